@@ -9,19 +9,34 @@ System Requirements:
 - ASI Camera SDK for Linux
 - Python 3 with Flask, NumPy, Pillow
 - libusb-1.0 (via apt)
+
+Set ASI_SIMULATOR=1 to run without a camera: the SDK is replaced by
+SimulatedASILibrary, which renders a synthetic star field (see the ASI_SIM_*
+environment variables in SimulatedASILibrary.from_environment).
 """
 
 from flask import Flask, Response, jsonify, send_file, request
 from flask_cors import CORS
+import bisect
 import ctypes
+import functools
+import heapq
+import itertools
+import mmap
 import numpy as np
 from PIL import Image
 import io
 import time
 import threading
+import types
 import os
 import platform
-from datetime import datetime
+import queue
+import re
+import tempfile
+from datetime import datetime, timezone
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future
 import json
 from uuid import uuid4
 
@@ -77,10 +92,14 @@ def get_library_paths():
     
     return paths
 
-lib_paths = get_library_paths()
+# Hardware-free mode: use the simulated SDK defined below instead of libASICamera2
+ASI_SIMULATOR = os.environ.get('ASI_SIMULATOR', '').lower() in ('1', 'true', 'yes')
+
+lib_paths = [] if ASI_SIMULATOR else get_library_paths()
 
 print(f"Detected architecture: {platform.machine()}")
-print(f"Trying to load ASI Camera library from {len(lib_paths)} possible paths...")
+if not ASI_SIMULATOR:
+    print(f"Trying to load ASI Camera library from {len(lib_paths)} possible paths...")
 
 for lib_path in lib_paths:
     if not os.path.exists(lib_path):
@@ -93,7 +112,7 @@ for lib_path in lib_paths:
     except Exception as e:
         print(f"Failed to load {lib_path}: {e}")
 
-if asi_lib is None:
+if asi_lib is None and not ASI_SIMULATOR:
     print("ERROR: Could not load ASI Camera library")
     print("Please ensure:")
     print("1. ASI Camera SDK is installed")
@@ -112,6 +131,12 @@ ASI_IMG_RGB24 = 1
 ASI_IMG_RAW16 = 2
 ASI_IMG_Y8 = 3
 
+# Bayer patterns (ASI_CAMERA_INFO.BayerPattern)
+ASI_BAYER_RG = 0
+ASI_BAYER_BG = 1
+ASI_BAYER_GR = 2
+ASI_BAYER_GB = 3
+
 # Control types (IMPORTANT: Order from header file)
 ASI_GAIN = 0
 ASI_EXPOSURE = 1
@@ -129,13 +154,545 @@ ASI_AUTO_TARGET_BRIGHTNESS = 12
 ASI_HARDWARE_BIN = 13
 ASI_HIGH_SPEED_MODE = 14
 
+# Error codes (ASI_ERROR_CODE)
+ASI_ERROR_INVALID_INDEX = 1
+ASI_ERROR_INVALID_ID = 2
+ASI_ERROR_INVALID_CONTROL_TYPE = 3
+ASI_ERROR_CAMERA_CLOSED = 4
+ASI_ERROR_CAMERA_REMOVED = 5
+ASI_ERROR_INVALID_SIZE = 8
+ASI_ERROR_INVALID_IMGTYPE = 9
+ASI_ERROR_OUTOF_BOUNDARY = 10
+ASI_ERROR_TIMEOUT = 11
+ASI_ERROR_INVALID_SEQUENCE = 12
+ASI_ERROR_BUFFER_TOO_SMALL = 13
+ASI_ERROR_VIDEO_MODE_ACTIVE = 14
+ASI_ERROR_EXPOSURE_IN_PROGRESS = 15
+ASI_ERROR_GENERAL_ERROR = 16
+
+# Exposure status (ASI_EXPOSURE_STATUS)
+ASI_EXP_IDLE = 0
+ASI_EXP_WORKING = 1
+ASI_EXP_SUCCESS = 2
+ASI_EXP_FAILED = 3
+
+EXP_STATUS_NAMES = {
+    ASI_EXP_IDLE: "ASI_EXP_IDLE",
+    ASI_EXP_WORKING: "ASI_EXP_WORKING",
+    ASI_EXP_SUCCESS: "ASI_EXP_SUCCESS",
+    ASI_EXP_FAILED: "ASI_EXP_FAILED"
+}
+
+# Exposure wait tuning: sleep until the expected end, then poll with exponential backoff
+EXPOSURE_POLL_MIN = 0.001  # seconds - first poll after the expected end of exposure
+EXPOSURE_POLL_MAX = 0.05  # seconds - backoff ceiling
+EXPOSURE_CHECK_INTERVAL = 1.0  # seconds - status check while a long exposure is running (early failure)
+EXPOSURE_TIMEOUT_MARGIN = 5.0
+IDLE_TIMEOUT = 3.0  # seconds - mode transitions wait this long for a confirmed IDLE before stopping the exposure
+
+# Asynchronous exposure jobs (/camera/jobs)
+EXPOSURE_JOB_TTL = 900.0  # Seconds a finished job and its image are kept for pickup
+EXPOSURE_JOB_MAX_RESULTS = 8  # Finished jobs kept in memory; the oldest are evicted first
+EXPOSURE_JOB_MAX_PENDING = 4  # Unfinished jobs at once; POST /camera/jobs answers 429 beyond this
+
+# Camera command priorities (lower runs first). Preview frames are captured only
+# when no command is waiting, so anything submitted preempts the live stream.
+PRIORITY_SNAPSHOT = 0  # User-requested photos
+PRIORITY_CONTROL = 1  # Connect/disconnect, stream start/stop, settings, ROI
+PRIORITY_SEQUENCE = 2  # Background sequence/time-lapse frames
+
+# Sequence frames are encoded/written in the background while the next exposure runs
+SEQUENCE_WRITE_WORKERS = 2  # Encoder threads (PIL releases the GIL while encoding)
+SEQUENCE_WRITE_QUEUE = 4  # Frames waiting for a worker before capture blocks (backpressure)
+BURST_HANDOFF_QUEUE = 4  # Burst frames waiting for the sequence thread; further frames are dropped, never waited for
+# Time-lapse: the preview stream is resumed between frames only if it would run at least this long
+TIMELAPSE_STREAM_RESUME_GAP = 3.0  # seconds - readout allowance beyond the exposure time
+
+class ASI_CAMERA_INFO(ctypes.Structure):
+    _fields_ = [
+        ("Name", ctypes.c_char * 64),
+        ("CameraID", ctypes.c_int),
+        ("MaxHeight", ctypes.c_long),
+        ("MaxWidth", ctypes.c_long),
+        ("IsColorCam", ctypes.c_int),
+        ("BayerPattern", ctypes.c_int),
+        ("SupportedBins", ctypes.c_int * 16),
+        ("SupportedVideoFormat", ctypes.c_int * 8),
+        ("PixelSize", ctypes.c_double),
+        ("MechanicalShutter", ctypes.c_int),
+        ("ST4Port", ctypes.c_int),
+        ("IsCoolerCam", ctypes.c_int),
+        ("IsUSB3Host", ctypes.c_int),
+        ("IsUSB3Camera", ctypes.c_int),
+        ("ElecPerADU", ctypes.c_float),
+        ("BitDepth", ctypes.c_int),
+        ("IsTriggerCam", ctypes.c_int),
+        ("Unused", ctypes.c_char * 16),
+    ]
+
+class ASI_CONTROL_CAPS(ctypes.Structure):
+    _fields_ = [
+        ("Name", ctypes.c_char * 64),
+        ("Description", ctypes.c_char * 128),
+        ("MaxValue", ctypes.c_long),
+        ("MinValue", ctypes.c_long),
+        ("DefaultValue", ctypes.c_long),
+        ("IsAutoSupported", ctypes.c_int),
+        ("IsWritable", ctypes.c_int),
+        ("ControlType", ctypes.c_int),
+        ("Unused", ctypes.c_char * 32),
+    ]
+
+class SimulatedASILibrary:
+    """Stand-in for libASICamera2 that needs no hardware.
+
+    Exposes the SDK functions this service calls, with the same conventions
+    (ctypes.byref out-parameters, integer ASI_ERROR_CODE results). Frames are a
+    synthetic star field scaled by gain/exposure. Video frames are paced at
+    max(exposure, 1/max_fps) and snapshot exposures take exposure +
+    readout_latency. failure_rate makes exposures end in ASI_EXP_FAILED, and
+    stuck_rate is the chance that such a failure leaves the camera FAILED until
+    it is closed and reopened (like the real stuck state seen on the Pi).
+    """
+    CAMERA_ID = 0
+    FORMAT_NAMES = {'RAW8': ASI_IMG_RAW8, 'RGB24': ASI_IMG_RGB24, 'RAW16': ASI_IMG_RAW16, 'Y8': ASI_IMG_Y8}
+    # (control, name, min, max, default, auto supported, writable)
+    CONTROLS = [
+        (ASI_GAIN, b'Gain', 0, 570, 200, True, True),
+        (ASI_EXPOSURE, b'Exposure', 32, 2000000000, 10000, True, True),
+        (ASI_GAMMA, b'Gamma', 1, 100, 50, False, True),
+        (ASI_WB_R, b'WB_R', 1, 99, 52, True, True),
+        (ASI_WB_B, b'WB_B', 1, 99, 95, True, True),
+        (ASI_BRIGHTNESS, b'Offset', 0, 80, 8, False, True),
+        (ASI_BANDWIDTHOVERLOAD, b'BandWidth', 40, 100, 50, True, True),
+        (ASI_TEMPERATURE, b'Temperature', -500, 1000, 20, False, False),
+        (ASI_FLIP, b'Flip', 0, 3, 0, False, True),
+        (ASI_AUTO_MAX_GAIN, b'AutoExpMaxGain', 0, 570, 285, False, True),
+        (ASI_AUTO_MAX_EXP, b'AutoExpMaxExpMS', 1, 60000, 100, False, True),
+        (ASI_AUTO_TARGET_BRIGHTNESS, b'AutoExpTargetBrightness', 50, 160, 100, False, True),
+        (ASI_HIGH_SPEED_MODE, b'HighSpeedMode', 0, 1, 0, False, True),
+    ]
+
+    def __init__(self, width=1920, height=1080, color=True, bayer_pattern=0, bit_depth=12,
+                 formats=(ASI_IMG_RAW8, ASI_IMG_RGB24, ASI_IMG_RAW16, ASI_IMG_Y8),
+                 max_fps=30.0, readout_latency=0.05, failure_rate=0.0, stuck_rate=0.0,
+                 video_timeout_rate=0.0, seed=1):
+        self.width = width - width % 8
+        self.height = height - height % 2
+        self.color = color
+        self.bayer_pattern = bayer_pattern
+        self.bit_depth = bit_depth
+        self.formats = list(formats)
+        self.max_fps = max_fps
+        self.readout_latency = readout_latency
+        self.failure_rate = failure_rate
+        self.stuck_rate = stuck_rate
+        self.video_timeout_rate = video_timeout_rate
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self._sky = None  # Full-sensor star field (float32), rendered on first use
+        self._frames = {}  # Rendered frame variants keyed by ROI/format/exposure/gain
+        self._frame_counter = 0
+        self.is_open = False
+        self._reset()
+
+    @classmethod
+    def from_environment(cls):
+        """Build a simulator from ASI_SIM_* environment variables"""
+        env = os.environ.get
+        formats = [cls.FORMAT_NAMES[name.strip().upper()]
+                   for name in env('ASI_SIM_FORMATS', 'RAW8,RGB24,RAW16,Y8').split(',')
+                   if name.strip().upper() in cls.FORMAT_NAMES]
+        return cls(
+            width=int(env('ASI_SIM_WIDTH', 1920)),
+            height=int(env('ASI_SIM_HEIGHT', 1080)),
+            color=env('ASI_SIM_COLOR', '1') not in ('0', 'false', 'no'),
+            bayer_pattern=int(env('ASI_SIM_BAYER', 0)),
+            bit_depth=int(env('ASI_SIM_BIT_DEPTH', 12)),
+            formats=formats or [ASI_IMG_RGB24],
+            max_fps=float(env('ASI_SIM_FPS', 30)),
+            readout_latency=float(env('ASI_SIM_EXPOSURE_LATENCY', 0.05)),
+            failure_rate=float(env('ASI_SIM_FAILURE_RATE', 0)),
+            stuck_rate=float(env('ASI_SIM_STUCK_RATE', 0)),
+            video_timeout_rate=float(env('ASI_SIM_VIDEO_TIMEOUT_RATE', 0)),
+            seed=int(env('ASI_SIM_SEED', 1)),
+        )
+
+    def _reset(self):
+        """Power-on state (also used by ASIInitCamera)"""
+        self.roi = {'width': self.width, 'height': self.height, 'bin': 1, 'img_type': ASI_IMG_RAW8,
+                    'start_x': 0, 'start_y': 0}
+        self.controls = {c[0]: [c[4], ASI_FALSE] for c in self.CONTROLS}
+        self.video_active = False
+        self.next_frame_time = 0.0
+        self.dropped_frames = 0
+        self.exp_status = ASI_EXP_IDLE
+        self.exp_end = 0.0
+        self.exp_will_fail = False
+        self.stuck = False
+
+    @staticmethod
+    def _out(pointer):
+        """Target object of a ctypes.byref()/pointer() argument"""
+        if hasattr(pointer, '_obj'):
+            return pointer._obj
+        if hasattr(pointer, 'contents'):
+            return pointer.contents
+        return pointer
+
+    def _check(self, camera_id):
+        if camera_id != self.CAMERA_ID:
+            return ASI_ERROR_INVALID_ID
+        if not self.is_open:
+            return ASI_ERROR_CAMERA_CLOSED
+        return ASI_SUCCESS
+
+    # --- Frame synthesis -------------------------------------------------
+
+    def _star_field(self):
+        """Full-resolution sky background plus Gaussian stars, in electrons per second"""
+        if self._sky is None:
+            rng = np.random.default_rng(12345)
+            sky = np.full((self.height, self.width), 40.0, dtype=np.float32)
+            sky += np.linspace(0, 25, self.width, dtype=np.float32)[None, :]  # Light-pollution gradient
+            count = max(50, self.width * self.height // 4000)
+            ys = rng.integers(3, self.height - 3, count)
+            xs = rng.integers(3, self.width - 3, count)
+            flux = rng.lognormal(7.0, 1.2, count).astype(np.float32)
+            offsets = np.arange(-2, 3)
+            dy, dx = np.meshgrid(offsets, offsets, indexing='ij')
+            psf = np.exp(-(dx ** 2 + dy ** 2) / 1.8).astype(np.float32)
+            psf /= psf.sum()
+            for oy in offsets:
+                for ox in offsets:
+                    np.add.at(sky, (ys + oy, xs + ox), flux * psf[oy + 2, ox + 2])
+            self._sky = sky
+        return self._sky
+
+    def _render(self, key):
+        width, height, bin_value, img_type, start_x, start_y, exposure, gain = key[:8]
+        sky = self._star_field()
+        y0, x0 = start_y * bin_value, start_x * bin_value
+        region = sky[y0:y0 + height * bin_value, x0:x0 + width * bin_value]
+        if bin_value > 1:
+            region = region.reshape(height, bin_value, width, bin_value).sum(axis=(1, 3))
+        scale = (exposure / 1e6) * (10 ** (gain / 200.0))
+        signal = region * np.float32(scale)
+        max_adu = (1 << self.bit_depth) - 1
+        noise = self.rng.normal(0.0, 3.0, signal.shape).astype(np.float32)
+        mono = np.clip(signal + noise + 64, 0, max_adu)
+        if img_type == ASI_IMG_RGB24:
+            tint = np.array([1.0, 0.9, 0.8] if self.color else [1.0, 1.0, 1.0], dtype=np.float32)
+            rgb = mono[:, :, None] * tint[None, None, :]
+            return (rgb / (1 << (self.bit_depth - 8))).astype(np.uint8)
+        if img_type == ASI_IMG_RAW16:
+            return (mono.astype(np.uint16) << (16 - self.bit_depth)).astype('<u2')
+        return (mono / (1 << (self.bit_depth - 8))).astype(np.uint8)
+
+    def _frame_bytes(self):
+        """Next synthetic frame for the current ROI/settings (a few cached noise variants)"""
+        roi = self.roi
+        base_key = (roi['width'], roi['height'], roi['bin'], roi['img_type'], roi['start_x'], roi['start_y'],
+                    self.controls[ASI_EXPOSURE][0], self.controls[ASI_GAIN][0])
+        self._frame_counter += 1
+        key = base_key + (self._frame_counter % 3,)
+        frame = self._frames.get(key)
+        if frame is None:
+            if len(self._frames) >= 6:
+                self._frames.clear()
+            frame = self._frames[key] = np.ascontiguousarray(self._render(key))
+        return frame
+
+    def _frame_size(self):
+        roi = self.roi
+        return roi['width'] * roi['height'] * bytes_per_pixel(roi['img_type'])
+
+    def _fill(self, buffer_pointer, size):
+        frame = self._frame_bytes()
+        if size < frame.nbytes:
+            return ASI_ERROR_BUFFER_TOO_SMALL
+        ctypes.memmove(ctypes.addressof(self._out(buffer_pointer)), frame.ctypes.data, frame.nbytes)
+        return ASI_SUCCESS
+
+    # --- Camera enumeration / lifecycle -----------------------------------
+
+    def ASIGetSDKVersion(self):
+        return b'1.40 (simulated)'
+
+    def ASIGetNumOfConnectedCameras(self):
+        return 1
+
+    def ASIGetCameraProperty(self, info_pointer, index):
+        if index != 0:
+            return ASI_ERROR_INVALID_INDEX
+        info = self._out(info_pointer)
+        info.Name = b'ZWO ASI Simulator'
+        info.CameraID = self.CAMERA_ID
+        info.MaxWidth = self.width
+        info.MaxHeight = self.height
+        info.IsColorCam = ASI_TRUE if self.color else ASI_FALSE
+        info.BayerPattern = self.bayer_pattern
+        for i, b in enumerate([1, 2, 3, 4, 0]):
+            info.SupportedBins[i] = b
+        for i in range(8):
+            info.SupportedVideoFormat[i] = self.formats[i] if i < len(self.formats) else -1
+        info.PixelSize = 2.9
+        info.IsUSB3Host = ASI_TRUE
+        info.IsUSB3Camera = ASI_TRUE
+        info.ElecPerADU = 1.0
+        info.BitDepth = self.bit_depth
+        return ASI_SUCCESS
+
+    def ASIOpenCamera(self, camera_id):
+        if camera_id != self.CAMERA_ID:
+            return ASI_ERROR_INVALID_ID
+        with self.lock:
+            self.is_open = True
+        return ASI_SUCCESS
+
+    def ASIInitCamera(self, camera_id):
+        result = self._check(camera_id)
+        if result == ASI_SUCCESS:
+            with self.lock:
+                self._reset()
+        return result
+
+    def ASICloseCamera(self, camera_id):
+        if camera_id != self.CAMERA_ID:
+            return ASI_ERROR_INVALID_ID
+        with self.lock:
+            self.is_open = False
+            self._reset()  # Closing clears a stuck exposure, as on real hardware
+        return ASI_SUCCESS
+
+    # --- Controls --------------------------------------------------------
+
+    def ASIGetNumOfControls(self, camera_id, count_pointer):
+        result = self._check(camera_id)
+        if result == ASI_SUCCESS:
+            self._out(count_pointer).value = len(self.CONTROLS)
+        return result
+
+    def ASIGetControlCaps(self, camera_id, index, caps_pointer):
+        result = self._check(camera_id)
+        if result != ASI_SUCCESS:
+            return result
+        if not 0 <= index < len(self.CONTROLS):
+            return ASI_ERROR_INVALID_INDEX
+        control, name, min_value, max_value, default, auto, writable = self.CONTROLS[index]
+        caps = self._out(caps_pointer)
+        caps.Name = name
+        caps.Description = b'Simulated ' + name
+        caps.MinValue = min_value
+        caps.MaxValue = max_value
+        caps.DefaultValue = default
+        caps.IsAutoSupported = ASI_TRUE if auto else ASI_FALSE
+        caps.IsWritable = ASI_TRUE if writable else ASI_FALSE
+        caps.ControlType = control
+        return ASI_SUCCESS
+
+    def ASIGetControlValue(self, camera_id, control, value_pointer, auto_pointer):
+        result = self._check(camera_id)
+        if result != ASI_SUCCESS:
+            return result
+        if control not in self.controls:
+            return ASI_ERROR_INVALID_CONTROL_TYPE
+        with self.lock:
+            value, auto = self.controls[control]
+            if control == ASI_TEMPERATURE:
+                value = 150 + int(self.rng.integers(-5, 6))  # 15.0 C +/- noise, SDK reports 10x
+        self._out(value_pointer).value = value
+        self._out(auto_pointer).value = auto
+        return ASI_SUCCESS
+
+    def ASISetControlValue(self, camera_id, control, value, auto):
+        result = self._check(camera_id)
+        if result != ASI_SUCCESS:
+            return result
+        spec = next((c for c in self.CONTROLS if c[0] == control), None)
+        if spec is None:
+            return ASI_ERROR_INVALID_CONTROL_TYPE
+        if not spec[6]:
+            return ASI_ERROR_GENERAL_ERROR
+        with self.lock:
+            self.controls[control] = [max(spec[2], min(spec[3], int(value))), ASI_TRUE if auto and spec[5] else ASI_FALSE]
+        return ASI_SUCCESS
+
+    # --- ROI -------------------------------------------------------------
+
+    def ASISetROIFormat(self, camera_id, width, height, bin_value, img_type):
+        result = self._check(camera_id)
+        if result != ASI_SUCCESS:
+            return result
+        if bin_value not in (1, 2, 3, 4):
+            return ASI_ERROR_INVALID_SIZE
+        if width <= 0 or height <= 0 or width % 8 or height % 2 \
+                or width * bin_value > self.width or height * bin_value > self.height:
+            return ASI_ERROR_INVALID_SIZE
+        if img_type not in self.formats:
+            return ASI_ERROR_INVALID_IMGTYPE
+        with self.lock:
+            # Like the SDK, a new ROI is centred on the sensor
+            self.roi = {'width': width, 'height': height, 'bin': bin_value, 'img_type': img_type,
+                        'start_x': (self.width // bin_value - width) // 2,
+                        'start_y': (self.height // bin_value - height) // 2}
+        return ASI_SUCCESS
+
+    def ASIGetROIFormat(self, camera_id, width_pointer, height_pointer, bin_pointer, type_pointer):
+        result = self._check(camera_id)
+        if result == ASI_SUCCESS:
+            self._out(width_pointer).value = self.roi['width']
+            self._out(height_pointer).value = self.roi['height']
+            self._out(bin_pointer).value = self.roi['bin']
+            self._out(type_pointer).value = self.roi['img_type']
+        return result
+
+    def ASISetStartPos(self, camera_id, start_x, start_y):
+        result = self._check(camera_id)
+        if result != ASI_SUCCESS:
+            return result
+        roi = self.roi
+        if start_x < 0 or start_y < 0 \
+                or start_x + roi['width'] > self.width // roi['bin'] \
+                or start_y + roi['height'] > self.height // roi['bin']:
+            return ASI_ERROR_OUTOF_BOUNDARY
+        with self.lock:
+            roi['start_x'] = start_x
+            roi['start_y'] = start_y
+        return ASI_SUCCESS
+
+    def ASIGetStartPos(self, camera_id, x_pointer, y_pointer):
+        result = self._check(camera_id)
+        if result == ASI_SUCCESS:
+            self._out(x_pointer).value = self.roi['start_x']
+            self._out(y_pointer).value = self.roi['start_y']
+        return result
+
+    # --- Video mode ------------------------------------------------------
+
+    def _frame_period(self):
+        return max(self.controls[ASI_EXPOSURE][0] / 1e6, 1.0 / self.max_fps)
+
+    def ASIStartVideoCapture(self, camera_id):
+        result = self._check(camera_id)
+        if result != ASI_SUCCESS:
+            return result
+        if self.exp_status == ASI_EXP_WORKING:
+            return ASI_ERROR_EXPOSURE_IN_PROGRESS
+        with self.lock:
+            self.video_active = True
+            self.dropped_frames = 0
+            self.next_frame_time = time.monotonic() + self._frame_period()
+        return ASI_SUCCESS
+
+    def ASIStopVideoCapture(self, camera_id):
+        result = self._check(camera_id)
+        if result == ASI_SUCCESS:
+            with self.lock:
+                self.video_active = False
+        return result
+
+    def ASIGetVideoData(self, camera_id, buffer_pointer, size, wait_ms, *unused):
+        result = self._check(camera_id)
+        if result != ASI_SUCCESS:
+            return result
+        if not self.video_active:
+            return ASI_ERROR_INVALID_SEQUENCE
+        if size < self._frame_size():
+            return ASI_ERROR_BUFFER_TOO_SMALL
+        period = self._frame_period()
+        with self.lock:
+            now = time.monotonic()
+            # Frames that completed while nobody was reading were overwritten (dropped)
+            if now - self.next_frame_time > period:
+                missed = int((now - self.next_frame_time) / period)
+                self.dropped_frames += missed
+                self.next_frame_time += missed * period
+            wait = self.next_frame_time - now
+        if wait_ms >= 0 and wait > wait_ms / 1000.0:
+            time.sleep(wait_ms / 1000.0)
+            return ASI_ERROR_TIMEOUT
+        if wait > 0:
+            time.sleep(wait)
+        with self.lock:
+            self.next_frame_time += period
+            if self.video_timeout_rate and self.rng.random() < self.video_timeout_rate:
+                self.dropped_frames += 1
+                return ASI_ERROR_TIMEOUT
+            return self._fill(buffer_pointer, size)
+
+    def ASIGetDroppedFrames(self, camera_id, count_pointer):
+        result = self._check(camera_id)
+        if result == ASI_SUCCESS:
+            self._out(count_pointer).value = self.dropped_frames
+        return result
+
+    # --- Snapshot mode ---------------------------------------------------
+
+    def ASIStartExposure(self, camera_id, is_dark):
+        result = self._check(camera_id)
+        if result != ASI_SUCCESS:
+            return result
+        if self.video_active:
+            return ASI_ERROR_VIDEO_MODE_ACTIVE
+        with self.lock:
+            if self.exp_status == ASI_EXP_WORKING:
+                return ASI_ERROR_EXPOSURE_IN_PROGRESS
+            self.exp_status = ASI_EXP_WORKING
+            self.exp_end = time.monotonic() + self.controls[ASI_EXPOSURE][0] / 1e6 + self.readout_latency
+            self.exp_will_fail = self.stuck or (self.failure_rate and self.rng.random() < self.failure_rate)
+            if self.exp_will_fail and not self.stuck and self.stuck_rate and self.rng.random() < self.stuck_rate:
+                self.stuck = True
+        return ASI_SUCCESS
+
+    def ASIGetExpStatus(self, camera_id, status_pointer):
+        result = self._check(camera_id)
+        if result != ASI_SUCCESS:
+            return result
+        with self.lock:
+            if self.exp_status == ASI_EXP_WORKING and time.monotonic() >= self.exp_end:
+                self.exp_status = ASI_EXP_FAILED if self.exp_will_fail else ASI_EXP_SUCCESS
+            if self.stuck and self.exp_status == ASI_EXP_IDLE:
+                self.exp_status = ASI_EXP_FAILED
+            self._out(status_pointer).value = self.exp_status
+        return ASI_SUCCESS
+
+    def ASIStopExposure(self, camera_id):
+        result = self._check(camera_id)
+        if result == ASI_SUCCESS:
+            with self.lock:
+                self.exp_status = ASI_EXP_FAILED if self.stuck else ASI_EXP_IDLE
+        return result
+
+    def ASIGetDataAfterExp(self, camera_id, buffer_pointer, size):
+        result = self._check(camera_id)
+        if result != ASI_SUCCESS:
+            return result
+        with self.lock:
+            if self.exp_status != ASI_EXP_SUCCESS:
+                return ASI_ERROR_GENERAL_ERROR
+            result = self._fill(buffer_pointer, size)
+            if result == ASI_SUCCESS:
+                self.exp_status = ASI_EXP_IDLE
+            return result
+
+if ASI_SIMULATOR:
+    asi_lib = SimulatedASILibrary.from_environment()
+    print(f"Using simulated ASI camera: {asi_lib.width} x {asi_lib.height}, "
+          f"{asi_lib.max_fps:g} fps max, failure rate {asi_lib.failure_rate:g}")
+
 # Camera state
 camera_state = {
     'connected': False,
     'streaming': False,
     'camera_id': -1,
-    'width': 1280,
-    'height': 960,
+    'width': 1280,  # Active video ROI width (binned pixels)
+    'height': 960,  # Active video ROI height (binned pixels)
+    'max_width': 1280,  # Full sensor width - photos always use the full frame
+    'max_height': 960,  # Full sensor height
+    'bin': 1,  # Video binning (1 = no binning)
+    'start_x': 0,  # Video ROI start position (binned pixels)
+    'start_y': 0,
     'exposure': 1000000,  # microseconds - for photo capture only
     'video_exposure': 100000,  # microseconds - max exposure for video streaming (controls frame rate)
     'gain': 50,
@@ -143,7 +700,12 @@ camera_state = {
     'wb_r': 50,  # White balance red channel (default, range 0-100)
     'wb_b': 50,  # White balance blue channel (default, range 0-100)
     'wb_auto': False,  # Auto white balance enabled (default: manual)
+    'bandwidth': 40,  # ASI_BANDWIDTHOVERLOAD percentage
     'image_format': ASI_IMG_RGB24,  # Default to RGB24
+    'demosaic': 'bilinear',  # RAW8/RAW16 from color cameras in JPEG output: bilinear, superpixel or none
+    'stretch': 'none',  # Auto-stretch for stream and snapshot JPEGs: none, midtone or asinh
+    'calibrate': False,  # Dark/flat calibration of photos (snapshots, jobs, sequences) from the calibration library
+    'calibrate_stream': False,  # Same for the preview stream (needs masters captured with target=stream)
     'current_frame': None,
     'error': None
 }
@@ -154,20 +716,1093 @@ sequence_state = {
     'save_path': None,
     'total_count': 0,
     'current_count': 0,
-    'file_format': 'JPEG',  # JPEG, PNG, or TIFF
+    'file_format': 'JPEG',  # JPEG, PNG, TIFF, or FITS
     'interval': 0,  # Interval between photos in seconds (0 = fast mode, >0 = time-lapse mode)
+    'thread': None,
+    'saved_count': 0,  # Frames the writer pool has finished writing to disk
+    'burst': False,  # Fast mode only: read frames from video mode instead of one exposure per frame
+    'burst_dropped': 0,  # Frames lost during burst capture (SDK drops and hand-off queue overflow)
+    'stack': None,  # Live stacking mode (mean, max or sigma), None = off
+    # Time-lapse schedule accounting (seconds)
+    'slots_triggered': 0,
+    'slots_skipped': 0,
+    'lateness_last': None,
+    'lateness_max': 0.0,
+    'lateness_total': 0.0,
+    'next_deadline': None  # time.monotonic() of the next time-lapse frame
+}
+
+# Dark/flat master capture (POST /camera/calibration/capture)
+calibration_state = {
+    'active': False,
+    'state': 'idle',  # idle, capturing, building
+    'kind': None,  # dark or flat
+    'method': None,  # median or mean
+    'target': None,  # photo or stream
+    'captured': 0,
+    'total': 0,
+    'error': None,
+    'last_master': None,  # File name of the most recently saved master
     'thread': None
 }
 
+# --- Metrics (Prometheus text exposition format, served on /metrics) ---
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _MetricChild:
+    """One labelled time series of a metric"""
+    __slots__ = ('lock', 'value', 'function', 'bounds', 'buckets', 'sum', 'count')
+
+    def __init__(self, bounds=None):
+        self.lock = threading.Lock()
+        self.value = 0.0
+        self.function = None
+        self.bounds = bounds
+        if bounds is not None:
+            self.buckets = [0] * (len(bounds) + 1)  # Last bucket is +Inf
+            self.sum = 0.0
+            self.count = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Gauge value computed at scrape time"""
+        self.function = function
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.buckets[index] += 1
+            self.sum += value
+            self.count += 1
+
+class Metric:
+    """Counter, gauge or histogram with optional labels.
+
+    Hot paths should bind a child once (metric.labels(...)) and reuse it, so an
+    update costs a lock and an addition.
+    """
+    def __init__(self, kind, name, documentation, labelnames=(), buckets=None):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.bounds = list(buckets) if kind == 'histogram' else None
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, _MetricChild(self.bounds))
+        return child
+
+    def remove(self, *values):
+        with self.lock:
+            self.children.pop(tuple(str(v) for v in values), None)
+
+    # Shortcuts for unlabelled metrics
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _label_text(self, values, extra=None):
+        pairs = list(zip(self.labelnames, values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape_label(v)}"' for k, v in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, child in list(self.children.items()):
+            if self.kind == 'histogram':
+                with child.lock:
+                    buckets = list(child.buckets)
+                    total, count = child.sum, child.count
+                cumulative = 0
+                for bound, bucket in zip(self.bounds + [float('inf')], buckets):
+                    cumulative += bucket
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f'{self.name}_bucket{self._label_text(values, ("le", le))} {cumulative}')
+                lines.append(f'{self.name}_sum{self._label_text(values)} {total!r}')
+                lines.append(f'{self.name}_count{self._label_text(values)} {count}')
+            else:
+                value = child.function() if child.function else child.value
+                lines.append(f'{self.name}{self._label_text(values)} {float(value)!r}')
+        return '\n'.join(lines)
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Metric('counter', name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Metric('gauge', name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=None):
+        return self._add(Metric('histogram', name, documentation, labelnames, buckets or LATENCY_BUCKETS))
+
+    def render(self):
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
+
+# Seconds - spans sub-millisecond conversions up to multi-minute exposures
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+metrics = MetricsRegistry()
+metric_video_data_seconds = metrics.histogram(
+    'camera_asi_get_video_data_seconds', 'Time spent in ASIGetVideoData')
+metric_video_data_results = metrics.counter(
+    'camera_asi_get_video_data_total', 'ASIGetVideoData calls by result code', ['result'])
+metric_video_timeouts = metrics.counter(
+    'camera_asi_get_video_data_timeouts_total', 'ASIGetVideoData calls that timed out')
+metric_frame_convert_seconds = metrics.histogram(
+    'camera_frame_convert_seconds', 'NumPy reshape and PIL conversion of a captured frame', ['path'])
+metric_jpeg_encode_seconds = metrics.histogram(
+    'camera_jpeg_encode_seconds', 'JPEG encode time', ['path'])
+metric_stream_write_seconds = metrics.histogram(
+    'camera_stream_write_seconds', 'Socket write time per MJPEG frame and client')
+metric_exp_status_poll_seconds = metrics.histogram(
+    'camera_exp_status_poll_seconds', 'Time spent polling ASIGetExpStatus for one snapshot')
+metric_exp_status_polls = metrics.counter(
+    'camera_exp_status_polls_total', 'ASIGetExpStatus calls made while waiting for exposures')
+metric_sequence_save_seconds = metrics.histogram(
+    'camera_sequence_save_seconds', 'File save time in sequence capture', ['format'])
+metric_sequence_encode_seconds = metrics.histogram(
+    'camera_sequence_encode_seconds', 'Image encode time in the sequence writer pool', ['format'])
+metric_sequence_backpressure_seconds = metrics.counter(
+    'camera_sequence_backpressure_seconds_total', 'Time the sequence loop waited for a free writer queue slot')
+metric_sequence_write_queue = metrics.gauge(
+    'camera_sequence_write_queue', 'Sequence frames waiting to be encoded and written')
+metric_stretch_seconds = metrics.histogram(
+    'camera_stretch_seconds', 'Auto-stretch time per frame (statistics plus lookup)', ['path'])
+metric_stretch_rebuilds = metrics.counter(
+    'camera_stretch_lut_rebuilds_total', 'Auto-stretch lookup tables rebuilt after the frame statistics drifted', ['path'])
+metric_stack_seconds = metrics.histogram(
+    'camera_stack_update_seconds', 'Live stack update time per sequence frame', ['mode'])
+metric_calibration_seconds = metrics.histogram(
+    'camera_calibration_seconds', 'Dark subtraction and flat fielding time per frame', ['path'])
+metric_frames_captured = metrics.counter(
+    'camera_frames_captured_total', 'Video frames captured by the capture loop')
+metric_capture_fps = metrics.gauge(
+    'camera_capture_fps', 'Achieved capture frame rate')
+metric_client_fps = metrics.gauge(
+    'camera_stream_client_fps', 'Frames per second delivered to each MJPEG client', ['client'])
+metric_stream_clients = metrics.gauge(
+    'camera_stream_clients', 'Connected MJPEG stream clients')
+metric_dropped_frames = metrics.counter(
+    'camera_dropped_frames_total', 'Frames lost in the SDK (sdk) or skipped by the service (host)', ['source'])
+
+class DropTracker:
+    """Dropped-frame accounting for video mode.
+
+    sdk: frames the SDK reports as dropped (ASIGetDroppedFrames - usually USB
+    bandwidth or the capture loop not reading fast enough).
+    host: frames we captured but replaced before any stream client used them.
+    A one-sample-per-second rolling window keeps the counts next to the
+    bandwidth and exposure settings in effect, for correlation.
+    """
+    def __init__(self, window_seconds=300):
+        self.lock = threading.Lock()
+        self.frames_total = 0
+        self.sdk_total = 0
+        self.host_total = 0
+        self._sdk_session = 0  # ASIGetDroppedFrames is cumulative per video session
+        self.window = deque(maxlen=window_seconds)
+        self._bucket = None
+
+    def start_session(self):
+        with self.lock:
+            self._sdk_session = 0
+
+    def record_frame(self):
+        with self.lock:
+            self.frames_total += 1
+            self._current_bucket()['frames'] += 1
+
+    def record_sdk_count(self, session_count):
+        """Feed the cumulative ASIGetDroppedFrames value of the running video session"""
+        with self.lock:
+            delta = session_count - self._sdk_session
+            if delta < 0:  # SDK counter restarted
+                delta = session_count
+            self._sdk_session = session_count
+            if delta:
+                self.sdk_total += delta
+                self._current_bucket()['sdk'] += delta
+        if delta:
+            metric_dropped_frames.labels('sdk').inc(delta)
+
+    def record_host_skip(self, count=1):
+        with self.lock:
+            self.host_total += count
+            self._current_bucket()['host'] += count
+        metric_dropped_frames.labels('host').inc(count)
+
+    def _current_bucket(self):
+        """Per-second sample (lock held)"""
+        second = int(time.time())
+        if self._bucket is None or self._bucket['time'] != second:
+            self._bucket = {
+                'time': second,
+                'frames': 0,
+                'sdk': 0,
+                'host': 0,
+                'bandwidth': camera_state['bandwidth'],
+                'video_exposure': camera_state['video_exposure'],
+            }
+            self.window.append(self._bucket)
+        return self._bucket
+
+    def summary(self, seconds=60):
+        """Running totals plus drop rate (frames/s) over the last `seconds` seconds"""
+        with self.lock:
+            cutoff = time.time() - seconds
+            recent = [b for b in self.window if b['time'] >= cutoff]
+            sdk_recent = sum(b['sdk'] for b in recent)
+            host_recent = sum(b['host'] for b in recent)
+            frames_recent = sum(b['frames'] for b in recent)
+            return {
+                'frames': self.frames_total,
+                'sdk_dropped': self.sdk_total,
+                'host_skipped': self.host_total,
+                'sdk_drop_rate': sdk_recent / float(seconds),
+                'host_skip_rate': host_recent / float(seconds),
+                'drop_ratio': (sdk_recent + host_recent) / float(max(1, frames_recent + sdk_recent)),
+                'window_seconds': seconds,
+            }
+
+    def history(self):
+        with self.lock:
+            return [dict(b) for b in self.window]
+
+class RateMeter:
+    """Events per second over roughly one-second windows, published to a gauge child"""
+    def __init__(self, gauge_child, window=1.0):
+        self.gauge_child = gauge_child
+        self.window = window
+        self.count = 0
+        self.window_start = time.monotonic()
+
+    def tick(self):
+        self.count += 1
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed >= self.window:
+            self.gauge_child.set(self.count / elapsed)
+            self.count = 0
+            self.window_start = now
+
+def bytes_per_pixel(img_format):
+    """Bytes per pixel delivered by the SDK for an ASI image format"""
+    if img_format == ASI_IMG_RGB24:
+        return 3
+    if img_format == ASI_IMG_RAW16:
+        return 2
+    return 1  # RAW8 / Y8
+
+# Attributes the capture paths set on a frame (the settings it was taken with); copied onto derived frames
+FRAME_METADATA = ('bayer_pattern', 'exposure_us', 'exposure_start', 'gain', 'gamma', 'img_format', 'temperature')
+
+def frame_to_image(buffer, width, height, img_format, bayer_pattern=None):
+    """Copy a raw SDK frame into a new PIL image (the buffer can be reused right after)
+
+    RAW frames stay undebayered (files keep the sensor data); bayer_pattern is
+    recorded on the image so preview_8bit can demosaic it for JPEG output.
+    """
+    if img_format == ASI_IMG_RGB24:
+        return Image.frombytes('RGB', (width, height), buffer)
+    if img_format == ASI_IMG_Y8:
+        return Image.frombytes('L', (width, height), buffer)  # Grayscale
+    if img_format == ASI_IMG_RAW8:
+        img_array = np.frombuffer(buffer, dtype=np.uint8, count=width * height).reshape(height, width).copy()
+    elif img_format == ASI_IMG_RAW16:
+        # RAW16: zero-copy little-endian view of the SDK buffer, copied once so the
+        # pooled buffer can be reused. The 'I;16' image shares memory with that copy
+        # and keeps the full bit depth (PNG/TIFF are written as 16-bit).
+        img_array = np.frombuffer(buffer, dtype='<u2', count=width * height).reshape(height, width).copy()
+    else:
+        raise ValueError(f"Unsupported image format: {img_format}")
+    img = Image.fromarray(img_array)
+    img.array = img_array  # Same memory - lets writers (FITS) read the pixels without another copy
+    img.bayer_pattern = bayer_pattern
+    return img
+
+def frame_array(img):
+    """NumPy pixels of a captured frame (no copy for RAW16 frames from frame_to_image)"""
+    array = getattr(img, 'array', None)
+    return array if array is not None else np.asarray(img)
+
+# Bayer pattern -> (row, column) of the red pixel in each 2x2 cell; blue is diagonally opposite
+BAYER_RED_OFFSET = {ASI_BAYER_RG: (0, 0), ASI_BAYER_BG: (1, 1), ASI_BAYER_GR: (0, 1), ASI_BAYER_GB: (1, 0)}
+DEMOSAIC_MODES = ('bilinear', 'superpixel', 'none')
+
+class Demosaicer:
+    """Vectorized Bayer demosaic for 8- and 16-bit mosaics, all four patterns.
+
+    bilinear: full resolution, each missing color is the mean of its 2 or 4
+    nearest neighbours of that color. superpixel: each 2x2 cell becomes one
+    RGB pixel (half resolution, no interpolation). Intermediate sums use
+    scratch buffers cached per thread and shape, so a steady stream of frames
+    allocates only the output - or nothing when out= is passed.
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+    def _scratch(self, name, shape, dtype):
+        buffers = self.local.__dict__.setdefault('buffers', {})
+        key = (name, shape, dtype)
+        buffer = buffers.get(key)
+        if buffer is None:
+            if len(buffers) > 32:
+                buffers.clear()  # Frame size changed - drop buffers for the old shapes
+            buffer = buffers[key] = np.empty(shape, dtype)
+        return buffer
+
+    def demosaic(self, raw, bayer_pattern, mode='bilinear', out=None):
+        if mode == 'superpixel':
+            return self.superpixel(raw, bayer_pattern, out)
+        return self.bilinear(raw, bayer_pattern, out)
+
+    def superpixel(self, raw, bayer_pattern, out=None):
+        """(h/2, w/2, 3) RGB from 2x2 cells: R and B as-is, G the mean of the two greens"""
+        ry, rx = BAYER_RED_OFFSET[bayer_pattern]
+        by, bx = 1 - ry, 1 - rx
+        height, width = raw.shape[0] // 2 * 2, raw.shape[1] // 2 * 2
+        wide = np.uint16 if raw.dtype == np.uint8 else np.uint32
+        if out is None:
+            out = np.empty((height // 2, width // 2, 3), raw.dtype)
+        out[..., 0] = raw[ry:height:2, rx:width:2]
+        out[..., 2] = raw[by:height:2, bx:width:2]
+        green = self._scratch('green', (height // 2, width // 2), wide)
+        np.add(raw[ry:height:2, bx:width:2], raw[by:height:2, rx:width:2], out=green, dtype=wide)
+        green >>= 1
+        out[..., 1] = green
+        return out
+
+    def bilinear(self, raw, bayer_pattern, out=None):
+        """(h, w, 3) RGB, processed per 2x2 phase from a mirrored copy split into phase planes"""
+        ry, rx = BAYER_RED_OFFSET[bayer_pattern]
+        height, width = raw.shape
+        wide = np.uint16 if raw.dtype == np.uint8 else np.uint32
+        # Padded copy in a wider type so neighbour sums cannot overflow. Mirroring
+        # (row -1 = row 1) keeps the Bayer phase at the borders.
+        padded = self._scratch('padded', (height + 2, width + 2), wide)
+        padded[1:-1, 1:-1] = raw
+        padded[0, 1:-1] = raw[1]
+        padded[-1, 1:-1] = raw[-2]
+        padded[:, 0] = padded[:, 2]
+        padded[:, -1] = padded[:, -3]
+        # Split into the four 2x2 phases once: every neighbour view below is then a
+        # plain (contiguous-row) slice instead of a stride-2 gather
+        planes = {}
+        for a in (0, 1):
+            for b in (0, 1):
+                source = padded[a::2, b::2]
+                planes[a, b] = self._scratch(('plane', a, b), source.shape, wide)
+                np.copyto(planes[a, b], source)
+        if out is None:
+            out = np.empty((height, width, 3), raw.dtype)
+        
+        for py in (0, 1):
+            for px in (0, 1):
+                rows = (height - py + 1) // 2
+                cols = (width - px + 1) // 2
+                
+                def at(dy, dx):
+                    # Neighbour (dy, dx) of every pixel in this phase
+                    y = 1 + py + dy
+                    x = 1 + px + dx
+                    return planes[y % 2, x % 2][y // 2:y // 2 + rows, x // 2:x // 2 + cols]
+                
+                dest = out[py::2, px::2]
+                acc = self._scratch(('sum', py, px), (rows, cols), wide)
+                if (py, px) == (ry, rx) or (py, px) == (1 - ry, 1 - rx):
+                    own = 0 if (py, px) == (ry, rx) else 2
+                    dest[..., own] = at(0, 0)
+                    # Green: the 4 direct neighbours
+                    np.add(at(-1, 0), at(1, 0), out=acc)
+                    acc += at(0, -1)
+                    acc += at(0, 1)
+                    acc += 2
+                    acc >>= 2
+                    dest[..., 1] = acc
+                    # The opposite color: the 4 diagonal neighbours
+                    np.add(at(-1, -1), at(-1, 1), out=acc)
+                    acc += at(1, -1)
+                    acc += at(1, 1)
+                    acc += 2
+                    acc >>= 2
+                    dest[..., 2 - own] = acc
+                else:
+                    dest[..., 1] = at(0, 0)
+                    # Green in a red row has red left/right and blue above/below (and vice versa)
+                    horizontal = 0 if py == ry else 2
+                    np.add(at(0, -1), at(0, 1), out=acc)
+                    acc += 1
+                    acc >>= 1
+                    dest[..., horizontal] = acc
+                    np.add(at(-1, 0), at(1, 0), out=acc)
+                    acc += 1
+                    acc >>= 1
+                    dest[..., 2 - horizontal] = acc
+        return out
+
+demosaicer = Demosaicer()
+
+STRETCH_MODES = ('none', 'midtone', 'asinh')
+STRETCH_SAMPLES = 65536  # Pixels sampled for the black/median/white estimate
+STRETCH_BLACK_PERCENTILE = 0.5
+STRETCH_WHITE_PERCENTILE = 99.95
+STRETCH_TARGET_BACKGROUND = 0.25  # Output level (0-1) the median is mapped to
+STRETCH_DRIFT = 0.02  # Rebuild the table once a statistic moves this fraction of the black-white range
+
+def build_stretch_lut(stats, mode, levels):
+    """uint8 lookup table with `levels` entries (256 or 65536) for a stretch curve.
+
+    Input is normalised to the black..white range; midtone uses the midtones
+    transfer function, asinh an arcsinh curve, both chosen so the median lands
+    on STRETCH_TARGET_BACKGROUND.
+    """
+    black, median, white = stats
+    white = max(white, black + 1.0)
+    x = np.clip((np.arange(levels, dtype=np.float64) - black) / (white - black), 0.0, 1.0)
+    m = min(max((median - black) / (white - black), 1e-6), 1.0 - 1e-6)
+    target = STRETCH_TARGET_BACKGROUND
+    if mode == 'midtone':
+        balance = m * (target - 1) / (2 * target * m - target - m)
+        y = (balance - 1) * x / ((2 * balance - 1) * x - balance)
+    else:
+        if m >= target:
+            y = x  # Already bright enough - asinh only ever lifts the background
+        else:
+            # asinh(k*m)/asinh(k) grows from m towards 1 with k: bisect log(k)
+            low, high = -6.0, 12.0
+            for _ in range(40):
+                k = np.exp((low + high) / 2)
+                if np.arcsinh(k * m) / np.arcsinh(k) < target:
+                    low = np.log(k)
+                else:
+                    high = np.log(k)
+            k = np.exp((low + high) / 2)
+            y = np.arcsinh(k * x) / np.arcsinh(k)
+    return np.round(np.clip(y, 0.0, 1.0) * 255).astype(np.uint8)
+
+class AutoStretch:
+    """Percentile black/white point plus midtone or asinh curve, applied as a lookup table.
+
+    Statistics come from a strided subsample (about STRETCH_SAMPLES pixels), so
+    estimating them costs far less than the lookup itself. The table is only
+    rebuilt when the mode changes or the statistics drift by more than
+    STRETCH_DRIFT of the black-white range, so steady frames reuse it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.key = None  # (mode, levels) the table was built for
+        self.stats = None  # (black, median, white) the table was built from
+        self.lut = None
+        self.point_table = None  # lut as a list, for PIL Image.point
+        self.rebuilds = 0
+
+    def statistics(self, array):
+        """(black, median, white) of a strided subsample of an integer image array"""
+        step = max(1, int(np.sqrt(array.shape[0] * array.shape[1] / STRETCH_SAMPLES)))
+        sample = array[::step, ::step].ravel()
+        # Histogram + cumulative sum: one linear pass, cheaper than np.percentile's partitioning
+        cumulative = np.cumsum(np.bincount(sample, minlength=256))
+        ranks = np.array((STRETCH_BLACK_PERCENTILE, 50.0, STRETCH_WHITE_PERCENTILE)) / 100.0 * (sample.size - 1)
+        return tuple(float(v) for v in np.searchsorted(cumulative, ranks, side='right'))
+
+    def lookup_table(self, array, mode):
+        levels = 65536 if array.dtype == np.uint16 else 256
+        stats = self.statistics(array)
+        with self.lock:
+            if self.key == (mode, levels) and self.stats is not None:
+                tolerance = STRETCH_DRIFT * max(self.stats[2] - self.stats[0], 1.0)
+                if all(abs(a - b) <= tolerance for a, b in zip(stats, self.stats)):
+                    return self.lut, self.point_table
+            self.lut = build_stretch_lut(stats, mode, levels)
+            self.point_table = self.lut.tolist() if levels == 256 else None
+            self.key = (mode, levels)
+            self.stats = stats
+            self.rebuilds += 1
+            metric_stretch_rebuilds.labels(self.path).inc()
+            return self.lut, self.point_table
+
+    def apply(self, img, mode, array=None):
+        """Stretched 8-bit copy of img (L, RGB or I;16); array is img's pixels if already at hand"""
+        started = time.perf_counter()
+        if array is None:
+            array = frame_array(img)
+        lut, point_table = self.lookup_table(array, mode)
+        if point_table is not None:
+            # 8-bit: PIL's point() runs the table per band in C, several times faster than np.take
+            stretched = img.point(point_table * len(img.getbands()))
+        else:
+            stretched_array = np.take(lut, array)
+            stretched = Image.fromarray(stretched_array)
+            stretched.array = stretched_array
+        metric_stretch_seconds.labels(self.path).observe(time.perf_counter() - started)
+        return stretched
+
+stream_stretch = AutoStretch('stream')
+snapshot_stretch = AutoStretch('snapshot')
+stack_stretch = AutoStretch('stack')
+
+def preview_8bit(img, stretch=None):
+    """8-bit version of a frame for JPEG.
+
+    With stretch (an AutoStretch) and camera_state['stretch'] enabled, the frame
+    goes through its lookup table; otherwise 16-bit RAW16 frames keep their
+    upper 8 bits. RAW frames from color cameras are then demosaiced
+    (camera_state['demosaic']).
+    """
+    bayer_pattern = getattr(img, 'bayer_pattern', None)
+    mode = camera_state.get('demosaic', 'bilinear')
+    stretch_mode = camera_state.get('stretch', 'none') if stretch is not None else 'none'
+    if stretch_mode != 'none':
+        img = stretch.apply(img, stretch_mode)
+    if img.mode != 'I;16' and (bayer_pattern is None or mode == 'none'):
+        return img
+    raw = frame_array(img)
+    if raw.dtype == np.uint16:
+        # The SDK left-aligns sensor data in 16 bits, so the top byte is the most significant data
+        raw = (raw >> 8).astype(np.uint8)
+    if bayer_pattern is None or mode == 'none':
+        return Image.fromarray(raw)
+    return Image.fromarray(demosaicer.demosaic(raw, bayer_pattern, mode))
+
+class FrameSlot:
+    """One preallocated, page-aligned frame buffer owned by a FrameBufferPool"""
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.width, self.height, self.img_format = key
+        self.size = self.width * self.height * bytes_per_pixel(self.img_format)
+        # Anonymous mmap is always page-aligned, which is what the SDK's USB transfers prefer
+        self._mmap = mmap.mmap(-1, self.size)
+        self.buffer = (ctypes.c_ubyte * self.size).from_buffer(self._mmap)
+        self.refcount = 0
+        self.timestamp = 0.0
+        self.image = None  # Persistent PIL image, refilled in place by to_image()
+
+    def array(self):
+        """NumPy view of the buffer (no copy) - only valid while a reference is held"""
+        data = np.frombuffer(self.buffer, dtype=np.uint8)
+        if self.img_format == ASI_IMG_RGB24:
+            return data.reshape((self.height, self.width, 3))
+        if self.img_format == ASI_IMG_RAW16:
+            return data.reshape((self.height, self.width, 2))
+        return data.reshape((self.height, self.width))
+
+    def to_image(self):
+        """PIL image of the current buffer contents, reusing the same image object every frame"""
+        mode = 'RGB' if self.img_format == ASI_IMG_RGB24 else 'L'
+        if self.img_format == ASI_IMG_RAW16:
+            raise ValueError("RAW16 slots have no 8-bit image view")
+        if self.image is None:
+            self.image = Image.new(mode, (self.width, self.height))
+        self.image.frombytes(self.buffer)
+        return self.image
+
+    def retain(self):
+        self.pool.retain(self)
+        return self
+
+    def release(self):
+        self.pool.release(self)
+
+class FrameBufferPool:
+    """Ring of reusable frame buffers keyed by (width, height, format).
+
+    Buffers are handed out with acquire() (refcount 1) and go back to the free
+    list once every holder has called release(). Slots are allocated lazily, up
+    to slots_per_key per format, so a key that is only used for snapshots costs
+    a single buffer.
+    """
+    def __init__(self, slots_per_key=4):
+        self.slots_per_key = slots_per_key
+        self.lock = threading.Lock()
+        self.free = {}       # key -> list of idle FrameSlot
+        self.allocated = {}  # key -> number of FrameSlot created
+
+    def acquire(self, width, height, img_format):
+        """Check out a free buffer, or None if every slot for this key is in use"""
+        key = (int(width), int(height), int(img_format))
+        with self.lock:
+            free = self.free.setdefault(key, [])
+            if free:
+                slot = free.pop()
+            elif self.allocated.get(key, 0) < self.slots_per_key:
+                slot = FrameSlot(self, key)
+                self.allocated[key] = self.allocated.get(key, 0) + 1
+            else:
+                return None
+            slot.refcount = 1
+            return slot
+
+    def retain(self, slot):
+        with self.lock:
+            slot.refcount += 1
+
+    def release(self, slot):
+        with self.lock:
+            slot.refcount -= 1
+            if slot.refcount == 0:
+                self.free.setdefault(slot.key, []).append(slot)
+
+    def discard_idle(self, keep_key=None):
+        """Drop idle buffers of other formats/sizes (e.g. after the ROI changes)"""
+        with self.lock:
+            for key in list(self.free):
+                if key == keep_key:
+                    continue
+                self.allocated[key] = self.allocated.get(key, 0) - len(self.free[key])
+                del self.free[key]
+
+# Encoding parameters shared by stream clients - clients with equal profiles share JPEG bytes
+StreamProfile = namedtuple('StreamProfile', ['max_width', 'quality'])
+DEFAULT_STREAM_PROFILE = StreamProfile(max_width=None, quality=75)
+
+def downscale_array(img_array, max_width):
+    """Shrink an image array by an integer factor so its width is <= max_width.
+
+    Uses a box (area) filter built from strided views summed in uint16, so the
+    cost is a handful of vectorized passes over the already-reduced output.
+    """
+    height, width = img_array.shape[:2]
+    if not max_width or width <= max_width:
+        return img_array
+    factor = -(-width // max_width)  # ceil division
+    out_h = height // factor
+    out_w = width // factor
+    if factor > 4:
+        # Large reductions: plain decimation is visually fine and costs a single copy
+        return np.ascontiguousarray(img_array[:out_h * factor:factor, :out_w * factor:factor])
+    acc = np.zeros((out_h, out_w) + img_array.shape[2:], dtype=np.uint16)
+    for dy in range(factor):
+        for dx in range(factor):
+            acc += img_array[dy:out_h * factor:factor, dx:out_w * factor:factor]
+    acc //= factor * factor
+    return acc.astype(np.uint8)
+
+class _ProfileCache:
+    """Most recent JPEG encoded for one StreamProfile"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jpeg = None
+        self.sequence = 0
+        self.subscribers = 0
+
+class FrameBroadcaster:
+    """Fan out captured frames to all MJPEG clients, encoding each frame once per stream profile"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.sequence = 0  # Incremented for every frame published by the capture loop
+        self.frame = None  # FrameSlot of the latest frame - the broadcaster holds one reference
+        self.closed = False
+        self.profiles = {}  # StreamProfile -> _ProfileCache, dropped when the last client leaves
+        self.clients = 0
+        self.consumed_sequence = 0  # Newest sequence any client has picked up
+
+    def publish(self, slot):
+        """Called by the capture loop for every new frame - cheap, no encoding here.
+
+        Takes over the caller's reference to slot and drops the previous frame.
+        """
+        with self.condition:
+            previous = self.frame
+            # Replacing a frame that connected clients never picked up = host-side skip
+            skipped = previous is not None and self.clients > 0 and self.consumed_sequence < self.sequence
+            self.frame = slot
+            self.sequence += 1
+            self.condition.notify_all()
+        if previous is not None:
+            previous.release()
+        if skipped:
+            drop_tracker.record_host_skip()
+
+    def open(self):
+        """Stream (re)started - clients may block waiting for frames again"""
+        with self.condition:
+            self.closed = False
+
+    def close(self):
+        """Wake up all waiting clients (stream stopped)"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def subscribe(self, profile):
+        """Register a stream client for profile"""
+        with self.condition:
+            self.clients += 1
+            cache = self.profiles.get(profile)
+            if cache is None:
+                cache = self.profiles[profile] = _ProfileCache()
+            cache.subscribers += 1
+
+    def unsubscribe(self, profile):
+        with self.condition:
+            self.clients -= 1
+            cache = self.profiles.get(profile)
+            if cache is not None:
+                cache.subscribers -= 1
+                if cache.subscribers <= 0:
+                    del self.profiles[profile]
+
+    def wait_for_frame(self, last_sequence, profile=DEFAULT_STREAM_PROFILE, timeout=1.0):
+        """Block until a frame newer than last_sequence exists.
+
+        Returns (sequence, jpeg_bytes), or (last_sequence, None) on timeout/close.
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.closed or (self.frame is not None and self.sequence != last_sequence),
+                timeout
+            )
+            if self.frame is None or self.sequence == last_sequence:
+                return last_sequence, None
+            sequence = self.sequence
+            self.consumed_sequence = max(self.consumed_sequence, sequence)
+            slot = self.frame.retain()  # Keep the buffer out of the free list while we encode
+            cache = self.profiles.get(profile)
+            if cache is None:
+                cache = self.profiles[profile] = _ProfileCache()
+        try:
+            return self._encode(sequence, slot, profile, cache)
+        finally:
+            slot.release()
+
+    def _encode(self, sequence, slot, profile, cache):
+        """Encode frame once per profile - the first client to ask does the work, the rest reuse the bytes"""
+        with cache.lock:
+            # Another client may already have encoded this frame (or a newer one) while we waited
+            if cache.sequence < sequence:
+                if profile.max_width and slot.width > profile.max_width:
+                    array = downscale_array(slot.array(), profile.max_width)
+                    img = Image.fromarray(array)
+                else:
+                    array = slot.array()
+                    img = slot.image
+                stretch_mode = camera_state['stretch']
+                if stretch_mode != 'none':
+                    img = stream_stretch.apply(img, stretch_mode, array)
+                started = time.perf_counter()
+                img_io = io.BytesIO()
+                img.save(img_io, 'JPEG', quality=profile.quality)
+                cache.jpeg = img_io.getvalue()
+                metric_jpeg_encode_seconds.labels('stream').observe(time.perf_counter() - started)
+                cache.sequence = sequence
+            return cache.sequence, cache.jpeg
+
+class ExposureJob:
+    """One asynchronous snapshot: queued -> starting -> exposing -> encoding -> done/failed"""
+    def __init__(self, job_id):
+        self.id = job_id
+        self.state = 'queued'
+        self.created = time.time()
+        self.finished = None  # time.monotonic() when done/failed, used for TTL eviction
+        self.exposure_us = None
+        self.exposure_started = None  # time.monotonic()
+        self.result = None  # JPEG bytes
+        self.error = None
+
+    def exposure_started_at(self, started, exposure_us):
+        self.exposure_us = exposure_us
+        self.exposure_started = started
+        self.state = 'exposing'
+
+    def to_dict(self):
+        elapsed = None
+        progress = 1.0 if self.state == 'done' else 0.0
+        if self.exposure_started is not None:
+            elapsed = (self.finished or time.monotonic()) - self.exposure_started
+            if self.state in ('exposing', 'encoding'):
+                # Never report 100% before the image is actually read out
+                progress = min(0.99, elapsed / max(self.exposure_us / 1e6, 1e-6))
+        return {
+            'job_id': self.id,
+            'state': self.state,
+            'progress': round(progress, 3),
+            'elapsed': round(elapsed, 3) if elapsed is not None else None,
+            'exposure': self.exposure_us,
+            'created': datetime.fromtimestamp(self.created).isoformat(),
+            'error': self.error,
+            'result_size': len(self.result) if self.result else None
+        }
+
+class ExposureJobStore:
+    """Bounded in-memory store for exposure jobs with TTL eviction of finished results"""
+    def __init__(self, max_results=EXPOSURE_JOB_MAX_RESULTS, ttl=EXPOSURE_JOB_TTL,
+                 max_pending=EXPOSURE_JOB_MAX_PENDING):
+        self.lock = threading.Lock()
+        self.jobs = {}  # job id -> ExposureJob, in creation order
+        self.max_results = max_results
+        self.ttl = ttl
+        self.max_pending = max_pending
+
+    def create(self):
+        """New queued job, or None if max_pending jobs are still unfinished"""
+        with self.lock:
+            self._evict()
+            if sum(1 for job in self.jobs.values() if job.finished is None) >= self.max_pending:
+                return None
+            job = ExposureJob(uuid4().hex)
+            self.jobs[job.id] = job
+            return job
+
+    def get(self, job_id):
+        with self.lock:
+            self._evict()
+            return self.jobs.get(job_id)
+
+    def finish(self, job, result=None, error=None):
+        with self.lock:
+            job.result = result
+            job.error = error
+            job.state = 'done' if result is not None else 'failed'
+            job.finished = time.monotonic()
+            self._evict()
+
+    def _evict(self):
+        """Drop expired jobs, then the oldest finished ones beyond max_results (lock held)"""
+        now = time.monotonic()
+        finished = [job for job in self.jobs.values() if job.finished is not None]
+        for job in finished:
+            if now - job.finished > self.ttl:
+                del self.jobs[job.id]
+        finished = [job for job in finished if job.id in self.jobs]
+        for job in finished[:max(0, len(finished) - self.max_results)]:
+            del self.jobs[job.id]
+
+    def active(self):
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.finished is None)
+
+class CameraCommand:
+    """A queued call for the camera thread"""
+    def __init__(self, fn, args, kwargs, merge_key=None, concurrent=False):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.merge_key = merge_key
+        self.concurrent = concurrent  # May run while an operation (exposure) is in flight
+        self.future = Future()
+
+class OperationAborted(Exception):
+    """Thrown into a camera operation that has to stop early (e.g. the camera is disconnecting)"""
+
+def finish_inline(result):
+    """Result of a camera command run inline; operations are stepped to completion, sleeping between steps"""
+    if not isinstance(result, types.GeneratorType):
+        return result
+    try:
+        while True:
+            time.sleep(next(result))
+    except StopIteration as stop:
+        return stop.value
+
+class CameraExecutor:
+    """Single thread that owns the camera handle and runs every SDK call.
+
+    Commands come from a priority queue and callers wait on futures. When the
+    queue is empty the idle task runs (one preview frame per call), so queued
+    commands preempt the stream after at most one ASIGetVideoData.
+
+    A command that returns a generator becomes an operation: each step runs
+    on the camera thread and yields the delay until its next step (an
+    exposure is started, then its status is polled), and the future completes
+    with the generator's return value. Other commands run between steps, but
+    only those submitted as concurrent; the rest wait until no operation is
+    in flight, and so does the preview stream.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queue = []  # heap of (priority, order, CameraCommand)
+        self.merging = {}  # merge_key -> queued CameraCommand that later submissions fold into
+        self.operations = []  # heap of (due time.monotonic(), order, generator, Future) for operations in flight
+        self.order = itertools.count()
+        self.thread = None
+        self.idle_task = None  # Returns True if it did work, False to sleep until a command arrives
+
+    def on_camera_thread(self):
+        return threading.current_thread() is self.thread
+
+    def has_waiting(self, priority):
+        """True if a command more urgent than priority is queued (long commands yield to it)"""
+        with self.condition:
+            return bool(self.queue) and self.queue[0][0] < priority
+
+    def operation_running(self):
+        """True while an operation (exposure) is in flight; non-concurrent commands queue behind it"""
+        with self.condition:
+            return bool(self.operations)
+
+    def submit(self, fn, *args, priority=PRIORITY_CONTROL, concurrent=False, **kwargs):
+        """Queue fn(*args, **kwargs) for the camera thread and return its Future"""
+        return self._enqueue(CameraCommand(fn, args, kwargs, concurrent=concurrent), priority)
+
+    def submit_merged(self, key, fn, changes, priority=PRIORITY_CONTROL):
+        """Queue fn(changes), folding changes into a not-yet-started command with the same key.
+
+        Merged callers share one Future (and one result).
+        """
+        with self.condition:
+            pending = self.merging.get(key)
+            if pending is not None:
+                pending.args[0].update(changes)
+                return pending.future
+        return self._enqueue(CameraCommand(fn, (dict(changes),), {}, merge_key=key), priority)
+
+    def call(self, fn, *args, priority=PRIORITY_CONTROL, concurrent=False, **kwargs):
+        """Run fn on the camera thread and return its result (inline if already on it)"""
+        if self.on_camera_thread():
+            return finish_inline(fn(*args, **kwargs))
+        return self.submit(fn, *args, priority=priority, concurrent=concurrent, **kwargs).result()
+
+    def abort_operations(self, reason):
+        """Throw OperationAborted into every operation in flight (camera thread)"""
+        with self.condition:
+            operations, self.operations = self.operations, []
+        for _, _, steps, future in operations:
+            try:
+                steps.throw(OperationAborted(reason))
+                steps.close()  # Kept going after the abort: stop it at its next yield
+                future.set_exception(OperationAborted(reason))
+            except StopIteration as stop:
+                future.set_result(stop.value)
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _enqueue(self, command, priority):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='camera', daemon=True)
+                self.thread.start()
+            if command.merge_key is not None:
+                self.merging[command.merge_key] = command
+            heapq.heappush(self.queue, (priority, next(self.order), command))
+            self.condition.notify()
+        return command.future
+
+    def _next_command(self):
+        """Pop the next runnable command (condition held): any command when idle, else only concurrent ones"""
+        if not self.operations:
+            return heapq.heappop(self.queue)[2] if self.queue else None
+        for entry in sorted(self.queue):
+            if entry[2].concurrent:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                return entry[2]
+        return None
+
+    def _step(self, steps, future):
+        """Run an operation up to its next yield and schedule the following step"""
+        try:
+            delay = next(steps)
+        except StopIteration as stop:
+            future.set_result(stop.value)
+            return
+        except BaseException as e:
+            future.set_exception(e)
+            return
+        with self.condition:
+            heapq.heappush(self.operations, (time.monotonic() + delay, next(self.order), steps, future))
+
+    def _run(self):
+        while True:
+            operation = None
+            with self.condition:
+                command = self._next_command()
+                if command is not None and command.merge_key is not None:
+                    self.merging.pop(command.merge_key, None)
+                if command is None and self.operations and self.operations[0][0] <= time.monotonic():
+                    operation = heapq.heappop(self.operations)
+            if command is not None:
+                if command.future.set_running_or_notify_cancel():
+                    try:
+                        result = command.fn(*command.args, **command.kwargs)
+                    except BaseException as e:
+                        command.future.set_exception(e)
+                    else:
+                        if isinstance(result, types.GeneratorType):
+                            self._step(result, command.future)
+                        else:
+                            command.future.set_result(result)
+                continue
+            if operation is not None:
+                self._step(operation[2], operation[3])
+                continue
+            
+            with self.condition:
+                waiting_for = self.operations[0][0] - time.monotonic() if self.operations else None
+            if waiting_for is not None:
+                # An operation is in flight: no preview frames, just sleep until its next step or a new command
+                with self.condition:
+                    if not self.queue or not any(entry[2].concurrent for entry in self.queue):
+                        self.condition.wait(max(0.0, waiting_for))
+                continue
+            try:
+                busy = self.idle_task is not None and self.idle_task()
+            except Exception as e:
+                print(f"[CameraExecutor] Idle task failed: {e}")
+                busy = False
+            if not busy:
+                with self.condition:
+                    if not self.queue and not self.operations:
+                        self.condition.wait()
+
+def camera_command(priority=PRIORITY_CONTROL, concurrent=False):
+    """Run an ASICamera method on the camera thread (callers block on the result)"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            return camera_executor.call(method, self, *args, priority=priority, concurrent=concurrent, **kwargs)
+        return wrapper
+    return decorator
+
 class ASICamera:
     def __init__(self):
         self.camera_id = -1
         self.is_open = False
         self.streaming = False
-        self.frame_buffer = None
-        self.capture_thread = None
+        self.stream_paused = False  # Stream stopped by a sequence that will resume it (clients stay connected)
+        self.preview = None  # Per-session state for capture_preview_frame while streaming
         self.is_color_cam = False  # Store whether camera is color camera
+        self.supported_bins = [1]  # From ASI_CAMERA_INFO.SupportedBins
+        self.camera_name = None  # ASI_CAMERA_INFO.Name
+        self.bayer_pattern = None  # ASI_CAMERA_INFO.BayerPattern (ASI_BAYER_*), color cameras only
+        self.last_temperature = None  # Sensor temperature (C) from the most recent photo
+        self.control_caps = {}  # control type -> limits from ASIGetControlCaps (read once at connect)
+        # Shadow registers: last value written to / read from the camera, so unchanged writes are skipped
+        self.control_shadow = {}  # control type -> (value, auto)
+        self.roi_shadow = None  # (width, height, bin, img_format)
+        self.start_pos_shadow = None  # (start_x, start_y)
         
+    @camera_command()
     def connect(self):
         """Connect to the first available ASI camera"""
         if asi_lib is None:
@@ -184,27 +1819,6 @@ class ASICamera:
                 return False
             
             # Get camera info
-            class ASI_CAMERA_INFO(ctypes.Structure):
-                _fields_ = [
-                    ("Name", ctypes.c_char * 64),
-                    ("CameraID", ctypes.c_int),
-                    ("MaxHeight", ctypes.c_long),
-                    ("MaxWidth", ctypes.c_long),
-                    ("IsColorCam", ctypes.c_int),
-                    ("BayerPattern", ctypes.c_int),
-                    ("SupportedBins", ctypes.c_int * 16),
-                    ("SupportedVideoFormat", ctypes.c_int * 8),
-                    ("PixelSize", ctypes.c_double),
-                    ("MechanicalShutter", ctypes.c_int),
-                    ("ST4Port", ctypes.c_int),
-                    ("IsCoolerCam", ctypes.c_int),
-                    ("IsUSB3Host", ctypes.c_int),
-                    ("IsUSB3Camera", ctypes.c_int),
-                    ("ElecPerADU", ctypes.c_float),
-                    ("BitDepth", ctypes.c_int),
-                    ("IsTriggerCam", ctypes.c_int),
-                ]
-            
             camera_info = ASI_CAMERA_INFO()
             result = asi_lib.ASIGetCameraProperty(ctypes.byref(camera_info), 0)
             
@@ -214,13 +1828,24 @@ class ASICamera:
             
             self.camera_id = camera_info.CameraID
             self.is_color_cam = bool(camera_info.IsColorCam)  # Store color camera status
+            self.camera_name = camera_info.Name.decode('utf-8', 'replace')
+            self.bayer_pattern = camera_info.BayerPattern if camera_info.IsColorCam else None
             camera_state['camera_id'] = self.camera_id
+            camera_state['max_width'] = camera_info.MaxWidth
+            camera_state['max_height'] = camera_info.MaxHeight
+            # New connection starts with the full, unbinned frame for video
             camera_state['width'] = camera_info.MaxWidth
             camera_state['height'] = camera_info.MaxHeight
+            camera_state['bin'] = 1
+            camera_state['start_x'] = 0
+            camera_state['start_y'] = 0
+            # SupportedBins is a zero-terminated list
+            self.supported_bins = [b for b in camera_info.SupportedBins if b > 0] or [1]
             
             print(f"Camera: {camera_info.Name.decode('utf-8')}")
             print(f"Resolution: {camera_info.MaxWidth} x {camera_info.MaxHeight}")
             print(f"Color: {'Yes' if camera_info.IsColorCam else 'No'}")
+            print(f"Supported bins: {self.supported_bins}")
             
             # Open camera
             result = asi_lib.ASIOpenCamera(self.camera_id)
@@ -236,55 +1861,50 @@ class ASICamera:
                 return False
             
             self.is_open = True
+            self.invalidate_shadow()
+            self.load_control_caps()
+            self.read_controls()  # Fill the shadow registers, so GET /camera/controls never has to wait
             
             # Set ROI format (full frame, use current format setting)
-            result = asi_lib.ASISetROIFormat(
-                self.camera_id,
-                camera_info.MaxWidth,
-                camera_info.MaxHeight,
-                1,  # bin
-                camera_state['image_format']
-            )
+            result = self.set_photo_format(camera_state['image_format'])
             
             if result != ASI_SUCCESS:
                 print(f"Warning: Failed to set ROI format: {result}")
             
             # Disable auto gain and auto exposure first (they might lock the values)
-            asi_lib.ASISetControlValue(self.camera_id, ASI_GAIN, 0, ASI_TRUE)  # Turn OFF auto gain
-            asi_lib.ASISetControlValue(self.camera_id, ASI_EXPOSURE, 0, ASI_TRUE)  # Turn OFF auto exposure
-            time.sleep(0.1)
+            self.set_control(ASI_GAIN, 0, ASI_TRUE)  # Turn OFF auto gain
+            self.set_control(ASI_EXPOSURE, 0, ASI_TRUE)  # Turn OFF auto exposure
+            self.wait_for_idle()
             
             # Set bandwidth
-            asi_lib.ASISetControlValue(self.camera_id, ASI_BANDWIDTHOVERLOAD, 40, ASI_FALSE)
+            self.set_control(ASI_BANDWIDTHOVERLOAD, camera_state['bandwidth'], ASI_FALSE)
             
             # Set initial gain
-            result_gain = asi_lib.ASISetControlValue(self.camera_id, ASI_GAIN, camera_state['gain'], ASI_FALSE)
+            result_gain = self.set_control(ASI_GAIN, camera_state['gain'], ASI_FALSE)
             
             # Set initial gamma
-            result_gamma = asi_lib.ASISetControlValue(self.camera_id, ASI_GAMMA, camera_state['gamma'], ASI_FALSE)
+            result_gamma = self.set_control(ASI_GAMMA, camera_state['gamma'], ASI_FALSE)
             
             # Set initial white balance (only for color cameras)
             if camera_info.IsColorCam:
                 wb_auto = camera_state.get('wb_auto', False)
                 if wb_auto:
                     # Set auto white balance
-                    result_wb_r = asi_lib.ASISetControlValue(self.camera_id, ASI_WB_R, 0, ASI_TRUE)
-                    result_wb_b = asi_lib.ASISetControlValue(self.camera_id, ASI_WB_B, 0, ASI_TRUE)
+                    result_wb_r = self.set_control(ASI_WB_R, 0, ASI_TRUE)
+                    result_wb_b = self.set_control(ASI_WB_B, 0, ASI_TRUE)
                 else:
                     # Set manual white balance
-                    result_wb_r = asi_lib.ASISetControlValue(self.camera_id, ASI_WB_R, camera_state['wb_r'], ASI_FALSE)
-                    result_wb_b = asi_lib.ASISetControlValue(self.camera_id, ASI_WB_B, camera_state['wb_b'], ASI_FALSE)
+                    result_wb_r = self.set_control(ASI_WB_R, camera_state['wb_r'], ASI_FALSE)
+                    result_wb_b = self.set_control(ASI_WB_B, camera_state['wb_b'], ASI_FALSE)
             else:
                 result_wb_r = None
                 result_wb_b = None
             
-            # Verify settings
-            actual_gain = ctypes.c_long(0)
-            auto_gain = ctypes.c_int(0)
-            asi_lib.ASIGetControlValue(self.camera_id, ASI_GAIN, ctypes.byref(actual_gain), ctypes.byref(auto_gain))
+            # Verify settings (one read after connect - later reads come from the shadow registers)
+            actual_gain, auto_gain = self.get_control(ASI_GAIN, refresh=True)
             
             print(f"Initial settings:")
-            print(f"  Gain: {camera_state['gain']} → actual: {actual_gain.value} (result: {result_gain})")
+            print(f"  Gain: {camera_state['gain']} → actual: {actual_gain} (result: {result_gain})")
             print(f"  Gamma: {camera_state['gamma']} (result: {result_gamma})")
             print(f"  Exposure (for photo): {camera_state['exposure']} μs ({camera_state['exposure']/1000000:.3f} s)")
             if camera_info.IsColorCam:
@@ -304,15 +1924,19 @@ class ASICamera:
             print(f"Error connecting to camera: {e}")
             return False
     
+    @camera_command(concurrent=True)
     def disconnect(self):
-        """Disconnect from camera"""
+        """Disconnect from camera - an exposure in progress is aborted instead of waited for"""
+        camera_executor.abort_operations("camera disconnected")
         self.stop_stream()
         if self.is_open and self.camera_id >= 0:
             asi_lib.ASICloseCamera(self.camera_id)
             self.is_open = False
+        self.invalidate_shadow()
         camera_state['connected'] = False
         camera_state['streaming'] = False
     
+    @camera_command()
     def reset_camera(self):
         """Reset camera by closing and reopening - use when camera is stuck in FAILED state"""
         if not self.is_open or self.camera_id < 0:
@@ -320,8 +1944,6 @@ class ASICamera:
         
         print("[reset_camera] Attempting to reset camera...")
         camera_id = self.camera_id
-        width = camera_state['width']
-        height = camera_state['height']
         gain = camera_state['gain']
         exposure = camera_state['exposure']
         image_format = camera_state['image_format']
@@ -331,11 +1953,18 @@ class ASICamera:
             print("[reset_camera] Closing camera...")
             asi_lib.ASICloseCamera(camera_id)
             self.is_open = False
-            time.sleep(1.0)
+            self.invalidate_shadow()  # Re-init resets every register on the camera
             
-            # Reopen camera
+            # Reopen camera as soon as the SDK lets go of it
             print("[reset_camera] Reopening camera...")
-            result = asi_lib.ASIOpenCamera(camera_id)
+            deadline = time.monotonic() + IDLE_TIMEOUT
+            backoff = EXPOSURE_POLL_MIN
+            while True:
+                result = asi_lib.ASIOpenCamera(camera_id)
+                if result == ASI_SUCCESS or time.monotonic() >= deadline:
+                    break
+                time.sleep(backoff)
+                backoff = min(backoff * 2, EXPOSURE_POLL_MAX)
             if result != ASI_SUCCESS:
                 print(f"[reset_camera] Failed to reopen camera: {result}")
                 return False
@@ -351,23 +1980,19 @@ class ASICamera:
             
             # Restore settings
             print("[reset_camera] Restoring camera settings...")
-            asi_lib.ASISetROIFormat(camera_id, width, height, 1, image_format)
-            time.sleep(0.3)
-            asi_lib.ASISetControlValue(camera_id, ASI_GAIN, gain, ASI_FALSE)
-            asi_lib.ASISetControlValue(camera_id, ASI_EXPOSURE, exposure, ASI_FALSE)
-            asi_lib.ASISetControlValue(camera_id, ASI_BANDWIDTHOVERLOAD, 40, ASI_FALSE)
-            time.sleep(0.3)
+            self.set_photo_format(image_format)
+            self.set_control(ASI_GAIN, gain, ASI_FALSE)
+            self.set_control(ASI_EXPOSURE, exposure, ASI_FALSE)
+            self.set_control(ASI_BANDWIDTHOVERLOAD, camera_state['bandwidth'], ASI_FALSE)
             
             # Check status
-            status = ctypes.c_int(0)
-            asi_lib.ASIGetExpStatus(camera_id, ctypes.byref(status))
-            if status.value == 0:
+            status = self.wait_for_idle()
+            if status == ASI_EXP_IDLE:
                 print("[reset_camera] Camera successfully reset to IDLE state")
                 return True
             else:
-                status_names = {0: "ASI_EXP_IDLE", 1: "ASI_EXP_WORKING", 2: "ASI_EXP_SUCCESS", 3: "ASI_EXP_FAILED"}
-                status_name = status_names.get(status.value, f"UNKNOWN_{status.value}")
-                print(f"[reset_camera] Camera reset but still in state {status.value} ({status_name})")
+                status_name = EXP_STATUS_NAMES.get(status, f"UNKNOWN_{status}")
+                print(f"[reset_camera] Camera reset but still in state {status} ({status_name})")
                 return False
                 
         except Exception as e:
@@ -376,58 +2001,214 @@ class ASICamera:
             traceback.print_exc()
             return False
     
+    def invalidate_shadow(self):
+        """Forget cached register values (camera closed, re-initialised or in an unknown state)"""
+        self.control_shadow = {}
+        self.roi_shadow = None
+        self.start_pos_shadow = None
+    
+    def load_control_caps(self):
+        """Read min/max/default/auto/writable for every control once (ASIGetControlCaps)"""
+        self.control_caps = {}
+        count = ctypes.c_int(0)
+        if asi_lib.ASIGetNumOfControls(self.camera_id, ctypes.byref(count)) != ASI_SUCCESS:
+            print("[load_control_caps] ASIGetNumOfControls failed, control limits unknown")
+            return
+        caps = ASI_CONTROL_CAPS()
+        for index in range(count.value):
+            if asi_lib.ASIGetControlCaps(self.camera_id, index, ctypes.byref(caps)) != ASI_SUCCESS:
+                continue
+            self.control_caps[caps.ControlType] = {
+                'name': caps.Name.decode('utf-8', 'replace'),
+                'description': caps.Description.decode('utf-8', 'replace'),
+                'min': caps.MinValue,
+                'max': caps.MaxValue,
+                'default': caps.DefaultValue,
+                'auto_supported': bool(caps.IsAutoSupported),
+                'writable': bool(caps.IsWritable),
+            }
+        print(f"[load_control_caps] {len(self.control_caps)} controls: "
+              f"{', '.join(c['name'] for c in self.control_caps.values())}")
+    
+    def validate_control(self, control, value):
+        """Check a requested value against the camera's caps; raises ValueError if out of range"""
+        caps = self.control_caps.get(control)
+        if caps is None:
+            return int(value)
+        value = int(value)
+        if not caps['writable']:
+            raise ValueError(f"{caps['name']} is read-only on this camera")
+        if not caps['min'] <= value <= caps['max']:
+            raise ValueError(f"{caps['name']} must be between {caps['min']} and {caps['max']}")
+        return value
+    
+    @camera_command()
+    def set_control(self, control, value, auto=ASI_FALSE):
+        """ASISetControlValue through the shadow register - skipped if the camera already has this value"""
+        caps = self.control_caps.get(control)
+        if caps is not None:
+            if not caps['writable']:
+                return ASI_ERROR_GENERAL_ERROR
+            if not caps['auto_supported']:
+                auto = ASI_FALSE
+            if not auto:
+                value = max(caps['min'], min(caps['max'], int(value)))
+        elif self.control_caps:
+            return ASI_ERROR_INVALID_CONTROL_TYPE  # Caps loaded and this control does not exist
+        entry = (int(value), int(auto))
+        if self.control_shadow.get(control) == entry:
+            return ASI_SUCCESS
+        result = asi_lib.ASISetControlValue(self.camera_id, control, entry[0], entry[1])
+        if result == ASI_SUCCESS:
+            self.control_shadow[control] = entry
+        else:
+            self.control_shadow.pop(control, None)
+        return result
+    
+    @camera_command()
+    def get_control(self, control, refresh=False):
+        """(value, auto) from the shadow register; read-only and auto controls are always read from the camera"""
+        entry = self.control_shadow.get(control)
+        caps = self.control_caps.get(control)
+        volatile = caps is not None and not caps['writable']
+        if entry is None or refresh or volatile or entry[1]:
+            value = ctypes.c_long(0)
+            auto = ctypes.c_int(0)
+            if asi_lib.ASIGetControlValue(self.camera_id, control, ctypes.byref(value), ctypes.byref(auto)) != ASI_SUCCESS:
+                return None, None
+            entry = (value.value, auto.value)
+            self.control_shadow[control] = entry  # Read-only/auto values are kept only as the latest reading
+        return entry
+    
+    @camera_command(concurrent=True)
+    def read_controls(self):
+        """{control: (value, auto)} for every control: shadow registers, re-reading only read-only and auto controls.
+
+        Concurrent: ASIGetControlValue is safe while an exposure runs, so this never waits for one.
+        """
+        return {control: self.get_control(control) for control in self.control_caps}
+    
+    def set_roi_format(self, width, height, bin_value, img_format):
+        """ASISetROIFormat through the shadow register"""
+        roi = (int(width), int(height), int(bin_value), int(img_format))
+        if self.roi_shadow == roi:
+            return ASI_SUCCESS
+        result = asi_lib.ASISetROIFormat(self.camera_id, *roi)
+        # The SDK re-centres the start position on every ROI change
+        self.start_pos_shadow = None
+        self.roi_shadow = roi if result == ASI_SUCCESS else None
+        return result
+    
+    def set_start_pos(self, start_x, start_y):
+        """ASISetStartPos through the shadow register"""
+        position = (int(start_x), int(start_y))
+        if self.start_pos_shadow == position:
+            return ASI_SUCCESS
+        result = asi_lib.ASISetStartPos(self.camera_id, *position)
+        self.start_pos_shadow = position if result == ASI_SUCCESS else None
+        return result
+    
+    @camera_command()
+    def set_photo_format(self, img_format):
+        """Full-frame, unbinned ROI for photo capture"""
+        return self.set_roi_format(
+            camera_state['max_width'],
+            camera_state['max_height'],
+            1,  # bin
+            img_format
+        )
+    
+    @camera_command()
+    def set_video_roi(self):
+        """Apply the active video ROI (binning + sub-frame) in RGB24"""
+        result = self.set_roi_format(
+            camera_state['width'],
+            camera_state['height'],
+            camera_state['bin'],
+            ASI_IMG_RGB24
+        )
+        if result != ASI_SUCCESS:
+            print(f"[set_video_roi] ASISetROIFormat failed: {result}")
+            return result
+        result = self.set_start_pos(camera_state['start_x'], camera_state['start_y'])
+        if result != ASI_SUCCESS:
+            print(f"[set_video_roi] ASISetStartPos failed: {result}")
+        return result
+    
+    def normalize_roi(self, bin_value, width=None, height=None, start_x=None, start_y=None):
+        """Validate a requested video ROI and return it with SDK alignment applied.
+
+        Sizes and start positions are in binned pixels. Width is rounded down to a
+        multiple of 8 and height to a multiple of 2 (SDK requirement); a missing
+        start position centres the window. Raises ValueError on invalid input.
+        """
+        bin_value = int(bin_value)
+        if bin_value not in self.supported_bins:
+            raise ValueError(f"Unsupported bin {bin_value}, camera supports {self.supported_bins}")
+        full_width = camera_state['max_width'] // bin_value
+        full_height = camera_state['max_height'] // bin_value
+        width = full_width if width is None else int(width)
+        height = full_height if height is None else int(height)
+        width -= width % 8
+        height -= height % 2
+        if width <= 0 or height <= 0 or width > full_width or height > full_height:
+            raise ValueError(f"ROI size must be within {full_width}x{full_height} at bin {bin_value}")
+        start_x = (full_width - width) // 2 if start_x is None else int(start_x)
+        start_y = (full_height - height) // 2 if start_y is None else int(start_y)
+        if start_x < 0 or start_y < 0 or start_x + width > full_width or start_y + height > full_height:
+            raise ValueError(f"ROI start position ({start_x}, {start_y}) puts the window outside the sensor")
+        return {'bin': bin_value, 'width': width, 'height': height, 'start_x': start_x, 'start_y': start_y}
+    
+    @camera_command()
     def start_stream(self):
         """Start video streaming"""
         if not self.is_open:
             return False
         
+        # Video always runs in RGB24 at the active ROI (photos may have left a different format)
+        self.set_video_roi()
+        
         # Enable auto exposure for video mode, but limit max exposure time
         # This allows the camera to adjust exposure automatically while respecting the max limit
         video_exposure = camera_state['video_exposure']  # microseconds
         gain = camera_state['gain']
         
         # Set gain first (must be set before starting video capture)
-        result_gain = asi_lib.ASISetControlValue(self.camera_id, ASI_GAIN, gain, ASI_FALSE)
+        # All writes go through the shadow registers - unchanged values cost no USB round trip
+        result_gain = self.set_control(ASI_GAIN, gain, ASI_FALSE)
         
         # Set gamma
         gamma = camera_state.get('gamma', 50)
-        result_gamma = asi_lib.ASISetControlValue(self.camera_id, ASI_GAMMA, gamma, ASI_FALSE)
+        result_gamma = self.set_control(ASI_GAMMA, gamma, ASI_FALSE)
         
         # Set white balance (only for color cameras)
         if self.is_color_cam:
             wb_auto = camera_state.get('wb_auto', False)
             if wb_auto:
                 # Set auto white balance
-                result_wb_r = asi_lib.ASISetControlValue(self.camera_id, ASI_WB_R, 0, ASI_TRUE)
-                result_wb_b = asi_lib.ASISetControlValue(self.camera_id, ASI_WB_B, 0, ASI_TRUE)
+                result_wb_r = self.set_control(ASI_WB_R, 0, ASI_TRUE)
+                result_wb_b = self.set_control(ASI_WB_B, 0, ASI_TRUE)
             else:
                 # Set manual white balance
                 wb_r = camera_state.get('wb_r', 50)
                 wb_b = camera_state.get('wb_b', 50)
-                result_wb_r = asi_lib.ASISetControlValue(self.camera_id, ASI_WB_R, wb_r, ASI_FALSE)
-                result_wb_b = asi_lib.ASISetControlValue(self.camera_id, ASI_WB_B, wb_b, ASI_FALSE)
+                result_wb_r = self.set_control(ASI_WB_R, wb_r, ASI_FALSE)
+                result_wb_b = self.set_control(ASI_WB_B, wb_b, ASI_FALSE)
         else:
             result_wb_r = None
             result_wb_b = None
         
         # Set manual exposure for video mode (we're in manual mode, so ASI_AUTO_MAX_EXP is not needed)
-        result_manual = asi_lib.ASISetControlValue(self.camera_id, ASI_EXPOSURE, video_exposure, ASI_FALSE)
+        result_manual = self.set_control(ASI_EXPOSURE, video_exposure, ASI_FALSE)
         
         # Try auto exposure for video mode (may not work well with gain on Linux)
         # Commented out for now - using manual exposure instead
-        # result_auto = asi_lib.ASISetControlValue(self.camera_id, ASI_EXPOSURE, 0, ASI_TRUE)
-        
-        # Verify gain was set
-        actual_gain = ctypes.c_long(0)
-        auto_gain = ctypes.c_int(0)
-        asi_lib.ASIGetControlValue(self.camera_id, ASI_GAIN, ctypes.byref(actual_gain), ctypes.byref(auto_gain))
+        # result_auto = self.set_control(ASI_EXPOSURE, 0, ASI_TRUE)
         
-        # Verify exposure was set
-        actual_exp = ctypes.c_long(0)
-        auto_exp = ctypes.c_int(0)
-        asi_lib.ASIGetControlValue(self.camera_id, ASI_EXPOSURE, ctypes.byref(actual_exp), ctypes.byref(auto_exp))
+        actual_gain, auto_gain = self.get_control(ASI_GAIN)
+        actual_exp, auto_exp = self.get_control(ASI_EXPOSURE)
         
-        print(f"[start_stream] Set gain to {gain} (result: {result_gain}, actual: {actual_gain.value})")
+        print(f"[start_stream] Set gain to {gain} (result: {result_gain}, actual: {actual_gain})")
         print(f"[start_stream] Set gamma to {gamma} (result: {result_gamma})")
         if self.is_color_cam:
             wb_auto = camera_state.get('wb_auto', False)
@@ -438,7 +2219,7 @@ class ASICamera:
                 wb_b = camera_state.get('wb_b', 50)
                 print(f"[start_stream] Set manual white balance R: {wb_r} (result: {result_wb_r}), B: {wb_b} (result: {result_wb_b})")
         print(f"[start_stream] Set video exposure to {video_exposure} μs ({video_exposure/1000:.1f} ms)")
-        print(f"[start_stream] Manual exposure result: {result_manual}, actual: {actual_exp.value} μs, auto: {auto_exp.value}")
+        print(f"[start_stream] Manual exposure result: {result_manual}, actual: {actual_exp} μs, auto: {auto_exp}")
         
         print(f"[start_stream] Starting video capture")
         
@@ -447,22 +2228,40 @@ class ASICamera:
             camera_state['error'] = f"Failed to start video capture: {result}"
             return False
         
+        width = camera_state['width']
+        height = camera_state['height']
+        frame_pool.discard_idle(keep_key=(width, height, ASI_IMG_RGB24))
+        self.preview = {
+            'width': width,
+            'height': height,
+            'consecutive_errors': 0,
+            'fps_meter': RateMeter(metric_capture_fps.labels()),
+            'video_data_seconds': metric_video_data_seconds.labels(),
+            'convert_seconds': metric_frame_convert_seconds.labels('stream'),
+            'dropped': ctypes.c_int(0)
+        }
+        drop_tracker.start_session()
         self.streaming = True
+        self.stream_paused = False
         camera_state['streaming'] = True
-        
-        # Start capture thread
-        self.capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
-        self.capture_thread.start()
-        
+        broadcaster.open()
+        # Frames are now captured by the camera thread whenever no command is queued
         return True
     
-    def stop_stream(self):
-        """Stop video streaming - simplified like asicap, just call SDK"""
+    @camera_command()
+    def stop_stream(self, pause=False):
+        """Stop video streaming - simplified like asicap, just call SDK
+
+        pause=True is used between sequence frames: MJPEG clients stay connected
+        (showing the last frame) until the stream is started again.
+        """
+        was_streaming = self.streaming
         self.streaming = False
+        self.stream_paused = pause and (was_streaming or self.stream_paused)
+        self.preview = None
         camera_state['streaming'] = False
-        
-        if self.capture_thread:
-            self.capture_thread.join(timeout=2.0)
+        if not self.stream_paused:
+            broadcaster.close()  # Release MJPEG clients blocked waiting for a frame
         
         if self.is_open and self.camera_id >= 0:
             print("[stop_stream] Stopping video capture...")
@@ -472,52 +2271,247 @@ class ASICamera:
             else:
                 print("[stop_stream] Video capture stopped successfully")
     
-    def _capture_loop(self):
-        """Continuous capture loop for streaming"""
-        width = camera_state['width']
-        height = camera_state['height']
-        buffer_size = width * height * 3  # RGB24
-        buffer = (ctypes.c_ubyte * buffer_size)()
-        consecutive_errors = 0
-        
-        while self.streaming and self.is_open:
-            # Calculate timeout based on video exposure time
-            # SDK recommends: exposure*2+500ms
-            video_exposure_ms = camera_state['video_exposure'] / 1000.0  # Convert to ms
-            timeout_ms = int(video_exposure_ms * 2 + 500)
-            timeout_ms = max(100, min(timeout_ms, 5000))  # Clamp between 100ms and 5s (was 1s minimum)
+    def calibrate_preview(self, slot):
+        """Calibrate a stream frame in place (masters captured with target=stream; ROIs use their window of the master)"""
+        started = time.perf_counter()
+        frame = slot.array()
+        if calibration.apply(frame, camera_state['video_exposure'], camera_state['gain'], camera_state['bin'],
+                             ASI_IMG_RGB24, self.last_temperature, out=frame,
+                             crop=(camera_state['start_y'], camera_state['start_x'])) is not None:
+            metric_calibration_seconds.labels('stream').observe(time.perf_counter() - started)
+    
+    def capture_preview_frame(self):
+        """Capture one stream frame - the camera thread's idle task.
+
+        Returns False when not streaming so the camera thread can sleep.
+        """
+        preview = self.preview
+        if not self.streaming or not self.is_open or preview is None:
+            return False
+        
+        # Fill a free ring slot - never one that a stream client is still encoding
+        slot = frame_pool.acquire(preview['width'], preview['height'], ASI_IMG_RGB24)
+        if slot is None:
+            time.sleep(0.001)
+            return True
+        buffer = slot.buffer
+        buffer_size = slot.size
+        
+        # Calculate timeout based on video exposure time
+        # SDK recommends: exposure*2+500ms
+        video_exposure_ms = camera_state['video_exposure'] / 1000.0  # Convert to ms
+        timeout_ms = int(video_exposure_ms * 2 + 500)
+        timeout_ms = max(100, min(timeout_ms, 5000))  # Clamp between 100ms and 5s (was 1s minimum)
+        
+        started = time.perf_counter()
+        result = asi_lib.ASIGetVideoData(
+            self.camera_id,
+            ctypes.byref(buffer),
+            buffer_size,
+            timeout_ms
+        )
+        preview['video_data_seconds'].observe(time.perf_counter() - started)
+        metric_video_data_results.labels(result).inc()
+        
+        if result == ASI_SUCCESS:
+            preview['consecutive_errors'] = 0  # Reset error counter
+            # Refill the slot's persistent PIL image in place (no per-frame allocation)
+            slot.timestamp = time.time()
+            if camera_state['calibrate_stream']:
+                self.calibrate_preview(slot)
+            started = time.perf_counter()
+            slot.to_image()
+            preview['convert_seconds'].observe(time.perf_counter() - started)
+            camera_state['current_frame'] = slot.timestamp
+            broadcaster.publish(slot)  # Broadcaster now owns our reference
+            metric_frames_captured.inc()
+            preview['fps_meter'].tick()
+            drop_tracker.record_frame()
+        else:
+            slot.release()
+            if result == ASI_ERROR_TIMEOUT:
+                metric_video_timeouts.inc()
+        
+        # SDK-side drops (cumulative for this video session)
+        dropped = preview['dropped']
+        if asi_lib.ASIGetDroppedFrames(self.camera_id, ctypes.byref(dropped)) == ASI_SUCCESS:
+            drop_tracker.record_sdk_count(dropped.value)
+        if result != ASI_SUCCESS and result != ASI_ERROR_TIMEOUT:  # Timeout is normal
+            preview['consecutive_errors'] += 1
+            consecutive_errors = preview['consecutive_errors']
+            # Only print error if it persists
+            if consecutive_errors == 1 or consecutive_errors % 10 == 0:
+                print(f"Error getting video data: {result} (consecutive: {consecutive_errors})")
+        return True
+    
+    def wait_for_idle(self, timeout=IDLE_TIMEOUT):
+        """Wait until no exposure is running and return the ASI_EXP_* status.
+
+        Used after mode transitions instead of fixed delays: polls ASIGetExpStatus
+        with exponential backoff and stops the exposure if the camera is still
+        busy after `timeout` seconds.
+        """
+        status = ctypes.c_int(ASI_EXP_WORKING)
+        deadline = time.monotonic() + timeout
+        backoff = EXPOSURE_POLL_MIN
+        while True:
+            asi_lib.ASIGetExpStatus(self.camera_id, ctypes.byref(status))
+            if status.value != ASI_EXP_WORKING:
+                return status.value
+            if time.monotonic() >= deadline:
+                print(f"[wait_for_idle] Camera still busy after {timeout}s, stopping exposure")
+                asi_lib.ASIStopExposure(self.camera_id)
+                asi_lib.ASIGetExpStatus(self.camera_id, ctypes.byref(status))
+                return status.value
+            time.sleep(backoff)
+            backoff = min(backoff * 2, EXPOSURE_POLL_MAX)
+    
+    def wait_for_exposure(self, exposure_us, started):
+        """Operation steps waiting for the exposure started at `started` (time.monotonic); returns its final ASI_EXP_* status.
+
+        Yields until the exposure should be done - checking once per second on long
+        exposures so a failure is noticed early - then polls ASIGetExpStatus with
+        exponential backoff (1 ms doubling to 50 ms) until readout completes. The
+        camera thread runs other concurrent commands between the steps.
+        """
+        status = ctypes.c_int(ASI_EXP_WORKING)
+        expected_end = started + exposure_us / 1e6
+        deadline = expected_end + EXPOSURE_TIMEOUT_MARGIN
+        poll_seconds = metric_exp_status_poll_seconds.labels()
+        polls = metric_exp_status_polls.labels()
+        wait_started = time.perf_counter()
+        try:
+            while True:
+                remaining = expected_end - time.monotonic()
+                if remaining <= 0:
+                    break
+                yield min(remaining, EXPOSURE_CHECK_INTERVAL)
+                if remaining > EXPOSURE_CHECK_INTERVAL:
+                    asi_lib.ASIGetExpStatus(self.camera_id, ctypes.byref(status))
+                    polls.inc()
+                    if status.value == ASI_EXP_FAILED:
+                        return status.value
             
-            drop_frames = ctypes.c_int(0)
-            result = asi_lib.ASIGetVideoData(
-                self.camera_id,
-                ctypes.byref(buffer),
-                buffer_size,
-                timeout_ms,
-                ctypes.byref(drop_frames)
-            )
+            backoff = EXPOSURE_POLL_MIN
+            while True:
+                asi_lib.ASIGetExpStatus(self.camera_id, ctypes.byref(status))
+                polls.inc()
+                if status.value != ASI_EXP_WORKING or time.monotonic() >= deadline:
+                    return status.value
+                yield backoff
+                backoff = min(backoff * 2, EXPOSURE_POLL_MAX)
+        finally:
+            poll_seconds.observe(time.perf_counter() - wait_started)
+    
+    @camera_command(PRIORITY_SEQUENCE)
+    def capture_burst(self, count, on_frame, should_continue, resume_stream=True):
+        """Capture up to count full frames back to back in video mode at the photo settings.
+
+        Runs ASIStartVideoCapture at the photo exposure, gain and format and reads
+        frames with ASIGetVideoData into pooled buffers; on_frame(img) gets each
+        frame as a PIL image. It runs between reads on the camera thread, so it
+        must only hand the frame off (see burst_capture). Stops early when should_continue() is False or a
+        more urgent command (snapshot, settings) is waiting, so callers loop
+        until done. With resume_stream=False a running stream stays paused.
+        Returns (frames captured, frames dropped by the SDK).
+        """
+        if not self.is_open:
+            return 0, 0
+        
+        was_streaming = self.streaming or self.stream_paused
+        if self.streaming:
+            self.stop_stream(pause=not resume_stream)
+        
+        width = camera_state['max_width']
+        height = camera_state['max_height']
+        img_format = camera_state['image_format']
+        exposure = camera_state['exposure']
+        gain = camera_state['gain']
+        gamma = camera_state['gamma']
+        captured = 0
+        dropped = ctypes.c_int(0)
+        
+        try:
+            result = self.set_photo_format(img_format)
+            if result != ASI_SUCCESS:
+                print(f"[capture_burst] ASISetROIFormat failed: {result}")
+                return 0, 0
+            self.set_control(ASI_EXPOSURE, exposure, ASI_FALSE)
+            self.set_control(ASI_GAIN, gain, ASI_FALSE)
             
-            if result == ASI_SUCCESS:
-                consecutive_errors = 0  # Reset error counter
-                # Convert to numpy array
-                img_array = np.frombuffer(buffer, dtype=np.uint8)
-                img_array = img_array.reshape((height, width, 3))
-                
-                # Convert to PIL Image
-                img = Image.fromarray(img_array, mode='RGB')
-                self.frame_buffer = img
-                camera_state['current_frame'] = img
-            elif result != 2:  # 2 = timeout, which is normal
-                consecutive_errors += 1
-                # Only print error if it persists
-                if consecutive_errors == 1 or consecutive_errors % 10 == 0:
-                    print(f"Error getting video data: {result} (consecutive: {consecutive_errors})")
+            result = asi_lib.ASIStartVideoCapture(self.camera_id)
+            if result != ASI_SUCCESS:
+                print(f"[capture_burst] ASIStartVideoCapture failed: {result}")
+                return 0, 0
             
-            # Minimal sleep - let camera exposure time control the actual frame rate
-            # If exposure is short, we'll get frames faster; if long, we'll wait longer
-            time.sleep(0.001)  # 1ms sleep - much shorter to allow FPS to vary with exposure
+            # SDK recommends exposure*2+500ms
+            timeout_ms = int(exposure / 1000.0 * 2 + 500)
+            consecutive_errors = 0
+            temperature = self.read_temperature()
+            try:
+                while captured < count and should_continue() and not camera_executor.has_waiting(PRIORITY_SEQUENCE):
+                    slot = frame_pool.acquire(width, height, img_format)
+                    if slot is None:
+                        time.sleep(0.001)
+                        continue
+                    try:
+                        started = time.perf_counter()
+                        result = asi_lib.ASIGetVideoData(self.camera_id, ctypes.byref(slot.buffer), slot.size, timeout_ms)
+                        metric_video_data_seconds.labels().observe(time.perf_counter() - started)
+                        arrived = time.time()  # The frame's exposure ended just before it was delivered
+                        if result != ASI_SUCCESS:
+                            consecutive_errors += 1
+                            print(f"[capture_burst] ASIGetVideoData returned {result} (consecutive: {consecutive_errors})")
+                            if consecutive_errors >= 10:
+                                break
+                            continue
+                        consecutive_errors = 0
+                        started = time.perf_counter()
+                        img = frame_to_image(slot.buffer, width, height, img_format, self.bayer_pattern)
+                        metric_frame_convert_seconds.labels('burst').observe(time.perf_counter() - started)
+                        img.exposure_us = exposure
+                        img.exposure_start = arrived - exposure / 1e6
+                        img.gain = gain
+                        img.gamma = gamma
+                        img.img_format = img_format
+                        img.temperature = temperature
+                    finally:
+                        slot.release()
+                    captured += 1
+                    on_frame(img)
+            finally:
+                asi_lib.ASIGetDroppedFrames(self.camera_id, ctypes.byref(dropped))
+                asi_lib.ASIStopVideoCapture(self.camera_id)
+        finally:
+            # start_stream puts the video exposure and ROI back (via the shadow registers)
+            if was_streaming and resume_stream:
+                self.start_stream()
+        
+        return captured, dropped.value
     
-    def capture_snapshot(self):
-        """Capture a single snapshot"""
+    def read_temperature(self):
+        """Sensor temperature in C (also kept in last_temperature), or None"""
+        value, _ = self.get_control(ASI_TEMPERATURE)
+        if value is None:
+            return None
+        self.last_temperature = value / 10.0
+        return self.last_temperature
+    
+    @camera_command(PRIORITY_SNAPSHOT)
+    def capture_snapshot(self, on_exposure_start=None, dark=False, target='photo'):
+        """Capture a single snapshot (the image, or None) - see exposure_steps"""
+        return self.exposure_steps(on_exposure_start, dark, target)
+    
+    def exposure_steps(self, on_exposure_start=None, dark=False, target='photo'):
+        """Operation steps for one snapshot: start the exposure, poll until it is read out, return the image or None.
+
+        on_exposure_start(started, exposure_us) is called once the exposure is running
+        (started is time.monotonic()), so callers can report progress. dark=True
+        asks the SDK for a dark frame (closes the shutter on cameras that have one).
+        target picks the frame size, format and exposure (see capture_settings); the
+        ROI must already be set for it. An OperationAborted thrown in while waiting
+        stops the exposure.
+        """
         if not self.is_open:
             print("[capture_snapshot] Camera not open")
             return None
@@ -526,150 +2520,1207 @@ class ASICamera:
         if self.streaming:
             print("[capture_snapshot] Warning: Camera is streaming, stopping...")
             self.stop_stream()
-            time.sleep(0.5)
-        
-        # Simplified approach like asicap: just stop video if needed, then start exposure
-        # Don't wait for IDLE state - let SDK handle it
-        
-        # If streaming, stop it first
-        if self.streaming:
-            print("[capture_snapshot] Stopping stream before snapshot...")
-            self.stop_stream()
-            time.sleep(0.1)  # Brief pause for SDK to process
         
         # Set exposure and gain (disable auto for photo mode)
-        exposure = camera_state['exposure']
+        settings = capture_settings(target)
+        exposure = settings.exposure
         gain_val = camera_state['gain']
         
         # Disable auto exposure and set manual values
-        asi_lib.ASISetControlValue(self.camera_id, ASI_EXPOSURE, exposure, ASI_FALSE)
-        asi_lib.ASISetControlValue(self.camera_id, ASI_GAIN, gain_val, ASI_FALSE)
+        self.set_control(ASI_EXPOSURE, exposure, ASI_FALSE)
+        self.set_control(ASI_GAIN, gain_val, ASI_FALSE)
         
         print(f"[capture_snapshot] Starting exposure: {exposure} μs, gain: {gain_val}")
         
-        # Start exposure - SDK will return error if video mode is still active
-        result = asi_lib.ASIStartExposure(self.camera_id, 0)  # 0 = not dark frame
+        # Start exposure - the camera thread already stopped video, so no retry is needed
+        result = asi_lib.ASIStartExposure(self.camera_id, ASI_TRUE if dark else ASI_FALSE)
         
         if result != ASI_SUCCESS:
             error_names = {
-                14: "ASI_ERROR_VIDEO_MODE_ACTIVE",
-                15: "ASI_ERROR_EXPOSURE_IN_PROGRESS",
+                ASI_ERROR_VIDEO_MODE_ACTIVE: "ASI_ERROR_VIDEO_MODE_ACTIVE",
+                ASI_ERROR_EXPOSURE_IN_PROGRESS: "ASI_ERROR_EXPOSURE_IN_PROGRESS",
             }
             error_name = error_names.get(result, f"ERROR_{result}")
             print(f"[capture_snapshot] Failed to start exposure: {result} ({error_name})")
-            # If video mode is still active, try stopping again
-            if result == 14:  # ASI_ERROR_VIDEO_MODE_ACTIVE
-                print("[capture_snapshot] Video mode still active, stopping again...")
-                asi_lib.ASIStopVideoCapture(self.camera_id)
-                time.sleep(0.2)
-                result = asi_lib.ASIStartExposure(self.camera_id, 0)
-                if result != ASI_SUCCESS:
-                    print(f"[capture_snapshot] Still failed after retry: {result}")
-                    return None
-            else:
-                return None
-        
-        # Wait for exposure to complete
-        status = ctypes.c_int(0)
-        timeout = 0
-        max_timeout = (exposure // 1000) + 5000  # ms
+            return None
+        started = time.monotonic()
+        exposure_start = time.time()
+        if on_exposure_start is not None:
+            on_exposure_start(started, exposure)
         
-        while timeout < max_timeout:
-            asi_lib.ASIGetExpStatus(self.camera_id, ctypes.byref(status))
-            if status.value == 2:  # ASI_EXP_SUCCESS
-                break
-            if status.value == 3:  # ASI_EXP_FAILED - don't wait, fail immediately
-                status_name = status_names.get(status.value, f"UNKNOWN_{status.value}")
-                print(f"[capture_snapshot] Exposure failed with status: {status.value} ({status_name}) at timeout: {timeout}ms")
-                return None
-            time.sleep(0.1)
-            timeout += 100
+        # Wait for exposure to complete - other concurrent commands run in the meantime
+        try:
+            status = yield from self.wait_for_exposure(exposure, started)
+        except OperationAborted as e:
+            print(f"[capture_snapshot] Exposure aborted: {e}")
+            asi_lib.ASIStopExposure(self.camera_id)
+            raise
+        elapsed_ms = (time.monotonic() - started) * 1000
         
-        if status.value != 2:
-            status_name = status_names.get(status.value, f"UNKNOWN_{status.value}")
-            print(f"[capture_snapshot] Exposure failed with status: {status.value} ({status_name}) after {timeout}ms")
+        if status != ASI_EXP_SUCCESS:
+            status_name = EXP_STATUS_NAMES.get(status, f"UNKNOWN_{status}")
+            print(f"[capture_snapshot] Exposure failed with status: {status} ({status_name}) after {elapsed_ms:.0f}ms")
             return None
         
-        # Get image data based on format
-        width = camera_state['width']
-        height = camera_state['height']
-        img_format = camera_state['image_format']
+        # Get image data based on format - photos always use the full, unbinned frame
+        width = settings.width
+        height = settings.height
+        img_format = settings.img_format
         
-        # Calculate buffer size based on format
-        if img_format == ASI_IMG_RGB24:
-            buffer_size = width * height * 3
-            buffer = (ctypes.c_ubyte * buffer_size)()
-        elif img_format == ASI_IMG_RAW8 or img_format == ASI_IMG_Y8:
-            buffer_size = width * height
-            buffer = (ctypes.c_ubyte * buffer_size)()
-        elif img_format == ASI_IMG_RAW16:
-            buffer_size = width * height * 2
-            buffer = (ctypes.c_ubyte * buffer_size)()  # Use byte buffer, will convert to uint16 later
-        else:
+        if img_format not in (ASI_IMG_RGB24, ASI_IMG_RAW8, ASI_IMG_Y8, ASI_IMG_RAW16):
             print(f"[capture_snapshot] Unsupported image format: {img_format}")
             return None
-
-        result = asi_lib.ASIGetDataAfterExp(self.camera_id, ctypes.byref(buffer), buffer_size)
         
-        if result != ASI_SUCCESS:
-            error_names = {
-                1: "ASI_ERROR_INVALID_INDEX",
-                2: "ASI_ERROR_INVALID_ID", 
-                3: "ASI_ERROR_INVALID_CONTROL_TYPE",
-                4: "ASI_ERROR_CAMERA_CLOSED",
-                5: "ASI_ERROR_CAMERA_REMOVED",
-                11: "ASI_ERROR_TIMEOUT",
-                13: "ASI_ERROR_BUFFER_TOO_SMALL",
-                16: "ASI_ERROR_GENERAL_ERROR"
+        # Reuse a pooled buffer instead of allocating (and zeroing) a full frame every call
+        slot = frame_pool.acquire(width, height, img_format)
+        if slot is None:
+            print(f"[capture_snapshot] No free frame buffer for {width}x{height} format {img_format}")
+            return None
+        
+        try:
+            buffer = slot.buffer
+            buffer_size = slot.size
+            result = asi_lib.ASIGetDataAfterExp(self.camera_id, ctypes.byref(buffer), buffer_size)
+        
+            if result != ASI_SUCCESS:
+                error_names = {
+                    1: "ASI_ERROR_INVALID_INDEX",
+                    2: "ASI_ERROR_INVALID_ID", 
+                    3: "ASI_ERROR_INVALID_CONTROL_TYPE",
+                    4: "ASI_ERROR_CAMERA_CLOSED",
+                    5: "ASI_ERROR_CAMERA_REMOVED",
+                    11: "ASI_ERROR_TIMEOUT",
+                    13: "ASI_ERROR_BUFFER_TOO_SMALL",
+                    16: "ASI_ERROR_GENERAL_ERROR"
+                }
+                error_name = error_names.get(result, f"UNKNOWN_ERROR_{result}")
+                print(f"[capture_snapshot] Failed to get image data: {result} ({error_name})")
+                print(f"[capture_snapshot] Buffer size requested: {buffer_size}, format: {img_format}, width: {width}, height: {height}")
+                # Check exposure status
+                status_check = ctypes.c_int(0)
+                asi_lib.ASIGetExpStatus(self.camera_id, ctypes.byref(status_check))
+                status_names = {0: "ASI_EXP_IDLE", 1: "ASI_EXP_WORKING", 2: "ASI_EXP_SUCCESS", 3: "ASI_EXP_FAILED"}
+                status_name = status_names.get(status_check.value, f"UNKNOWN_{status_check.value}")
+                print(f"[capture_snapshot] Exposure status when getting data: {status_check.value} ({status_name})")
+                return None
+
+            # Convert to PIL Image based on format
+            convert_started = time.perf_counter()
+            img = frame_to_image(buffer, width, height, img_format, self.bayer_pattern)
+            metric_frame_convert_seconds.labels('snapshot').observe(time.perf_counter() - convert_started)
+            # Settings the frame was taken with, for calibration master lookup and FITS headers
+            img.exposure_us = exposure
+            img.exposure_start = exposure_start
+            img.gain = gain_val
+            img.gamma = camera_state['gamma']
+            img.img_format = img_format
+            img.temperature = self.read_temperature()
+
+            return img
+        finally:
+            slot.release()
+
+FITS_BLOCK = 2880  # Header and data are padded to multiples of this
+FITS_CHUNK_BYTES = 1 << 20  # Row-block size when memory-mapped output is not possible
+BAYER_NAMES = {ASI_BAYER_RG: 'RGGB', ASI_BAYER_BG: 'BGGR', ASI_BAYER_GR: 'GRBG', ASI_BAYER_GB: 'GBRG'}
+
+def fits_card(key, value=None, comment=None):
+    """One 80-character FITS header card"""
+    if value is None:
+        card = key
+    else:
+        if isinstance(value, bool):
+            text = ('T' if value else 'F').rjust(20)
+        elif isinstance(value, (int, np.integer)):
+            text = str(int(value)).rjust(20)
+        elif isinstance(value, (float, np.floating)):
+            text = repr(float(value)).upper().rjust(20)
+        else:
+            text = "'" + str(value).replace("'", "''").ljust(8) + "'"
+        card = f"{key:<8}= {text}"
+        if comment:
+            card += f" / {comment}"
+    return card[:80].ljust(80)
+
+def write_fits(filepath, data, header=()):
+    """Write a single-HDU FITS file from a uint8/uint16 (height, width[, 3]) array.
+
+    header is a sequence of (key, value, comment) cards added after the
+    structural keywords. 16-bit data is stored as BITPIX 16 with BZERO 32768
+    and converted to big-endian in one pass straight into a memory-mapped
+    output file (row blocks if mapping fails); 8-bit data is written as-is.
+    RGB frames become three planes (NAXIS3 = 3). Rows are written top-down.
+    Returns the file size.
+    """
+    if data.dtype == np.uint16:
+        bitpix = 16
+    elif data.dtype == np.uint8:
+        bitpix = 8
+    else:
+        raise ValueError(f"Unsupported FITS data type: {data.dtype}")
+    height, width = data.shape[:2]
+    planes = data.shape[2] if data.ndim == 3 else 1
+    cards = [
+        fits_card('SIMPLE', True, 'conforms to FITS standard'),
+        fits_card('BITPIX', bitpix, 'bits per data value'),
+        fits_card('NAXIS', 3 if planes > 1 else 2),
+        fits_card('NAXIS1', width),
+        fits_card('NAXIS2', height),
+    ]
+    if planes > 1:
+        cards.append(fits_card('NAXIS3', planes, 'RGB planes'))
+    if bitpix == 16:
+        cards.append(fits_card('BZERO', 32768, 'unsigned 16-bit data'))
+        cards.append(fits_card('BSCALE', 1))
+    cards.append(fits_card('ROWORDER', 'TOP-DOWN', 'first row is the top of the image'))
+    cards.extend(fits_card(*card) for card in header)
+    cards.append(fits_card('END'))
+    header_bytes = ''.join(cards).encode('ascii')
+    header_bytes += b' ' * (-len(header_bytes) % FITS_BLOCK)
+    data_size = height * width * planes * data.itemsize
+    file_size = len(header_bytes) + data_size + (-data_size % FITS_BLOCK)
+    
+    with open(filepath, 'wb') as f:
+        f.write(header_bytes)
+        if bitpix == 8:
+            if planes == 1:
+                f.write(np.ascontiguousarray(data))
+            else:
+                for plane in range(planes):
+                    f.write(np.ascontiguousarray(data[:, :, plane]))
+            f.write(b'\0' * (-data_size % FITS_BLOCK))
+            return file_size
+        f.truncate(file_size)  # Zero padding included
+    
+    # 16-bit: unsigned -> signed with BZERO is a flip of the top bit (v ^ 0x8000 == v - 32768)
+    planar = data.transpose(2, 0, 1) if planes > 1 else data
+    try:
+        output = np.memmap(filepath, dtype='>u2', mode='r+', offset=len(header_bytes), shape=planar.shape)
+    except (OSError, ValueError):
+        output = None
+    if output is not None:
+        np.bitwise_xor(planar, 0x8000, out=output)
+        output.flush()
+        del output
+        return file_size
+    rows = max(1, FITS_CHUNK_BYTES // (width * 2))
+    with open(filepath, 'r+b') as f:
+        f.seek(len(header_bytes))
+        for plane in (planar if planes > 1 else [planar]):
+            for row in range(0, height, rows):
+                f.write((plane[row:row + rows] ^ 0x8000).astype('>u2').tobytes())
+    return file_size
+
+def open_fits(filepath):
+    """(header values, read-only memmap of the stored pixels) for a FITS file laid out like write_fits output.
+
+    The memmap keeps FITS order and encoding (planes first, big-endian,
+    BZERO offset); fits_pixels converts it, or a slice of it.
+    """
+    header = {}
+    offset = 0
+    with open(filepath, 'rb') as f:
+        while 'END' not in header:
+            block = f.read(FITS_BLOCK)
+            if len(block) < FITS_BLOCK:
+                raise ValueError(f"Truncated FITS header: {filepath}")
+            offset += FITS_BLOCK
+            for start in range(0, FITS_BLOCK, 80):
+                card = block[start:start + 80].decode('ascii', 'replace')
+                key = card[:8].strip()
+                if key == 'END':
+                    header['END'] = None
+                    break
+                if card[8:10] == '= ':
+                    header[key] = card[10:].split('/')[0].strip().strip("'").strip()
+    bitpix = int(header['BITPIX'])
+    if bitpix not in (8, 16):
+        raise ValueError(f"Unsupported FITS BITPIX {bitpix}: {filepath}")
+    width, height = int(header['NAXIS1']), int(header['NAXIS2'])
+    planes = int(header.get('NAXIS3', 1)) if int(header['NAXIS']) == 3 else 1
+    shape = (planes, height, width) if planes > 1 else (height, width)
+    data = np.memmap(filepath, dtype='>u1' if bitpix == 8 else '>u2', mode='r', offset=offset, shape=shape)
+    return header, data
+
+def fits_pixels(header, data):
+    """uint8/uint16 (height, width[, 3]) pixels from stored FITS data (all of it or a slice)"""
+    if int(header['BITPIX']) == 16:
+        # Signed storage with BZERO 32768 back to unsigned: flip the top bit again
+        if float(header.get('BZERO', 0)) == 32768:
+            data = np.bitwise_xor(data, 0x8000, dtype=np.uint16)
+        dtype = np.uint16
+    else:
+        dtype = np.uint8
+    if data.ndim == 3:
+        data = data.transpose(1, 2, 0)
+    return np.ascontiguousarray(data, dtype=dtype)
+
+def read_fits(filepath):
+    """Pixels of a FITS file in the layout write_fits produces (BITPIX 8 or 16, optional RGB planes)"""
+    header, data = open_fits(filepath)
+    return fits_pixels(header, data)
+
+CAPTURE_ROOTS_FILE = 'capture_roots.json'  # Sequence save directories, so the index survives restarts
+CAPTURE_EXTENSIONS = ('.jpg', '.png', '.tif', '.tiff', '.fits')
+CAPTURE_PAGE_LIMIT = 1000
+
+class CaptureIndex:
+    """Files written by sequence capture, served by GET /captures.
+
+    Maintained incrementally: the sequence writer adds every file it writes,
+    and a save directory is scanned once - when a sequence first uses it, or
+    after a restart from CAPTURE_ROOTS_FILE. Entries stay sorted by (mtime,
+    name), so a page is a list slice. Files deleted behind our back are
+    dropped when a download finds them missing.
+    """
+    def __init__(self, roots_file=CAPTURE_ROOTS_FILE):
+        self.roots_file = roots_file
+        self.lock = threading.Lock()
+        self.roots = None  # Loaded (and scanned) on first use
+        self.entries = {}  # name -> (mtime, name, size, path)
+        self.order = []  # Entries sorted oldest first
+
+    def _load_roots(self):
+        """Read and scan the saved directories once (lock held)"""
+        if self.roots is not None:
+            return
+        self.roots = []
+        if os.path.exists(self.roots_file):
+            try:
+                with open(self.roots_file, 'r') as f:
+                    self.roots = [root for root in json.load(f) if isinstance(root, str)]
+            except (OSError, ValueError) as e:
+                print(f"[Captures] Ignoring unreadable {self.roots_file}: {e}")
+        for root in self.roots:
+            self._scan(root)
+
+    def add_root(self, directory):
+        """Index a sequence save directory (scanned once, remembered across restarts)"""
+        directory = os.path.abspath(directory)
+        with self.lock:
+            self._load_roots()
+            if directory in self.roots:
+                return
+            self.roots.append(directory)
+            partial = self.roots_file + '.partial'
+            with open(partial, 'w') as f:
+                json.dump(self.roots, f, indent=2)
+            os.replace(partial, self.roots_file)
+            self._scan(directory)
+
+    def _scan(self, directory):
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.lower().endswith(CAPTURE_EXTENSIONS):
+                        stat = entry.stat()
+                        self._insert(entry.name, entry.path, stat.st_size, stat.st_mtime)
+        except OSError as e:
+            print(f"[Captures] Cannot scan {directory}: {e}")
+
+    def add(self, path, size, mtime):
+        with self.lock:
+            self._load_roots()
+            self._insert(os.path.basename(path), os.path.abspath(path), size, mtime)
+
+    def _insert(self, name, path, size, mtime):
+        """Add or replace an entry (lock held) - a name seen in two directories keeps the newer file"""
+        existing = self.entries.get(name)
+        if existing is not None and existing[3] != path:
+            older, newer = (path, existing[3]) if existing[0] > mtime else (existing[3], path)
+            print(f"[Captures] {older} is hidden by the newer {newer} with the same name")
+            if older == path:
+                return
+        self._remove(name)
+        entry = (mtime, name, size, path)
+        self.entries[name] = entry
+        bisect.insort(self.order, entry)
+
+    def remove(self, name):
+        with self.lock:
+            self._remove(name)
+
+    def _remove(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            position = bisect.bisect_left(self.order, entry)
+            if position < len(self.order) and self.order[position] == entry:
+                del self.order[position]
+
+    def page(self, offset, limit):
+        """(total, entries) for one page, newest first"""
+        with self.lock:
+            self._load_roots()
+            total = len(self.order)
+            end = max(0, total - offset)
+            return total, self.order[max(0, end - limit):end][::-1]
+
+    def path(self, name):
+        with self.lock:
+            self._load_roots()
+            entry = self.entries.get(name)
+            return entry[3] if entry else None
+
+THUMBNAIL_DIR = os.environ.get('ASI_THUMBNAIL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thumbnails'))
+THUMBNAIL_SIZE = 256  # Default longest side; also the size generated eagerly by the sequence writer
+THUMBNAIL_MIN_SIZE = 32
+THUMBNAIL_MAX_SIZE = 1024
+THUMBNAIL_CACHE_BYTES = 32 << 20  # In-memory thumbnails, least recently used dropped first
+THUMBNAIL_QUALITY = 80
+BAYER_BY_NAME = {name: pattern for pattern, name in BAYER_NAMES.items()}
+
+def thumbnail_indices(length, step, bayer):
+    """Every step-th index along an axis; for Bayer data both rows/columns of every step-th 2x2 cell"""
+    if not bayer:
+        return np.arange(0, length, step)
+    starts = np.arange(0, length - 1, step)
+    return np.stack([starts, starts + 1], axis=1).ravel()
+
+def thumbnail_sample(data, size, bayer=False):
+    """Strided sample of the last two (height, width) axes at about twice the thumbnail size.
+
+    Works on memmaps too, so only the sampled rows of a file are read. Bayer
+    data keeps whole 2x2 cells (an even step) so the sample is still a mosaic.
+    """
+    height, width = data.shape[-2:]
+    step = max(1, max(height, width) // (size * 2))
+    if bayer:
+        step += step % 2
+    rows = thumbnail_indices(height, step, bayer)
+    columns = thumbnail_indices(width, step, bayer)
+    return data[..., rows, :][..., columns]
+
+def thumbnail_jpeg(pixels, size, bayer_pattern=None):
+    """JPEG thumbnail (longest side <= size) of a sampled uint8/uint16 (height, width[, 3]) array"""
+    if pixels.dtype == np.uint16:
+        pixels = (pixels >> 8).astype(np.uint8)
+    if bayer_pattern is not None:
+        pixels = demosaicer.superpixel(pixels, bayer_pattern)
+    img = Image.fromarray(np.ascontiguousarray(pixels))
+    img.thumbnail((size, size), Image.Resampling.BILINEAR)
+    img_io = io.BytesIO()
+    img.save(img_io, 'JPEG', quality=THUMBNAIL_QUALITY)
+    return img_io.getvalue()
+
+def image_thumbnail(img, size):
+    """Thumbnail of an in-memory frame (RGB, L or I;16; RAW mosaics are debayered per 2x2 cell)"""
+    bayer_pattern = getattr(img, 'bayer_pattern', None)
+    array = frame_array(img)
+    if array.ndim == 3:
+        sample = thumbnail_sample(array.transpose(2, 0, 1), size).transpose(1, 2, 0)
+    else:
+        sample = thumbnail_sample(array, size, bayer_pattern is not None)
+    return thumbnail_jpeg(sample, size, bayer_pattern)
+
+def file_thumbnail(path, size):
+    """Thumbnail of a saved capture, reading as little of the file as the format allows"""
+    if path.lower().endswith('.fits'):
+        header, data = open_fits(path)
+        bayer_pattern = BAYER_BY_NAME.get(header.get('BAYERPAT')) if data.ndim == 2 else None
+        sample = fits_pixels(header, thumbnail_sample(data, size, bayer_pattern is not None))
+        return thumbnail_jpeg(sample, size, bayer_pattern)
+    with Image.open(path) as img:
+        if img.mode in ('RGB', 'L'):
+            # JPEG: draft() decodes at 1/2, 1/4 or 1/8 scale; reducing_gap lets others reduce() by an integer factor first
+            img.draft('RGB' if img.mode == 'RGB' else 'L', (size * 2, size * 2))
+            img.thumbnail((size, size), Image.Resampling.BILINEAR, reducing_gap=2.0)
+            img_io = io.BytesIO()
+            img.save(img_io, 'JPEG', quality=THUMBNAIL_QUALITY)
+            return img_io.getvalue()
+        # 16-bit PNG/TIFF (RAW16, mosaic or mono - no Bayer metadata in these files)
+        return thumbnail_jpeg(thumbnail_sample(np.asarray(img), size), size)
+
+class ThumbnailCache:
+    """JPEG thumbnails of captured files: byte-bounded in-memory LRU in front of a disk cache.
+
+    Entries remember when they were made and are rebuilt if the capture file
+    is newer. The sequence writer stores THUMBNAIL_SIZE thumbnails as it saves
+    frames, while the pixels are still in memory.
+    """
+    def __init__(self, directory=THUMBNAIL_DIR, max_bytes=THUMBNAIL_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # (name, size) -> (created, JPEG bytes)
+        self.memory_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _disk_path(self, name, size):
+        return os.path.join(self.directory, f"{name}.{size}.jpg")
+
+    def get(self, name, size, path):
+        """Thumbnail JPEG of the capture at path, from memory, disk or built from the file"""
+        source_mtime = os.stat(path).st_mtime
+        key = (name, size)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and entry[0] >= source_mtime:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        disk_path = self._disk_path(name, size)
+        try:
+            created = os.stat(disk_path).st_mtime
+            if created >= source_mtime:
+                with open(disk_path, 'rb') as f:
+                    jpeg = f.read()
+                with self.lock:
+                    self.disk_hits += 1
+                self._remember(key, created, jpeg)
+                return jpeg
+        except OSError:
+            pass
+        with self.lock:
+            self.misses += 1
+        jpeg = file_thumbnail(path, size)
+        self.store(name, size, jpeg)
+        return jpeg
+
+    def store(self, name, size, jpeg):
+        """Keep a thumbnail in memory and on disk"""
+        os.makedirs(self.directory, exist_ok=True)
+        disk_path = self._disk_path(name, size)
+        partial = disk_path + '.partial'
+        with open(partial, 'wb') as f:
+            f.write(jpeg)
+        os.replace(partial, disk_path)
+        self._remember((name, size), time.time(), jpeg)
+
+    def _remember(self, key, created, jpeg):
+        with self.lock:
+            old = self.memory.pop(key, None)
+            if old is not None:
+                self.memory_bytes -= len(old[1])
+            self.memory[key] = (created, jpeg)
+            self.memory_bytes += len(jpeg)
+            while self.memory_bytes > self.max_bytes and len(self.memory) > 1:
+                _, (_, evicted) = self.memory.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'cached': len(self.memory),
+                'cached_bytes': self.memory_bytes,
+                'capacity_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
             }
-            error_name = error_names.get(result, f"UNKNOWN_ERROR_{result}")
-            print(f"[capture_snapshot] Failed to get image data: {result} ({error_name})")
-            print(f"[capture_snapshot] Buffer size requested: {buffer_size}, format: {img_format}, width: {width}, height: {height}")
-            # Check exposure status
-            status_check = ctypes.c_int(0)
-            asi_lib.ASIGetExpStatus(self.camera_id, ctypes.byref(status_check))
-            status_names = {0: "ASI_EXP_IDLE", 1: "ASI_EXP_WORKING", 2: "ASI_EXP_SUCCESS", 3: "ASI_EXP_FAILED"}
-            status_name = status_names.get(status_check.value, f"UNKNOWN_{status_check.value}")
-            print(f"[capture_snapshot] Exposure status when getting data: {status_check.value} ({status_name})")
+
+class SequenceWriter:
+    """Bounded worker pool that encodes and writes sequence frames.
+
+    The capture loop hands over each image and goes straight to the next
+    exposure; submit() blocks only when SEQUENCE_WRITE_QUEUE frames are
+    already waiting, so memory stays bounded when encoding is the bottleneck.
+    """
+    def __init__(self, workers=SEQUENCE_WRITE_WORKERS, max_queue=SEQUENCE_WRITE_QUEUE):
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.written = 0
+            self.failed = 0
+            self.bytes_written = 0
+            self.encode_seconds = 0.0
+            self.last_encode_seconds = None
+            self.write_seconds = 0.0
+            self.backpressure_seconds = 0.0
+            self.started = time.monotonic()
+
+    def start(self):
+        self.reset_stats()
+        self.threads = [threading.Thread(target=self._worker, name=f'sequence-writer-{i}', daemon=True)
+                        for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, img, filepath, file_format, header=()):
+        """Queue a frame for encoding - blocks while the queue is full
+
+        header holds FITS (key, value, comment) cards captured with the frame.
+        """
+        started = time.perf_counter()
+        self.queue.put((img, filepath, file_format, header))
+        waited = time.perf_counter() - started
+        if waited > 0.001:
+            with self.lock:
+                self.backpressure_seconds += waited
+            metric_sequence_backpressure_seconds.labels().inc(waited)
+
+    def finish(self, timeout=None):
+        """Write everything still queued, then stop the workers"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            img, filepath, file_format, header = item
+            try:
+                self._write(img, filepath, file_format, header)
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                print(f"[Sequence] Failed to save {os.path.basename(filepath)}: {e}")
+
+    def _write(self, img, filepath, file_format, header):
+        encode_started = time.perf_counter()
+        if file_format == 'FITS':
+            # No encode step: header + big-endian pixels go straight to the file
+            size = write_fits(filepath, frame_array(img), header)
+            finished = time.perf_counter()
+            self._record(filepath, file_format, size, encode_started, encode_started, finished)
+            self._thumbnail(img, filepath)
+            return
+        img_io = io.BytesIO()
+        if file_format == 'JPEG':
+            preview_8bit(img).save(img_io, 'JPEG', quality=100)
+        elif file_format == 'PNG':
+            img.save(img_io, 'PNG')
+        elif file_format == 'TIFF':
+            img.save(img_io, 'TIFF')
+        data = img_io.getbuffer()
+        write_started = time.perf_counter()
+        with open(filepath, 'wb') as f:
+            f.write(data)
+        finished = time.perf_counter()
+        self._record(filepath, file_format, len(data), encode_started, write_started, finished)
+        self._thumbnail(img, filepath)
+    
+    def _thumbnail(self, img, filepath):
+        """Gallery thumbnail from the frame still in memory - far cheaper than decoding the file later"""
+        try:
+            thumbnails.store(os.path.basename(filepath), THUMBNAIL_SIZE, image_thumbnail(img, THUMBNAIL_SIZE))
+        except Exception as e:
+            print(f"[Sequence] Thumbnail for {os.path.basename(filepath)} failed: {e}")
+
+    def _record(self, filepath, file_format, size, encode_started, write_started, finished):
+        capture_index.add(filepath, size, time.time())
+        metric_sequence_encode_seconds.labels(file_format).observe(write_started - encode_started)
+        metric_sequence_save_seconds.labels(file_format).observe(finished - encode_started)
+        with self.lock:
+            self.written += 1
+            self.bytes_written += size
+            self.encode_seconds += write_started - encode_started
+            self.last_encode_seconds = write_started - encode_started
+            self.write_seconds += finished - write_started
+            sequence_state['saved_count'] += 1
+        print(f"[Sequence] Saved photo {sequence_state['saved_count']}/{sequence_state['total_count']}: {os.path.basename(filepath)}")
+
+    def stats(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.started, 1e-6)
+            return {
+                'queue_depth': self.queue.qsize(),
+                'queue_capacity': self.queue.maxsize,
+                'written': self.written,
+                'failed': self.failed,
+                'encode_seconds_avg': round(self.encode_seconds / self.written, 4) if self.written else None,
+                'encode_seconds_last': round(self.last_encode_seconds, 4) if self.last_encode_seconds is not None else None,
+                'write_mb_per_s': round(self.bytes_written / self.write_seconds / 1e6, 2) if self.write_seconds else None,
+                'frames_per_s': round(self.written / elapsed, 2),
+                'backpressure_seconds': round(self.backpressure_seconds, 3)
+            }
+
+def fits_header(img):
+    """FITS cards describing a photo (full frame, bin 1), from the settings recorded on the frame at capture"""
+    started = datetime.fromtimestamp(img.exposure_start, timezone.utc)
+    cards = [
+        ('DATE-OBS', started.replace(tzinfo=None).isoformat(timespec='milliseconds'), 'UTC start of exposure'),
+        ('EXPTIME', img.exposure_us / 1e6, 'exposure time [s]'),
+        ('GAIN', img.gain, 'sensor gain'),
+        ('GAMMA', img.gamma),
+        ('XBINNING', 1),
+        ('YBINNING', 1),
+        ('INSTRUME', camera.camera_name or 'ZWO ASI', 'camera name'),
+        ('IMAGETYP', 'Light'),
+    ]
+    if img.temperature is not None:
+        cards.append(('CCD-TEMP', img.temperature, 'sensor temperature [C]'))
+    # Bayer keywords only apply to undebayered sensor data
+    bayer_pattern = getattr(img, 'bayer_pattern', None)
+    if bayer_pattern is not None and img.img_format in (ASI_IMG_RAW8, ASI_IMG_RAW16):
+        cards.append(('BAYERPAT', BAYER_NAMES.get(bayer_pattern, 'RGGB'), 'CFA pattern'))
+        cards.append(('XBAYROFF', 0))
+        cards.append(('YBAYROFF', 0))
+    return cards
+
+STACK_MODES = ('mean', 'max', 'sigma')
+STACK_SIGMA_KAPPA = 3.0  # sigma mode: values further than this many standard deviations from the mean are rejected
+STACK_SIGMA_WARMUP = 5  # sigma mode: frames accepted unconditionally before clipping starts
+STACK_SIGMA_FLOOR = 0.5  # sigma mode: minimum standard deviation (ADU), so noiseless pixels are not all rejected
+
+class LiveStacker:
+    """Running stack of sequence frames in constant memory.
+
+    mean: running per-pixel mean. max: per-pixel maximum (star trails).
+    sigma: incremental sigma-clipped mean - per-pixel running mean and
+    variance (Welford), leaving out values more than STACK_SIGMA_KAPPA
+    standard deviations from the current mean (satellites, planes, cosmic
+    rays). Accumulators are float32 arrays of the frame shape, allocated on
+    the first frame and updated in place, so memory does not grow with the
+    number of frames.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset(None)
+
+    def reset(self, mode):
+        """Drop the current stack; mode None turns stacking off"""
+        with self.lock:
+            self.mode = mode
+            self.frames = 0
+            self.rejected = 0  # sigma: pixel values left out
+            self.shape = None
+            self.dtype = None
+            self.bayer_pattern = None
+            self.header = ()  # FITS cards of the first frame
+            self.acc = None  # Mean or maximum
+            self.m2 = None  # sigma: sum of squared deviations from the mean
+            self.count = None  # sigma: accepted values per pixel
+            self.delta = None  # Scratch buffers, reused every frame
+            self.scratch = None
+            self.accept = None
+
+    def add(self, img, header=()):
+        """Add a captured frame (RGB, L or I;16 image); header is kept from the first frame"""
+        if self.mode is None:
+            return
+        started = time.perf_counter()
+        frame = frame_array(img)
+        with self.lock:
+            if self.shape != frame.shape or self.dtype != frame.dtype:
+                if self.frames:
+                    print(f"[Stack] Frame size or format changed, restarting the {self.mode} stack")
+                self._allocate(frame)
+                self.bayer_pattern = getattr(img, 'bayer_pattern', None)
+                self.header = header
+            self.frames += 1
+            if self.mode == 'max':
+                np.maximum(self.acc, frame, out=self.acc)
+            elif self.mode == 'mean':
+                # Running mean rather than a sum: stays within float32 precision for any frame count
+                delta = np.subtract(frame, self.acc, out=self.delta)
+                delta *= 1.0 / self.frames
+                self.acc += delta
+            else:
+                self._add_sigma(frame)
+        metric_stack_seconds.labels(self.mode).observe(time.perf_counter() - started)
+
+    def _allocate(self, frame):
+        """Fresh accumulators for frames like this one (lock held)"""
+        self.shape = frame.shape
+        self.dtype = frame.dtype
+        self.frames = 0
+        self.rejected = 0
+        self.acc = np.zeros(frame.shape, np.float32)
+        if self.mode in ('mean', 'sigma'):
+            self.delta = np.empty(frame.shape, np.float32)
+        if self.mode == 'sigma':
+            self.m2 = np.zeros(frame.shape, np.float32)
+            self.count = np.zeros(frame.shape, np.uint16)
+            self.scratch = np.empty(frame.shape, np.float32)
+            self.accept = np.empty(frame.shape, bool)
+
+    def _add_sigma(self, frame):
+        """Welford update limited to values within kappa sigma of the running mean (lock held)"""
+        delta = np.subtract(frame, self.acc, out=self.delta)
+        accept = self.accept
+        if self.frames > STACK_SIGMA_WARMUP:
+            # |delta| <= kappa * sigma, sigma = sqrt(m2 / (count - 1))
+            sigma = np.subtract(self.count, 1, out=self.scratch)
+            np.maximum(sigma, 1, out=sigma)
+            np.divide(self.m2, sigma, out=sigma)
+            np.sqrt(sigma, out=sigma)
+            np.maximum(sigma, STACK_SIGMA_FLOOR, out=sigma)
+            distance = np.divide(delta, sigma, out=sigma)
+            np.abs(distance, out=distance)
+            np.less_equal(distance, STACK_SIGMA_KAPPA, out=accept)
+            self.rejected += accept.size - int(np.count_nonzero(accept))
+        else:
+            accept.fill(True)
+        np.add(self.count, accept, out=self.count, casting='unsafe')
+        delta *= accept  # Rejected values leave mean and m2 unchanged
+        step = np.divide(delta, self.count, out=self.scratch)  # count >= 1 after the first frame
+        self.acc += step
+        # m2 += delta * (value - new mean)
+        spread = np.subtract(frame, self.acc, out=self.scratch)
+        spread *= delta
+        self.m2 += spread
+
+    def result(self, bits=None):
+        """Current stack as an integer array in the frames' depth (or bits=16), None if empty.
+
+        8-bit stacks are scaled by 257 for 16-bit output, so averaging keeps its
+        extra precision.
+        """
+        with self.lock:
+            if not self.frames:
+                return None
+            stack = self.acc.copy()
+            dtype = self.dtype
+        if bits == 16 and dtype == np.uint8:
+            stack *= 257
+            dtype = np.uint16
+        np.rint(stack, out=stack)
+        np.clip(stack, 0, np.iinfo(dtype).max, out=stack)
+        return stack.astype(dtype)
+
+    def stats(self):
+        with self.lock:
+            if self.mode is None:
+                return None
+            values = self.frames * int(np.prod(self.shape)) if self.shape else 0
+            return {
+                'mode': self.mode,
+                'frames': self.frames,
+                'rejected_fraction': round(self.rejected / values, 6) if self.mode == 'sigma' and values else None
+            }
+
+CALIBRATION_DIR = os.environ.get('ASI_CALIBRATION_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibration'))
+CALIBRATION_KINDS = ('dark', 'flat')
+CALIBRATION_METHODS = ('median', 'mean')
+CALIBRATION_STORAGE = ('npy', 'fits')
+CALIBRATION_TARGETS = ('photo', 'stream')  # Which frames a master is captured for (see capture_settings)
+CALIBRATION_TEMP_BUCKET = 5  # Darks are grouped by sensor temperature in steps of this many degrees C
+CALIBRATION_TEMP_TOLERANCE = 10  # Furthest a dark's temperature (C) may be from the frame's and still be used
+CALIBRATION_CHUNK_BYTES = 64 << 20  # Slice of the frame stack held in memory while taking the median
+CALIBRATION_CACHE_BYTES = 512 << 20  # Loaded masters kept in memory, least recently used dropped first
+IMG_FORMAT_NAMES = {ASI_IMG_RAW8: 'RAW8', ASI_IMG_RGB24: 'RGB24', ASI_IMG_RAW16: 'RAW16', ASI_IMG_Y8: 'Y8'}
+IMG_FORMATS_BY_NAME = {name: img_format for img_format, name in IMG_FORMAT_NAMES.items()}
+
+# Master frame identity - flats do not depend on exposure or sensor temperature (both None)
+MasterKey = namedtuple('MasterKey', ['kind', 'exposure', 'gain', 'bin', 'img_format', 'temperature'])
+MASTER_FILE = re.compile(r'^(dark|flat)(?:_exp(\d+)us)?_gain(\d+)_bin(\d+)_(RAW8|RGB24|RAW16|Y8)'
+                         r'(?:_temp(-?\d+|na))?\.(npy|fits)$')
+
+def master_key(kind, exposure, gain, bin_value, img_format, temperature):
+    """MasterKey for frames taken with these settings (temperature in C or None)"""
+    if kind == 'flat':
+        return MasterKey(kind, None, int(gain), int(bin_value), int(img_format), None)
+    if temperature is not None:
+        temperature = int(round(temperature / CALIBRATION_TEMP_BUCKET) * CALIBRATION_TEMP_BUCKET)
+    return MasterKey(kind, int(exposure), int(gain), int(bin_value), int(img_format), temperature)
+
+def master_filename(key, storage):
+    name = key.kind
+    if key.kind == 'dark':
+        name += f"_exp{key.exposure}us"
+    name += f"_gain{key.gain}_bin{key.bin}_{IMG_FORMAT_NAMES[key.img_format]}"
+    if key.kind == 'dark':
+        name += f"_temp{'na' if key.temperature is None else key.temperature}"
+    return f"{name}.{storage}"
+
+def chunked_median(stack):
+    """Per-pixel median of a (count, height, ...) frame stack such as a disk-backed memmap.
+
+    Works through bands of rows so at most CALIBRATION_CHUNK_BYTES of the
+    stack is in memory at once; the result keeps the stack's dtype.
+    """
+    count, height = stack.shape[:2]
+    rows = max(1, CALIBRATION_CHUNK_BYTES // max(1, stack[:, :1].nbytes))
+    out = np.empty(stack.shape[1:], stack.dtype)
+    middle = count // 2
+    for row in range(0, height, rows):
+        band = np.array(stack[:, row:row + rows])
+        if count % 2:
+            band.partition(middle, axis=0)
+            out[row:row + rows] = band[middle]
+        else:
+            band.partition((middle - 1, middle), axis=0)
+            out[row:row + rows] = (band[middle - 1].astype(np.uint32) + band[middle] + 1) >> 1
+    return out
+
+class CalibrationLibrary:
+    """Master darks and flats on disk, loaded through a byte-bounded LRU cache.
+
+    Masters are stored in the frames' own dtype (.npy or FITS) under a name
+    built from their MasterKey, so the directory listing is the index. Cached
+    masters are kept ready to apply: darks as stored, flats as float32 gain
+    maps (mean / flat, per color channel or Bayer phase).
+    """
+    def __init__(self, directory=CALIBRATION_DIR, cache_bytes=CALIBRATION_CACHE_BYTES):
+        self.directory = directory
+        self.cache_bytes = cache_bytes
+        self.lock = threading.Lock()
+        self.index = None  # MasterKey -> file path, scanned on first use
+        self.cache = OrderedDict()  # MasterKey -> ready-to-apply array, most recently used last
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.local = threading.local()  # Per-thread float32 scratch for flat fielding
+
+    def _scan(self):
+        """Index the master files in the directory (lock held)"""
+        if self.index is not None:
+            return
+        self.index = {}
+        if not os.path.isdir(self.directory):
+            return
+        for filename in sorted(os.listdir(self.directory)):
+            match = MASTER_FILE.match(filename)
+            if not match:
+                continue
+            kind, exposure, gain, bin_value, format_name, temperature, _ = match.groups()
+            key = MasterKey(kind, int(exposure) if exposure else None, int(gain), int(bin_value),
+                            IMG_FORMATS_BY_NAME[format_name],
+                            None if temperature in (None, 'na') else int(temperature))
+            self.index[key] = os.path.join(self.directory, filename)
+
+    def find(self, kind, exposure, gain, bin_value, img_format, temperature):
+        """Key of the master to use for a frame, or None.
+
+        Darks must match exposure, gain, binning and format and come from the
+        nearest temperature bucket within CALIBRATION_TEMP_TOLERANCE; flats
+        match gain, binning and format.
+        """
+        wanted = master_key(kind, exposure, gain, bin_value, img_format, temperature)
+        with self.lock:
+            self._scan()
+            if wanted in self.index:
+                return wanted
+            if kind != 'dark':
+                return None
+            candidates = [key for key in self.index if key[:5] == wanted[:5]]
+        if temperature is None or not candidates:
+            # Unknown sensor temperature: any dark for these settings beats none
+            return candidates[0] if candidates else None
+        nearest = min(candidates, key=lambda key: abs(key.temperature - temperature) if key.temperature is not None else float('inf'))
+        if nearest.temperature is None or abs(nearest.temperature - temperature) <= CALIBRATION_TEMP_TOLERANCE:
+            return nearest
+        return None
+
+    def load(self, key):
+        """Ready-to-apply master for key (cached), or None if it has no file"""
+        with self.lock:
+            master = self.cache.get(key)
+            if master is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return master
+            self._scan()
+            path = self.index.get(key)
+            self.misses += 1
+        if path is None:
             return None
+        data = read_fits(path) if path.endswith('.fits') else np.load(path)
+        master = self._prepare(key, data)
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = master
+                self.cached_bytes += master.nbytes
+            self._evict()
+        return master
+
+    def _prepare(self, key, data):
+        """Darks are applied as stored; flats become float32 gain maps normalised to mean 1"""
+        if key.kind == 'dark':
+            return data
+        flat = data.astype(np.float32)
+        gains = np.ones_like(flat)
+        if flat.ndim == 3:
+            regions = [(Ellipsis, channel) for channel in range(flat.shape[2])]
+        elif key.img_format in (ASI_IMG_RAW8, ASI_IMG_RAW16):
+            # Mosaic flat: normalise each Bayer phase on its own so color balance is kept
+            regions = [(slice(y, None, 2), slice(x, None, 2)) for y in (0, 1) for x in (0, 1)]
+        else:
+            regions = [Ellipsis]
+        for region in regions:
+            plane = flat[region]
+            np.divide(plane.mean(), plane, out=gains[region], where=plane > 0)
+        return gains
+
+    def _evict(self):
+        """Drop least recently used masters beyond cache_bytes, keeping the newest (lock held)"""
+        while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+            _, master = self.cache.popitem(last=False)
+            self.cached_bytes -= master.nbytes
 
-        # Convert to PIL Image based on format
-        if img_format == ASI_IMG_RGB24:
-            img_array = np.frombuffer(buffer, dtype=np.uint8)
-            img_array = img_array.reshape((height, width, 3))
-            img = Image.fromarray(img_array, 'RGB')
-        elif img_format == ASI_IMG_Y8:
-            img_array = np.frombuffer(buffer, dtype=np.uint8)
-            img_array = img_array.reshape((height, width))
-            img = Image.fromarray(img_array, 'L')  # Grayscale
-        elif img_format == ASI_IMG_RAW8:
-            # RAW8: Simple debayering (Bayer pattern to RGB)
-            # For now, convert to grayscale for display, but save as RAW data
-            img_array = np.frombuffer(buffer, dtype=np.uint8)
-            img_array = img_array.reshape((height, width))
-            # Simple debayering: treat as grayscale for now
-            # TODO: Implement proper Bayer demosaicing
-            img = Image.fromarray(img_array, 'L')
-        elif img_format == ASI_IMG_RAW16:
-            # RAW16: Convert byte buffer to uint16 array (little-endian)
-            img_array = np.frombuffer(buffer, dtype=np.uint8)
-            # Reshape to pairs and convert to uint16
-            img_array_pairs = img_array.reshape((height * width, 2))
-            img_array_16bit = img_array_pairs[:, 0].astype(np.uint16) | (img_array_pairs[:, 1].astype(np.uint16) << 8)
-            img_array_16bit = img_array_16bit.reshape((height, width))
-            # Scale to 8-bit for display (use upper 8 bits)
-            img_array_8bit = (img_array_16bit >> 8).astype(np.uint8)
-            img = Image.fromarray(img_array_8bit, 'L')
+    def save(self, key, master, storage='npy'):
+        """Write a master (replacing any file for the same key) and return its path"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, master_filename(key, storage))
+        partial = path + '.partial'
+        if storage == 'fits':
+            write_fits(partial, master, [('IMAGETYP', 'Dark' if key.kind == 'dark' else 'Flat')] +
+                       ([('EXPTIME', key.exposure / 1e6, 'exposure time [s]')] if key.exposure is not None else []) +
+                       [('GAIN', key.gain, 'sensor gain'), ('XBINNING', key.bin), ('YBINNING', key.bin)])
         else:
-            print(f"[capture_snapshot] Unsupported format: {img_format}")
+            with open(partial, 'wb') as f:
+                np.save(f, master)
+        os.replace(partial, path)
+        with self.lock:
+            self._scan()
+            previous = self.index.get(key)
+            if previous is not None and previous != path and os.path.exists(previous):
+                os.remove(previous)  # Same master saved in the other storage format before
+            self.index[key] = path
+            stale = self.cache.pop(key, None)
+            if stale is not None:
+                self.cached_bytes -= stale.nbytes
+        return path
+
+    def apply(self, frame, exposure, gain, bin_value, img_format, temperature, out=None, crop=None):
+        """Dark-subtract and flat-field frame, writing into out (may be frame itself).
+
+        crop=(start_y, start_x) takes the matching window from larger masters
+        (video ROI). Returns out, or None when no master applies.
+        """
+        dark_key = self.find('dark', exposure, gain, bin_value, img_format, temperature)
+        flat_key = self.find('flat', exposure, gain, bin_value, img_format, temperature)
+        dark = self._fit(self.load(dark_key) if dark_key else None, frame, crop)
+        flat = self._fit(self.load(flat_key) if flat_key else None, frame, crop)
+        if dark is None and flat is None:
+            return None
+        if out is None:
+            out = np.empty_like(frame)
+        if flat is None:
+            # Integer dark subtraction clamped at 0 without leaving the frame's dtype
+            floor = np.minimum(frame, dark, out=self._scratch(frame.shape, frame.dtype))
+            return np.subtract(frame, floor, out=out)
+        work = self._scratch(frame.shape, np.float32)
+        if dark is not None:
+            np.subtract(frame, dark, out=work, dtype=np.float32)  # float loop - negative values must not wrap
+        else:
+            np.copyto(work, frame)
+        work *= flat
+        np.clip(work, 0, np.iinfo(frame.dtype).max, out=work)
+        np.rint(work, out=work)
+        np.copyto(out, work, casting='unsafe')
+        return out
+
+    def _fit(self, master, frame, crop):
+        """master (or its ROI window) if it lines up with frame, else None"""
+        if master is None or master.shape == frame.shape:
+            return master
+        if crop is None or master.ndim != frame.ndim:
             return None
+        start_y, start_x = crop
+        window = master[start_y:start_y + frame.shape[0], start_x:start_x + frame.shape[1]]
+        return window if window.shape == frame.shape else None
+
+    def _scratch(self, shape, dtype):
+        buffers = self.local.__dict__.setdefault('buffers', {})
+        key = (shape, np.dtype(dtype))
+        if key not in buffers:
+            if len(buffers) > 8:
+                buffers.clear()
+            buffers[key] = np.empty(shape, dtype)
+        return buffers[key]
 
+    def filename(self, key):
+        """File name of the master stored for key, or None"""
+        with self.lock:
+            self._scan()
+            path = self.index.get(key)
+        return os.path.basename(path) if path else None
+
+    def masters(self):
+        with self.lock:
+            self._scan()
+            entries = sorted(self.index.items(), key=lambda item: os.path.basename(item[1]))
+        return [{
+            'file': os.path.basename(path),
+            'kind': key.kind,
+            'exposure': key.exposure,
+            'gain': key.gain,
+            'bin': key.bin,
+            'image_format': IMG_FORMAT_NAMES[key.img_format],
+            'temperature': key.temperature,
+        } for key, path in entries]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'cached': len(self.cache),
+                'cached_bytes': self.cached_bytes,
+                'cache_capacity_bytes': self.cache_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+def calibrate_frame(img):
+    """Photo img dark-subtracted and flat-fielded from the library, when enabled and a master matches"""
+    if not camera_state['calibrate'] or img is None:
+        return img
+    started = time.perf_counter()
+    frame = frame_array(img)
+    calibrated = calibration.apply(frame, getattr(img, 'exposure_us', camera_state['exposure']),
+                                   getattr(img, 'gain', camera_state['gain']), 1,
+                                   getattr(img, 'img_format', camera_state['image_format']),
+                                   getattr(img, 'temperature', camera.last_temperature))
+    if calibrated is None:
         return img
+    result = Image.fromarray(calibrated)
+    result.array = calibrated
+    for name in FRAME_METADATA:
+        if hasattr(img, name):
+            setattr(result, name, getattr(img, name))
+    metric_calibration_seconds.labels('photo').observe(time.perf_counter() - started)
+    return result
 
-def sequence_capture_loop():
-    """Background thread for sequence capture"""
-    import os
+def run_calibration_capture(kind, count, method, storage, target='photo'):
+    """Background thread: capture count darks or flats at target's settings (see capture_settings) and save the master"""
+    settings = capture_settings(target)
+    exposure = settings.exposure
+    gain = camera_state['gain']
+    img_format = settings.img_format
+    stack = None
+    stack_path = None
+    stacker = LiveStacker()
+    stacker.reset('mean')
+    temperatures = []
+    captured = 0
+    try:
+        for index in range(count):
+            if not calibration_state['active']:
+                break
+            img, error_msg = take_snapshot(priority=PRIORITY_SEQUENCE, dark=(kind == 'dark'), target=target)
+            if img is None:
+                print(f"[Calibration] Failed to capture {kind} {index + 1}/{count}: {error_msg}")
+                continue
+            if getattr(img, 'temperature', None) is not None:
+                temperatures.append(img.temperature)
+            if method == 'mean':
+                stacker.add(img)
+            else:
+                frame = frame_array(img)
+                if stack is None:
+                    # The frames wait on disk, not in RAM - only a band of rows is read back at a time
+                    os.makedirs(CALIBRATION_DIR, exist_ok=True)
+                    handle, stack_path = tempfile.mkstemp(prefix=f'{kind}_frames_', suffix='.tmp', dir=CALIBRATION_DIR)
+                    os.close(handle)
+                    stack = np.memmap(stack_path, dtype=frame.dtype, mode='w+', shape=(count,) + frame.shape)
+                stack[captured] = frame
+            captured += 1
+            calibration_state['captured'] = captured
+            print(f"[Calibration] Captured {kind} {captured}/{count}")
+        
+        if captured == 0:
+            calibration_state['error'] = f'No {kind} frames captured'
+            return
+        calibration_state['state'] = 'building'
+        master = chunked_median(stack[:captured]) if method == 'median' else stacker.result()
+        temperature = sum(temperatures) / len(temperatures) if temperatures else None
+        if kind == 'flat':
+            # Flats are stored dark-subtracted when a dark for the flat exposure exists
+            dark_key = calibration.find('dark', exposure, gain, settings.bin, img_format, temperature)
+            dark = calibration.load(dark_key) if dark_key else None
+            if dark is not None and dark.shape == master.shape:
+                np.subtract(master, np.minimum(master, dark), out=master)
+        key = master_key(kind, exposure, gain, settings.bin, img_format, temperature)
+        path = calibration.save(key, master, storage)
+        calibration_state['last_master'] = os.path.basename(path)
+        print(f"[Calibration] Master {kind} from {captured} frames ({method}) saved to {path}")
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        calibration_state['error'] = f'Exception: {str(e)}'
+    finally:
+        if stack is not None:
+            del stack
+        if stack_path is not None:
+            os.remove(stack_path)
+        calibration_state['active'] = False
+        calibration_state['state'] = 'idle'
+
+def save_sequence_frame(img):
+    """Count a captured sequence frame and queue it for encoding/saving"""
+    img = calibrate_frame(img)
+    sequence_state['current_count'] += 1
+    count = sequence_state['current_count']
+    total = sequence_state['total_count']
+    
+    # Generate filename (settings from the frame itself - they may have changed since it was taken)
+    date_formatter = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    gain = img.gain
+    exposure = img.exposure_us / 1000000.0  # Convert to seconds
     
+    file_format = sequence_state['file_format'].lower()
+    if file_format == 'jpeg':
+        file_format = 'jpg'
+    
+    filename = f"{date_formatter}_seq{count:04d}of{total:04d}_gain{gain}_exp{exposure:.3f}s.{file_format}"
+    filepath = os.path.join(sequence_state['save_path'], filename)
+    
+    # FITS metadata comes from the frame itself, so later settings changes cannot leak into it
+    header = fits_header(img) if sequence_state['file_format'] == 'FITS' else ()
+    
+    if sequence_state['stack']:
+        live_stack.add(img, header or (fits_header(img) if not live_stack.frames else ()))
+    
+    # Encode and save in the background - the next exposure starts right away
+    sequence_writer.submit(img, filepath, sequence_state['file_format'], header)
+
+def burst_capture(count):
+    """Burst-capture up to count sequence frames; returns (frames saved, frames lost).
+
+    The camera thread only reads frames and hands them over a bounded queue;
+    calibration, stacking and queueing for the writer run here on the sequence
+    thread, so they never stall the ASIGetVideoData loop. A frame that finds
+    the queue full is dropped (counted as a host drop) rather than waited for.
+    """
+    frames = queue.Queue(maxsize=BURST_HANDOFF_QUEUE)
+    overflow = 0
+    
+    def hand_off(img):
+        nonlocal overflow
+        try:
+            frames.put_nowait(img)
+        except queue.Full:
+            overflow += 1
+    
+    future = camera_executor.submit(camera.capture_burst, count, hand_off, lambda: sequence_state['active'],
+                                    resume_stream=False, priority=PRIORITY_SEQUENCE)
+    while True:
+        try:
+            img = frames.get(timeout=0.05)
+        except queue.Empty:
+            if future.done() and frames.empty():
+                break
+            continue
+        save_sequence_frame(img)
+    captured, dropped = future.result()
+    if overflow:
+        print(f"[Sequence] Burst hand-off queue full, dropped {overflow} frames")
+        drop_tracker.record_host_skip(overflow)
+    return captured - overflow, dropped + overflow
+
+def wait_until(deadline):
+    """Sleep until the time.monotonic() deadline; returns False early if the sequence is stopped"""
+    while sequence_state['active']:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return True
+        time.sleep(min(remaining, 0.25))
+    return False
+
+def sequence_capture_loop():
+    """Background thread for sequence capture - encoding/saving runs in sequence_writer
+
+    Time-lapse frames are triggered on absolute deadlines (start + n * interval),
+    so exposure, readout and encode time do not add up to drift. Slots that
+    have already passed are skipped and counted. The preview stream is only
+    paused between frames and resumed when the gap to the next frame is at
+    least TIMELAPSE_STREAM_RESUME_GAP, otherwise at the end of the sequence.
+    """
+    sequence_writer.start()
+    interval = sequence_state.get('interval', 0)  # Get interval (0 = fast mode)
+    schedule_start = time.monotonic()
+    slot = 0  # Index of the next time-lapse slot
     while sequence_state['active']:
         try:
             if sequence_state['current_count'] >= sequence_state['total_count']:
@@ -677,81 +3728,47 @@ def sequence_capture_loop():
                 print(f"[Sequence] Completed {sequence_state['current_count']}/{sequence_state['total_count']} photos")
                 break
             
-            # Capture photo
-            was_streaming = camera.streaming
-            if was_streaming:
-                camera.stop_stream()
-                time.sleep(1.0)
-                
-                # Ensure camera is idle
-                status = ctypes.c_int(0)
-                asi_lib.ASIGetExpStatus(camera.camera_id, ctypes.byref(status))
-                if status.value != 0:
-                    asi_lib.ASIStopExposure(camera.camera_id)
-                    time.sleep(0.5)
-            
-            # Apply format if needed
-            photo_format = camera_state['image_format']
-            width = camera_state['width']
-            height = camera_state['height']
-            format_applied = False
-            
-            if photo_format != ASI_IMG_RGB24:
-                asi_lib.ASISetROIFormat(camera.camera_id, width, height, 1, photo_format)
-                format_applied = True
+            if interval == 0 and sequence_state['burst']:
+                # Burst: frames straight from video mode; returns early if a snapshot/settings change is queued
+                remaining = sequence_state['total_count'] - sequence_state['current_count']
+                captured, dropped = burst_capture(remaining)
+                sequence_state['burst_dropped'] += dropped
+                if captured == 0 and sequence_state['active'] and not camera_executor.has_waiting(PRIORITY_SEQUENCE):
+                    print(f"[Sequence] Burst capture returned no frames, retrying in 1s")
+                    time.sleep(1.0)
+                continue
             
-            # Capture
-            img = camera.capture_snapshot()
+            resume_stream = False  # Fast mode: keep the stream paused until the sequence ends
+            if interval > 0:
+                deadline = schedule_start + slot * interval
+                if not wait_until(deadline):
+                    break
+                lateness = time.monotonic() - deadline
+                if lateness >= interval:
+                    # Previous frame overran its slot(s): skip them instead of bunching frames up
+                    missed = int(lateness // interval)
+                    slot += missed
+                    deadline += missed * interval
+                    lateness -= missed * interval
+                    sequence_state['slots_skipped'] += missed
+                    print(f"[Sequence] Running late, skipped {missed} time-lapse slot(s)")
+                slot += 1
+                sequence_state['slots_triggered'] += 1
+                sequence_state['lateness_last'] = lateness
+                sequence_state['lateness_max'] = max(sequence_state['lateness_max'], lateness)
+                sequence_state['lateness_total'] += lateness
+                sequence_state['next_deadline'] = schedule_start + slot * interval
+                # Resume preview only if it would run for a while before the next frame
+                gap = sequence_state['next_deadline'] - time.monotonic() - camera_state['exposure'] / 1e6
+                resume_stream = gap >= TIMELAPSE_STREAM_RESUME_GAP
             
-            # Restore format if needed
-            if was_streaming and format_applied:
-                asi_lib.ASISetROIFormat(camera.camera_id, width, height, 1, ASI_IMG_RGB24)
-                time.sleep(0.3)
-            
-            if was_streaming:
-                camera.start_stream()
+            # Capture photo (user snapshots and settings changes run first)
+            img, error_msg = take_snapshot(priority=PRIORITY_SEQUENCE, resume_stream=resume_stream)
             
             if img:
-                # Generate filename
-                sequence_state['current_count'] += 1
-                count = sequence_state['current_count']
-                total = sequence_state['total_count']
-                
-                date_formatter = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                gain = camera_state['gain']
-                exposure = camera_state['exposure'] / 1000000.0  # Convert to seconds
-                
-                file_format = sequence_state['file_format'].lower()
-                if file_format == 'jpeg':
-                    file_format = 'jpg'
-                
-                filename = f"{date_formatter}_seq{count:04d}of{total:04d}_gain{gain}_exp{exposure:.3f}s.{file_format}"
-                filepath = os.path.join(sequence_state['save_path'], filename)
-                
-                # Save image
-                if sequence_state['file_format'] == 'JPEG':
-                    img.save(filepath, 'JPEG', quality=100)
-                elif sequence_state['file_format'] == 'PNG':
-                    img.save(filepath, 'PNG')
-                elif sequence_state['file_format'] == 'TIFF':
-                    img.save(filepath, 'TIFF')
-                
-                print(f"[Sequence] Saved photo {count}/{total}: {filename}")
+                save_sequence_frame(img)
             else:
-                print(f"[Sequence] Failed to capture photo {sequence_state['current_count'] + 1}/{sequence_state['total_count']}")
-            
-            # Wait between photos
-            interval = sequence_state.get('interval', 0)  # Get interval (0 = fast mode)
-            if interval > 0:
-                # Time-lapse mode: use fixed interval
-                wait_time = interval
-                print(f"[Sequence] Waiting {wait_time} seconds until next photo (time-lapse mode)")
-            else:
-                # Fast mode: at least exposure time + some buffer
-                exposure_ms = camera_state['exposure'] / 1000.0
-                wait_time = max(exposure_ms / 1000.0 + 0.5, 1.0)  # At least 1 second between photos
-                print(f"[Sequence] Waiting {wait_time:.2f} seconds until next photo (fast mode)")
-            time.sleep(wait_time)
+                print(f"[Sequence] Failed to capture photo {sequence_state['current_count'] + 1}/{sequence_state['total_count']}: {error_msg}")
             
         except Exception as e:
             print(f"[Sequence] Error during capture: {e}")
@@ -759,11 +3776,48 @@ def sequence_capture_loop():
             traceback.print_exc()
             time.sleep(1.0)
     
-    print(f"[Sequence] Sequence capture stopped")
     sequence_state['active'] = False
+    sequence_state['next_deadline'] = None
+    if camera.stream_paused:
+        print("[Sequence] Resuming stream")
+        camera.start_stream()
+    sequence_writer.finish()
+    print(f"[Sequence] Sequence capture stopped ({sequence_state['saved_count']} photos saved)")
+
+# The only thread that talks to the SDK - everything else submits commands
+camera_executor = CameraExecutor()
 
 # Global camera instance
 camera = ASICamera()
+camera_executor.idle_task = camera.capture_preview_frame
+
+# Dropped-frame accounting for the video stream
+drop_tracker = DropTracker()
+
+# Reusable frame buffers for video and snapshot capture
+frame_pool = FrameBufferPool()
+
+# Shared MJPEG encoder/fan-out for /camera/stream
+broadcaster = FrameBroadcaster()
+metric_stream_clients.labels().set_function(lambda: broadcaster.clients)
+stream_client_ids = itertools.count(1)
+
+# Encoder/writer pool for sequence frames
+sequence_writer = SequenceWriter()
+metric_sequence_write_queue.labels().set_function(lambda: sequence_writer.queue.qsize())
+
+# Files written by sequences, listed on /captures
+capture_index = CaptureIndex()
+thumbnails = ThumbnailCache()
+
+# Optional running stack of the current sequence, served on /camera/sequence/stack
+live_stack = LiveStacker()
+
+# Master darks/flats (POST /camera/calibration/capture) applied by calibrate_frame
+calibration = CalibrationLibrary()
+
+# Long exposures run in the background; clients poll /camera/jobs/<id>
+exposure_jobs = ExposureJobStore()
 
 # API Routes
 @app.route('/status', methods=['GET'])
@@ -779,7 +3833,8 @@ def get_status():
                 'connected': camera_state['connected'],
                 'streaming': camera_state['streaming'],
                 'lastSnapshot': datetime.now().isoformat() if camera_state['current_frame'] else None,
-                'fault': camera_state['error']
+                'fault': camera_state['error'],
+                'droppedFrames': drop_tracker.summary()
             }
         }
         # No 'roof', 'safety', or 'alerts' - this controller doesn't handle those
@@ -807,108 +3862,109 @@ def start_stream():
 
 @app.route('/camera/stream/stop', methods=['POST'])
 def stop_stream():
-    """Stop video stream"""
-    camera.stop_stream()
+    """Stop video stream (after the exposure in progress, if any, without waiting for it)"""
+    future = camera_executor.submit(camera.stop_stream)
+    if camera_executor.operation_running():
+        return jsonify({'success': True, 'deferred': True, 'message': 'Stream stops after the current exposure'})
+    future.result()
     return jsonify({'success': True, 'message': 'Stream stopped'})
 
-@app.route('/camera/snapshot', methods=['GET'])
-def snapshot():
-    """Get a snapshot - automatically stops/resumes stream if needed"""
-    print(f"[Snapshot] Request. Streaming: {camera_state['streaming']}")
-    
+CaptureSettings = namedtuple('CaptureSettings', ['width', 'height', 'bin', 'img_format', 'exposure'])
+
+def capture_settings(target='photo'):
+    """CaptureSettings for a snapshot taken for target (see CALIBRATION_TARGETS).
+
+    photo: the full, unbinned frame in the photo format at the photo exposure.
+    stream: the whole sensor at the video bin in RGB24 at the video exposure, read
+    from start position (0, 0) - what stream frames look like, so a stream ROI can
+    use its window of a master taken this way (see calibrate_preview).
+    """
+    if target == 'stream':
+        bin_value = camera_state['bin']
+        width = camera_state['max_width'] // bin_value
+        height = camera_state['max_height'] // bin_value
+        return CaptureSettings(width - width % 8, height - height % 2, bin_value, ASI_IMG_RGB24,
+                               camera_state['video_exposure'])
+    return CaptureSettings(camera_state['max_width'], camera_state['max_height'], 1,
+                           camera_state['image_format'], camera_state['exposure'])
+
+def take_snapshot(on_exposure_start=None, priority=PRIORITY_SNAPSHOT, resume_stream=True, dark=False, target='photo'):
+    """Capture one photo, stopping and resuming the stream around it.
+
+    Returns (image, None) or (None, error message). Shared by /camera/snapshot,
+    the exposure jobs and sequence capture; runs as a camera operation so the
+    stop/capture/resume steps cannot interleave with other commands, while
+    concurrent commands (disconnect) still run during the exposure. With
+    resume_stream=False a running stream is only paused (see
+    ASICamera.stop_stream) and left for the caller to resume. dark and target
+    are passed to capture_snapshot. The image is not calibrated (see calibrate_frame).
+    """
+    return camera_executor.call(snapshot_steps, on_exposure_start, resume_stream, dark, target, priority=priority)
+
+def snapshot_steps(on_exposure_start=None, resume_stream=True, dark=False, target='photo'):
+    """Operation steps for take_snapshot (camera thread)"""
     # Check if camera is connected
     if not camera_state['connected'] or not camera.is_open:
-        error_msg = "Camera not connected"
-        print(f"[Snapshot] Error: {error_msg}")
-        return jsonify({'error': error_msg}), 500
+        return None, "Camera not connected"
     
-    # Remember if we were streaming
-    was_streaming = camera.streaming
+    # Remember if we were streaming (a stream paused by a sequence counts)
+    was_streaming = camera.streaming or camera.stream_paused
     
     try:
         # MUST stop video capture before exposure mode
-        if was_streaming:
+        if camera.streaming:
             print("[Snapshot] Stopping stream for capture...")
-            camera.stop_stream()
-            time.sleep(0.5)
-        
-        # Apply image format for photo capture (video stream always uses RGB24)
-        photo_format = camera_state['image_format']
-        width = camera_state['width']
-        height = camera_state['height']
-        format_applied = False
+            camera.stop_stream(pause=not resume_stream)
         
-        if photo_format != ASI_IMG_RGB24:
-            # Apply format for photo capture
-            result = asi_lib.ASISetROIFormat(camera.camera_id, width, height, 1, photo_format)
-            if result != ASI_SUCCESS:
-                error_names = {
-                    1: "ASI_ERROR_INVALID_INDEX",
-                    2: "ASI_ERROR_INVALID_ID", 
-                    3: "ASI_ERROR_INVALID_CONTROL_TYPE",
-                    4: "ASI_ERROR_CAMERA_CLOSED",
-                    5: "ASI_ERROR_CAMERA_REMOVED",
-                    9: "ASI_ERROR_INVALID_IMGTYPE",
-                    10: "ASI_ERROR_OUTOF_BOUNDARY",
-                    14: "ASI_ERROR_VIDEO_MODE_ACTIVE",
-                    15: "ASI_ERROR_EXPOSURE_IN_PROGRESS",
-                    16: "ASI_ERROR_GENERAL_ERROR"
-                }
-                error_name = error_names.get(result, f"UNKNOWN_ERROR_{result}")
-                error_msg = f"Failed to set ROI format: {result} ({error_name})"
-                print(f"[Snapshot] Error: {error_msg}")
-                # Try to restore stream if it was running
-                if was_streaming:
-                    try:
-                        camera.start_stream()
-                    except:
-                        pass
-                return jsonify({'error': error_msg}), 500
-            format_applied = True
-            print(f"[Snapshot] Applied image format {photo_format} for photo capture")
-            # Wait for format to be applied
-            time.sleep(0.3)
-            
-            # Ensure camera is idle after format change
-            status = ctypes.c_int(0)
-            asi_lib.ASIGetExpStatus(camera.camera_id, ctypes.byref(status))
-            if status.value != 0:
-                print(f"[Snapshot] Camera not idle after format change (status: {status.value}), waiting...")
-                timeout = 0
-                while status.value != 0 and timeout < 3000:  # Wait up to 3 seconds
-                    time.sleep(0.1)
-                    asi_lib.ASIGetExpStatus(camera.camera_id, ctypes.byref(status))
-                    timeout += 100
-                if status.value != 0:
-                    print(f"[Snapshot] Warning: Camera still not idle after format change, forcing stop...")
-                    asi_lib.ASIStopExposure(camera.camera_id)
-                    time.sleep(0.5)
+        # Apply the photo format and full unbinned frame on every capture (video stream always uses
+        # RGB24 at the video ROI); the ROI shadow register makes this free when nothing changed
+        settings = capture_settings(target)
+        photo_format = settings.img_format
+        if target == 'photo':
+            result = camera.set_photo_format(photo_format)
+        else:
+            result = camera.set_roi_format(settings.width, settings.height, settings.bin, photo_format)
+            if result == ASI_SUCCESS:
+                result = camera.set_start_pos(0, 0)
+        if result != ASI_SUCCESS:
+            error_names = {
+                1: "ASI_ERROR_INVALID_INDEX",
+                2: "ASI_ERROR_INVALID_ID", 
+                3: "ASI_ERROR_INVALID_CONTROL_TYPE",
+                4: "ASI_ERROR_CAMERA_CLOSED",
+                5: "ASI_ERROR_CAMERA_REMOVED",
+                9: "ASI_ERROR_INVALID_IMGTYPE",
+                10: "ASI_ERROR_OUTOF_BOUNDARY",
+                14: "ASI_ERROR_VIDEO_MODE_ACTIVE",
+                15: "ASI_ERROR_EXPOSURE_IN_PROGRESS",
+                16: "ASI_ERROR_GENERAL_ERROR"
+            }
+            error_name = error_names.get(result, f"UNKNOWN_ERROR_{result}")
+            # Try to restore stream if it was running
+            if was_streaming:
+                try:
+                    camera.start_stream()
+                except:
+                    pass
+            return None, f"Failed to set ROI format: {result} ({error_name})"
         
-        print(f"[Snapshot] Capturing with exposure: {camera_state['exposure']} μs ({camera_state['exposure']/1000000:.3f} s), format: {photo_format}")
-        img = camera.capture_snapshot()
+        print(f"[Snapshot] Capturing with exposure: {settings.exposure} μs ({settings.exposure/1000000:.3f} s), format: {photo_format}, bin: {settings.bin}")
+        try:
+            img = yield from camera.exposure_steps(on_exposure_start, dark, target)
+        except OperationAborted as e:
+            return None, f'Exposure aborted: {e}'
         
         # Restore RGB24 format if needed before resuming stream
-        if was_streaming:
-            if format_applied:
-                # Restore RGB24 for video streaming
-                asi_lib.ASISetROIFormat(camera.camera_id, width, height, 1, ASI_IMG_RGB24)
-                print("[Snapshot] Restored RGB24 format for video streaming")
-                time.sleep(0.3)
+        if was_streaming and resume_stream:
+            # Restore RGB24 and the video ROI for streaming
+            camera.set_video_roi()
             
             print("[Snapshot] Resuming stream...")
-            time.sleep(0.3)
             camera.start_stream()
         
-        if img:
-            img_io = io.BytesIO()
-            img.save(img_io, 'JPEG', quality=85)
-            img_io.seek(0)
-            print(f"[Snapshot] Success!")
-            return send_file(img_io, mimetype='image/jpeg')
-        else:
-            error_msg = 'Failed to capture snapshot - camera returned None'
-            print(f"[Snapshot] Error: {error_msg}")
-            return jsonify({'error': error_msg}), 500
+        if img is None:
+            return None, 'Failed to capture snapshot - camera returned None'
+        return img, None
             
     except Exception as e:
         import traceback
@@ -920,271 +3976,480 @@ def snapshot():
                 camera.start_stream()
             except:
                 pass
-        return jsonify({'error': f'Exception: {str(e)}'}), 500
+        return None, f'Exception: {str(e)}'
+
+def encode_snapshot(img):
+    """JPEG-encode a snapshot for download"""
+    encode_started = time.perf_counter()
+    img_io = io.BytesIO()
+    preview_8bit(img, snapshot_stretch).save(img_io, 'JPEG', quality=85)
+    metric_jpeg_encode_seconds.labels('snapshot').observe(time.perf_counter() - encode_started)
+    return img_io.getvalue()
+
+@app.route('/camera/snapshot', methods=['GET'])
+def snapshot():
+    """Get a snapshot - automatically stops/resumes stream if needed
+
+    Blocks for the whole exposure; use POST /camera/jobs for long exposures.
+    """
+    print(f"[Snapshot] Request. Streaming: {camera_state['streaming']}")
+    
+    img, error_msg = take_snapshot()
+    if img is None:
+        print(f"[Snapshot] Error: {error_msg}")
+        return jsonify({'error': error_msg}), 500
+    
+    jpeg = encode_snapshot(calibrate_frame(img))
+    print(f"[Snapshot] Success!")
+    return send_file(io.BytesIO(jpeg), mimetype='image/jpeg')
+
+def run_exposure_job(job):
+    """Background thread body for one exposure job"""
+    job.state = 'starting'
+    img, error_msg = take_snapshot(job.exposure_started_at)
+    if img is None:
+        print(f"[Jobs] Job {job.id} failed: {error_msg}")
+        exposure_jobs.finish(job, error=error_msg)
+        return
+    job.state = 'encoding'
+    try:
+        exposure_jobs.finish(job, result=encode_snapshot(calibrate_frame(img)))
+        print(f"[Jobs] Job {job.id} done")
+    except Exception as e:
+        exposure_jobs.finish(job, error=f'Exception: {str(e)}')
+
+@app.route('/camera/jobs', methods=['POST'])
+def create_exposure_job():
+    """Start a snapshot in the background and return its job ID right away
+
+    The job uses the current photo settings (exposure, gain, format). Poll
+    GET /camera/jobs/<id> for progress and fetch GET /camera/jobs/<id>/result
+    once the state is 'done'.
+    """
+    if not camera_state['connected'] or not camera.is_open:
+        return jsonify({'error': 'Camera not connected'}), 400
+    
+    job = exposure_jobs.create()
+    if job is None:
+        return jsonify({'error': f'Too many pending exposure jobs (limit {exposure_jobs.max_pending})'}), 429
+    print(f"[Jobs] Job {job.id} queued (exposure {camera_state['exposure']} μs)")
+    threading.Thread(target=run_exposure_job, args=(job,), daemon=True).start()
+    return jsonify(dict(job.to_dict(),
+                        status_url=f"/camera/jobs/{job.id}",
+                        result_url=f"/camera/jobs/{job.id}/result")), 202
+
+@app.route('/camera/jobs/<job_id>', methods=['GET'])
+def get_exposure_job(job_id):
+    """Progress of an exposure job (elapsed vs. expected exposure)"""
+    job = exposure_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/camera/jobs/<job_id>/result', methods=['GET'])
+def get_exposure_job_result(job_id):
+    """JPEG of a finished job - can be fetched repeatedly until the job expires"""
+    job = exposure_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found or expired'}), 404
+    if job.state == 'failed':
+        return jsonify({'error': job.error}), 500
+    if job.state != 'done':
+        return jsonify(dict(job.to_dict(), error='Job not finished')), 409
+    return send_file(io.BytesIO(job.result), mimetype='image/jpeg',
+                     download_name=f"snapshot_{job.id}.jpg")
 
 @app.route('/camera/stream', methods=['GET'])
 def video_stream():
-    """MJPEG video stream"""
+    """MJPEG video stream - all clients share one JPEG encode per captured frame and profile
+
+    Optional query parameters:
+      fps        - maximum frames per second sent to this client
+      max_width  - downscale frames (integer factor) so width <= max_width
+      quality    - JPEG quality 1-95 (default 75)
+    """
+    fps = request.args.get('fps', type=float)
+    max_width = request.args.get('max_width', type=int)
+    quality = request.args.get('quality', DEFAULT_STREAM_PROFILE.quality, type=int)
+    if fps is not None and not (0 < fps <= 120):
+        return jsonify({'error': 'fps must be between 0 and 120'}), 400
+    if max_width is not None and max_width < 16:
+        return jsonify({'error': 'max_width must be at least 16'}), 400
+    if not (1 <= quality <= 95):
+        return jsonify({'error': 'quality must be between 1 and 95'}), 400
+    
+    profile = StreamProfile(max_width=max_width, quality=quality)
+    min_interval = 1.0 / fps if fps else 0.0
+    
     def generate():
-        while camera_state['streaming']:
-            frame = camera.frame_buffer
-            if frame:
-                img_io = io.BytesIO()
-                frame.save(img_io, 'JPEG', quality=75)
-                img_io.seek(0)
+        last_sequence = 0
+        last_sent = 0.0
+        client_id = next(stream_client_ids)
+        fps_meter = RateMeter(metric_client_fps.labels(client_id))
+        write_seconds = metric_stream_write_seconds.labels()
+        broadcaster.subscribe(profile)
+        try:
+            while camera_state['streaming'] or camera.stream_paused:
+                # FPS cap: skip frames by sleeping until this client may send again
+                if min_interval:
+                    delay = last_sent + min_interval - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                # Sleep until the capture loop publishes a frame we have not sent yet
+                sequence, jpeg = broadcaster.wait_for_frame(last_sequence, profile, timeout=1.0)
+                if jpeg is None:
+                    continue
+                last_sequence = sequence
+                last_sent = time.monotonic()
+                # The WSGI server writes the chunk to the socket before resuming us
+                started = time.perf_counter()
+                # Per-part metadata: frame sequence and running dropped-frame totals
+                meta = (f'X-Frame-Sequence: {sequence}\r\n'
+                        f'X-Dropped-Frames-SDK: {drop_tracker.sdk_total}\r\n'
+                        f'X-Skipped-Frames-Host: {drop_tracker.host_total}\r\n').encode('ascii')
                 yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + img_io.read() + b'\r\n')
-                
-                # Minimal sleep to prevent CPU overload, but let camera capture rate control FPS
-                # The actual FPS will be determined by the camera's exposure time and capture speed
-                time.sleep(0.005)  # 5ms sleep - much shorter than before to allow higher FPS
-            else:
-                # No frame available, short sleep to avoid busy waiting
-                time.sleep(0.01)
+                       b'Content-Type: image/jpeg\r\n' + meta + b'\r\n' + jpeg + b'\r\n')
+                write_seconds.observe(time.perf_counter() - started)
+                fps_meter.tick()
+        finally:
+            broadcaster.unsubscribe(profile)
+            metric_client_fps.remove(client_id)
+    
+    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/camera/stream/drops', methods=['GET'])
+def stream_drops():
+    """Dropped-frame totals and the per-second rolling window (bandwidth/exposure included)"""
+    seconds = request.args.get('seconds', 60, type=int)
+    return jsonify({
+        'summary': drop_tracker.summary(max(1, seconds)),
+        'history': drop_tracker.history()
+    })
+
+def roi_response():
+    """Current video ROI as returned by /camera/roi"""
+    return {
+        'bin': camera_state['bin'],
+        'width': camera_state['width'],
+        'height': camera_state['height'],
+        'start_x': camera_state['start_x'],
+        'start_y': camera_state['start_y'],
+        'max_width': camera_state['max_width'],
+        'max_height': camera_state['max_height'],
+        'supported_bins': camera.supported_bins
+    }
+
+@app.route('/camera/roi', methods=['GET'])
+def get_roi():
+    """Get the video ROI (binning + sub-frame)"""
+    return jsonify(roi_response())
+
+@app.route('/camera/roi', methods=['POST'])
+def set_roi():
+    """Set video binning and sub-frame for streaming - photos always use the full frame
+
+    JSON body: bin (default 1), width/height (binned pixels, default full frame),
+    start_x/start_y (binned pixels, default centred).
+    """
+    data = request.get_json(silent=True) or {}
+    print(f"[ROI] Request received: {data}")
     
-    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    try:
+        roi = camera.normalize_roi(
+            data.get('bin', 1),
+            data.get('width'),
+            data.get('height'),
+            data.get('start_x'),
+            data.get('start_y')
+        )
+    except (ValueError, TypeError) as e:
+        print(f"[ROI] Error: {e}")
+        return jsonify({'error': str(e)}), 400
+    
+    future = camera_executor.submit(apply_roi, roi)
+    if camera_executor.operation_running():
+        # Applied once the exposure in progress is read out - don't hold the request for it
+        return jsonify(dict(roi_response(), **roi, success=True, deferred=True))
+    if not future.result():
+        return jsonify({'error': camera_state['error'] or 'Failed to restart stream with new ROI'}), 500
+    
+    return jsonify(dict(roi_response(), success=True))
 
-@app.route('/camera/settings', methods=['POST'])
-def update_settings():
-    """Update camera settings"""
-    from flask import request
-    data = request.get_json()
-    print(f"[Settings] Request received: {data}")
+def apply_roi(roi):
+    """Switch the video ROI, restarting the stream if it is running (camera thread)"""
+    was_streaming = camera.streaming
+    if was_streaming:
+        camera.stop_stream()
     
-    updated = []
+    camera_state.update(roi)
+    print(f"[ROI] Video ROI: bin {roi['bin']}, {roi['width']}x{roi['height']} at ({roi['start_x']}, {roi['start_y']})")
     
+    # start_stream applies the new ROI; when idle it is applied at the next stream start
+    return not was_streaming or camera.start_stream()
+
+@app.route('/camera/controls', methods=['GET'])
+def get_controls():
+    """Control limits from ASIGetControlCaps with the current (shadowed) values - answered during exposures too"""
+    if not camera.is_open:
+        return jsonify({'error': 'Camera not connected'}), 400
+    values = camera.read_controls()
+    controls = []
+    for control, caps in sorted(camera.control_caps.items()):
+        value, auto = values.get(control, (None, None))
+        controls.append(dict(caps, control_type=control, value=value, auto=bool(auto)))
+    return jsonify({'controls': controls})
+
+# Controls the SDK reliably applies while video capture is running.
+# Gamma, white balance and video exposure only take effect after a stream restart.
+LIVE_SETTABLE_CONTROLS = {ASI_GAIN}
+
+CONTROL_NAMES = {
+    ASI_GAIN: 'gain',
+    ASI_EXPOSURE: 'video_exposure',
+    ASI_GAMMA: 'gamma',
+    ASI_WB_R: 'wb_r',
+    ASI_WB_B: 'wb_b'
+}
+
+def parse_settings(data):
+    """Validate a settings request and return the new camera_state values.
+
+    Raises ValueError/TypeError without touching camera_state, so a request is
+    applied completely or not at all. Values are checked against the camera's
+    ASIGetControlCaps limits once connected.
+    """
+    format_map = {
+        'RGB24': ASI_IMG_RGB24,
+        'RAW8': ASI_IMG_RAW8,
+        'RAW16': ASI_IMG_RAW16,
+        'Y8': ASI_IMG_Y8
+    }
+    changes = {}
     if 'gain' in data:
-        gain = int(data['gain'])
-        camera_state['gain'] = gain
-        
-        # Remember if streaming
+        changes['gain'] = camera.validate_control(ASI_GAIN, data['gain'])
+    if 'gamma' in data:
+        if ASI_GAMMA in camera.control_caps:
+            changes['gamma'] = camera.validate_control(ASI_GAMMA, data['gamma'])
+        else:
+            # Limits unknown until connected - clamp gamma to the usual range (1-100)
+            changes['gamma'] = max(1, min(100, int(data['gamma'])))
+    if 'photo_exposure' in data:
+        changes['exposure'] = camera.validate_control(ASI_EXPOSURE, data['photo_exposure'])
+    if 'video_exposure' in data:
+        changes['video_exposure'] = camera.validate_control(ASI_EXPOSURE, data['video_exposure'])
+    if 'wb_auto' in data:
+        changes['wb_auto'] = bool(data['wb_auto'])
+    # Manual white balance values only count while auto white balance is off (after this request)
+    wb_auto = changes.get('wb_auto', camera_state.get('wb_auto', False))
+    for key in ('wb_r', 'wb_b'):
+        if key in data:
+            if wb_auto:
+                print(f"[Settings] Ignoring {key} change: auto white balance is enabled")
+            else:
+                changes[key] = camera.validate_control(ASI_WB_R if key == 'wb_r' else ASI_WB_B, data[key])
+    if 'demosaic' in data:
+        if data['demosaic'] not in DEMOSAIC_MODES:
+            raise ValueError(f"demosaic must be one of: {', '.join(DEMOSAIC_MODES)}")
+        changes['demosaic'] = data['demosaic']
+    for key in ('calibrate', 'calibrate_stream'):
+        if key in data:
+            changes[key] = bool(data[key])
+    if 'stretch' in data:
+        if data['stretch'] not in STRETCH_MODES:
+            raise ValueError(f"stretch must be one of: {', '.join(STRETCH_MODES)}")
+        changes['stretch'] = data['stretch']
+    if 'image_format' in data:
+        format_str = data['image_format']
+        if format_str not in format_map:
+            raise ValueError(f"Invalid image format: {format_str}")
+        # Note: Image format is only applied when capturing photos, not for video streaming
+        # Video stream always uses RGB24 for real-time performance
+        changes['image_format'] = format_map[format_str]
+    return changes
+
+def control_writes(changes):
+    """SDK control writes (control, value, auto) needed for a set of camera_state changes"""
+    writes = []
+    if 'gain' in changes:
+        writes.append((ASI_GAIN, changes['gain'], ASI_FALSE))
+    if 'gamma' in changes:
+        writes.append((ASI_GAMMA, changes['gamma'], ASI_FALSE))
+    if 'video_exposure' in changes:
+        # Manual exposure mode for video - ASI_AUTO_MAX_EXP is not needed
+        writes.append((ASI_EXPOSURE, changes['video_exposure'], ASI_FALSE))
+    if camera.is_color_cam and any(k in changes for k in ('wb_auto', 'wb_r', 'wb_b')):
+        if camera_state.get('wb_auto', False):
+            writes.append((ASI_WB_R, 0, ASI_TRUE))
+            writes.append((ASI_WB_B, 0, ASI_TRUE))
+        else:
+            writes.append((ASI_WB_R, camera_state.get('wb_r', 50), ASI_FALSE))
+            writes.append((ASI_WB_B, camera_state.get('wb_b', 50), ASI_FALSE))
+    return writes
+
+def apply_settings(changes):
+    """Apply a batch of camera_state changes to the camera (camera thread).
+
+    Runs as one merged command: settings requests queued behind a snapshot or
+    another batch are folded into a single write/restart.
+    """
+    camera_state.update(changes)
+    applied_live = []
+    applied_on_restart = []
+    restarted = False
+    
+    if camera.is_open:
+        writes = control_writes(changes)
         was_streaming = camera_state['streaming']
         print(f"[Settings] Current streaming state: {was_streaming}")
         
-        if camera.is_open:
-            # Try to set gain directly if streaming (may work without restart on some SDKs)
-            result = asi_lib.ASISetControlValue(camera.camera_id, ASI_GAIN, gain, ASI_FALSE)
-            
-            # Verify it was set
-            actual_gain = ctypes.c_long(0)
-            auto_gain = ctypes.c_int(0)
-            asi_lib.ASIGetControlValue(camera.camera_id, ASI_GAIN, ctypes.byref(actual_gain), ctypes.byref(auto_gain))
-            
-            print(f"[Settings] Set gain to {gain} (result: {result}, actual: {actual_gain.value}, auto: {auto_gain.value})")
-            
-            # If streaming and gain didn't take effect, restart stream
-            if was_streaming:
-                # Check if gain actually changed
-                if actual_gain.value != gain:
-                    print(f"[Settings] Gain not applied during streaming, restarting stream...")
-                    camera.stop_stream()
-                    time.sleep(0.5)
-                    result = asi_lib.ASISetControlValue(camera.camera_id, ASI_GAIN, gain, ASI_FALSE)
-                    time.sleep(0.2)
-                    success = camera.start_stream()
-                    print(f"[Settings] Stream restart result: {success}, State: {camera_state['streaming']}")
+        if not was_streaming:
+            # Not streaming: every control can be written now; photo exposure/format are read at capture time
+            for control, value, auto in writes:
+                result = camera.set_control(control, value, auto)
+                print(f"[Settings] Set {CONTROL_NAMES.get(control, control)} to {value} (auto: {auto}, result: {result})")
+                applied_live.append(CONTROL_NAMES.get(control, str(control)))
+        else:
+            needs_restart = []
+            for control, value, auto in writes:
+                name = CONTROL_NAMES.get(control, str(control))
+                if control not in LIVE_SETTABLE_CONTROLS:
+                    needs_restart.append(name)
+                    continue
+                result = camera.set_control(control, value, auto)
+                print(f"[Settings] Set {name} to {value} live (result: {result})")
+                if result == ASI_SUCCESS:
+                    applied_live.append(name)
                 else:
-                    print(f"[Settings] Gain updated successfully without stream restart")
-            
-            updated.append(f"gain={gain}")
-            
-    if 'gamma' in data:
-        gamma = int(data['gamma'])
-        # Clamp gamma to valid range (1-100)
-        gamma = max(1, min(100, gamma))
-        camera_state['gamma'] = gamma
-        print(f"[Settings] Setting gamma: {gamma}")
-        
-        if camera.is_open:
-            result_gamma = asi_lib.ASISetControlValue(camera.camera_id, ASI_GAMMA, gamma, ASI_FALSE)
+                    needs_restart.append(name)
             
-            # Verify it was set
-            actual_gamma = ctypes.c_long(0)
-            auto_gamma = ctypes.c_int(0)
-            asi_lib.ASIGetControlValue(camera.camera_id, ASI_GAMMA, ctypes.byref(actual_gamma), ctypes.byref(auto_gamma))
-            
-            print(f"[Settings] Set gamma to {gamma} (result: {result_gamma}, actual: {actual_gamma.value})")
-            
-            # If streaming, restart to apply gamma
-            was_streaming = camera_state['streaming']
-            if was_streaming:
-                print(f"[Settings] Restarting stream to apply gamma...")
+            if needs_restart:
+                # One restart for the whole batch - start_stream applies every control from camera_state
+                print(f"[Settings] Restarting stream once to apply: {', '.join(needs_restart)}")
                 camera.stop_stream()
-                time.sleep(0.5)
                 success = camera.start_stream()
+                restarted = True
+                applied_on_restart = needs_restart
                 print(f"[Settings] Stream restart result: {success}, State: {camera_state['streaming']}")
-            
-            updated.append(f"gamma={gamma}")
     
-    if 'photo_exposure' in data:
-        exposure_us = int(data['photo_exposure'])
-        camera_state['exposure'] = exposure_us
-        print(f"[Settings] Set photo exposure: {exposure_us} μs = {exposure_us/1000000:.3f} s")
-        updated.append(f"photo_exposure={exposure_us}us")
-    
-    if 'video_exposure' in data:
-        video_exposure_us = int(data['video_exposure'])
-        camera_state['video_exposure'] = video_exposure_us
-        
-        # Remember if streaming
-        was_streaming = camera_state['streaming']
-        print(f"[Settings] Setting video exposure: {video_exposure_us} μs ({video_exposure_us/1000:.1f} ms)")
-        
-        if camera.is_open:
-            # Video exposure requires stream restart to take effect (manual exposure mode)
-            if was_streaming:
-                print(f"[Settings] Stopping stream to apply video exposure...")
-                camera.stop_stream()
-                time.sleep(0.5)
-            
-            # Set ASI_EXPOSURE directly (manual exposure mode for video)
-            # Set ASI_EXPOSURE directly as we are in manual exposure mode
-            # Note: ASI_AUTO_MAX_EXP is not needed in manual mode
-            result_exp = asi_lib.ASISetControlValue(camera.camera_id, ASI_EXPOSURE, video_exposure_us, ASI_FALSE)
-            
-            # Verify ASI_EXPOSURE was set
-            actual_exp = ctypes.c_long(0)
-            auto_exp = ctypes.c_int(0)
-            asi_lib.ASIGetControlValue(camera.camera_id, ASI_EXPOSURE, ctypes.byref(actual_exp), ctypes.byref(auto_exp))
-            
-            print(f"[Settings] Set ASI_EXPOSURE to {video_exposure_us} μs (result: {result_exp}, actual: {actual_exp.value} μs, auto: {auto_exp.value})")
-            
-            # Restart stream if it was active
-            if was_streaming:
-                print(f"[Settings] Restarting stream with new video exposure...")
-                time.sleep(0.5)
-                success = camera.start_stream()
-                print(f"[Settings] Stream restart result: {success}, State: {camera_state['streaming']}")
-            
-            updated.append(f"video_exposure={video_exposure_us}us")
+    return {
+        'applied_live': applied_live,
+        'applied_on_restart': applied_on_restart,
+        'restarted': restarted
+    }
+
+@app.route('/camera/settings', methods=['POST'])
+def update_settings():
+    """Update camera settings as one batch.
+
+    All changed controls are computed first. While streaming, controls the SDK
+    accepts live are written directly; everything else is applied by a single
+    stream stop/start at the end. The response lists which changes were
+    applied live and which needed the restart.
+    """
+    data = request.get_json(silent=True) or {}
+    print(f"[Settings] Request received: {data}")
     
-    if 'wb_auto' in data:
-        wb_auto = bool(data['wb_auto'])
-        camera_state['wb_auto'] = wb_auto
-        print(f"[Settings] Setting white balance auto: {wb_auto}")
-        
-        if camera.is_open:
-            was_streaming = camera_state['streaming']
-            if was_streaming:
-                print(f"[Settings] Stopping stream to apply white balance mode...")
-                camera.stop_stream()
-                time.sleep(0.5)
-            
-            if wb_auto:
-                # Enable auto white balance
-                result_wb_r = asi_lib.ASISetControlValue(camera.camera_id, ASI_WB_R, 0, ASI_TRUE)
-                result_wb_b = asi_lib.ASISetControlValue(camera.camera_id, ASI_WB_B, 0, ASI_TRUE)
-                print(f"[Settings] Enabled auto white balance (R result: {result_wb_r}, B result: {result_wb_b})")
-            else:
-                # Disable auto and set manual values
-                wb_r = camera_state.get('wb_r', 50)
-                wb_b = camera_state.get('wb_b', 50)
-                result_wb_r = asi_lib.ASISetControlValue(camera.camera_id, ASI_WB_R, wb_r, ASI_FALSE)
-                result_wb_b = asi_lib.ASISetControlValue(camera.camera_id, ASI_WB_B, wb_b, ASI_FALSE)
-                print(f"[Settings] Disabled auto white balance, set manual R: {wb_r}, B: {wb_b}")
-            
-            # Restart stream if it was active
-            if was_streaming:
-                print(f"[Settings] Restarting stream with new white balance mode...")
-                time.sleep(0.5)
-                success = camera.start_stream()
-                print(f"[Settings] Stream restart result: {success}, State: {camera_state['streaming']}")
-            
-            updated.append(f"wb_auto={wb_auto}")
-    
-    if 'wb_r' in data:
-        # Only set manual values if auto is disabled
-        if not camera_state.get('wb_auto', False):
-            wb_r = int(data['wb_r'])
-            camera_state['wb_r'] = wb_r
-            print(f"[Settings] Setting white balance R: {wb_r}")
-            
-            if camera.is_open:
-                result_wb_r = asi_lib.ASISetControlValue(camera.camera_id, ASI_WB_R, wb_r, ASI_FALSE)
-                
-                # Verify it was set
-                actual_wb_r = ctypes.c_long(0)
-                auto_wb_r = ctypes.c_int(0)
-                asi_lib.ASIGetControlValue(camera.camera_id, ASI_WB_R, ctypes.byref(actual_wb_r), ctypes.byref(auto_wb_r))
-                
-                print(f"[Settings] Set white balance R to {wb_r} (result: {result_wb_r}, actual: {actual_wb_r.value})")
-                
-                # If streaming, restart to apply white balance
-                was_streaming = camera_state['streaming']
-                if was_streaming:
-                    print(f"[Settings] Restarting stream to apply white balance R...")
-                    camera.stop_stream()
-                    time.sleep(0.5)
-                    success = camera.start_stream()
-                    print(f"[Settings] Stream restart result: {success}, State: {camera_state['streaming']}")
-                
-                updated.append(f"wb_r={wb_r}")
-        else:
-            print(f"[Settings] Ignoring wb_r change: auto white balance is enabled")
-    
-    if 'wb_b' in data:
-        # Only set manual values if auto is disabled
-        if not camera_state.get('wb_auto', False):
-            wb_b = int(data['wb_b'])
-            camera_state['wb_b'] = wb_b
-            print(f"[Settings] Setting white balance B: {wb_b}")
-            
-            if camera.is_open:
-                result_wb_b = asi_lib.ASISetControlValue(camera.camera_id, ASI_WB_B, wb_b, ASI_FALSE)
-                
-                # Verify it was set
-                actual_wb_b = ctypes.c_long(0)
-                auto_wb_b = ctypes.c_int(0)
-                asi_lib.ASIGetControlValue(camera.camera_id, ASI_WB_B, ctypes.byref(actual_wb_b), ctypes.byref(auto_wb_b))
-                
-                print(f"[Settings] Set white balance B to {wb_b} (result: {result_wb_b}, actual: {actual_wb_b.value})")
-                
-                # If streaming, restart to apply white balance
-                was_streaming = camera_state['streaming']
-                if was_streaming:
-                    print(f"[Settings] Restarting stream to apply white balance B...")
-                    camera.stop_stream()
-                    time.sleep(0.5)
-                    success = camera.start_stream()
-                    print(f"[Settings] Stream restart result: {success}, State: {camera_state['streaming']}")
-                
-                updated.append(f"wb_b={wb_b}")
-        else:
-            print(f"[Settings] Ignoring wb_b change: auto white balance is enabled")
+    try:
+        changes = parse_settings(data)
+    except (ValueError, TypeError) as e:
+        print(f"[Settings] Invalid request: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 400
     
-    if 'image_format' in data:
-        format_map = {
-            'RGB24': ASI_IMG_RGB24,
-            'RAW8': ASI_IMG_RAW8,
-            'RAW16': ASI_IMG_RAW16,
-            'Y8': ASI_IMG_Y8
-        }
-        format_str = data['image_format']
-        if format_str in format_map:
-            new_format = format_map[format_str]
-            camera_state['image_format'] = new_format
-            print(f"[Settings] Set image format to {format_str} ({new_format})")
-            print(f"[Settings] Note: Image format only affects photo capture, video stream always uses RGB24")
-            updated.append(f"image_format={format_str}")
-            # Note: Image format is only applied when capturing photos, not for video streaming
-            # Video stream always uses RGB24 for real-time performance
-        else:
-            print(f"[Settings] Invalid image format: {format_str}")
+    updated = [f"{key}={data[key] if key == 'image_format' else value}" for key, value in changes.items()]
+    future = camera_executor.submit_merged('settings', apply_settings, changes)
+    if camera_executor.operation_running():
+        # The batch is applied once the exposure in progress is read out - don't hold the request for it
+        applied = {'applied_live': [], 'applied_on_restart': [], 'restarted': False, 'deferred': True}
+        state = dict(camera_state, **changes)
+    else:
+        applied = future.result()
+        state = camera_state
     
     # Get current format name
     format_names = {ASI_IMG_RGB24: 'RGB24', ASI_IMG_RAW8: 'RAW8', ASI_IMG_RAW16: 'RAW16', ASI_IMG_Y8: 'Y8'}
-    current_format_name = format_names.get(camera_state['image_format'], 'RGB24')
+    current_format_name = format_names.get(state['image_format'], 'RGB24')
     
-    print(f"[Settings] Updated: {', '.join(updated) if updated else 'nothing'}")
-    print(f"[Settings] State now - Gain: {camera_state['gain']}, Photo Exposure: {camera_state['exposure']} μs, Video Exposure: {camera_state['video_exposure']} μs, WB R: {camera_state.get('wb_r', 'N/A')}, WB B: {camera_state.get('wb_b', 'N/A')}, Format: {current_format_name}")
+    print(f"[Settings] Updated: {', '.join(updated) if updated else 'nothing'}{' (deferred)' if applied.get('deferred') else ''}")
+    print(f"[Settings] State now - Gain: {state['gain']}, Photo Exposure: {state['exposure']} μs, Video Exposure: {state['video_exposure']} μs, WB R: {state.get('wb_r', 'N/A')}, WB B: {state.get('wb_b', 'N/A')}, Format: {current_format_name}")
     
+    return jsonify(dict(applied,
+        success=True,
+        gain=state['gain'],
+        exposure=state['exposure'],
+        video_exposure=state['video_exposure'],
+        image_format=current_format_name,
+        updated=updated
+    ))
+
+@app.route('/camera/calibration', methods=['GET'])
+def calibration_status():
+    """Calibration capture progress, the master frames on disk and the master cache"""
+    # Masters calibrate_stream would use right now - it does nothing at these settings without any
+    stream = capture_settings('stream')
+    stream_masters = {kind: calibration.find(kind, stream.exposure, camera_state['gain'], stream.bin,
+                                             stream.img_format, camera.last_temperature)
+                      for kind in CALIBRATION_KINDS}
     return jsonify({
-        'success': True,
-        'gain': camera_state['gain'],
-        'exposure': camera_state['exposure'],
-        'video_exposure': camera_state['video_exposure'],
-        'image_format': current_format_name
+        'capture': {key: value for key, value in calibration_state.items() if key != 'thread'},
+        'calibrate': camera_state['calibrate'],
+        'calibrate_stream': camera_state['calibrate_stream'],
+        'stream_masters': {kind: calibration.filename(key) if key else None for kind, key in stream_masters.items()},
+        'directory': calibration.directory,
+        'masters': calibration.masters(),
+        'cache': calibration.stats()
+    })
+
+@app.route('/camera/calibration/capture', methods=['POST'])
+def capture_calibration():
+    """Capture N darks or flats at the current photo or stream settings and save their master frame
+
+    JSON: kind (dark or flat), count (default 20), method (median or mean,
+    default median), storage (npy or fits, default npy), target (photo or
+    stream, default photo). stream masters are taken at the video bin,
+    RGB24 and the video exposure for calibrate_stream. Runs in the
+    background; poll GET /camera/calibration. Darks need the lens capped
+    unless the camera has a shutter.
+    """
+    data = request.get_json(silent=True) or {}
+    kind = data.get('kind')
+    method = data.get('method', 'median')
+    storage = data.get('storage', 'npy')
+    target = data.get('target', 'photo')
+    if kind not in CALIBRATION_KINDS:
+        return jsonify({'error': f"kind must be one of: {', '.join(CALIBRATION_KINDS)}"}), 400
+    if target not in CALIBRATION_TARGETS:
+        return jsonify({'error': f"target must be one of: {', '.join(CALIBRATION_TARGETS)}"}), 400
+    if method not in CALIBRATION_METHODS:
+        return jsonify({'error': f"method must be one of: {', '.join(CALIBRATION_METHODS)}"}), 400
+    if storage not in CALIBRATION_STORAGE:
+        return jsonify({'error': f"storage must be one of: {', '.join(CALIBRATION_STORAGE)}"}), 400
+    try:
+        count = int(data.get('count', 20))
+    except (ValueError, TypeError):
+        return jsonify({'error': f'Invalid count value: {data.get("count")}'}), 400
+    if count < 1 or count > 500:
+        return jsonify({'error': 'Count must be between 1 and 500'}), 400
+    if not camera_state['connected'] or not camera.is_open:
+        return jsonify({'error': 'Camera not connected'}), 500
+    if calibration_state['active'] or sequence_state['active']:
+        return jsonify({'error': 'A calibration or sequence capture is already running'}), 409
+    
+    calibration_state.update({
+        'active': True,
+        'state': 'capturing',
+        'kind': kind,
+        'method': method,
+        'target': target,
+        'captured': 0,
+        'total': count,
+        'error': None,
+        'last_master': None
     })
+    calibration_state['thread'] = threading.Thread(
+        target=run_calibration_capture, args=(kind, count, method, storage, target), daemon=True)
+    calibration_state['thread'].start()
+    print(f"[Calibration] Capturing {count} {kind} frames ({method}, {storage})")
+    return jsonify({'success': True, 'kind': kind, 'count': count, 'method': method, 'storage': storage}), 202
 
 @app.route('/camera/sequence/start', methods=['POST'])
 def start_sequence():
@@ -1203,6 +4468,13 @@ def start_sequence():
         print("[Sequence Start] Error: Sequence already in progress")
         return jsonify({'error': 'Sequence capture already in progress'}), 400
     
+    if calibration_state['active']:
+        return jsonify({'error': 'Calibration capture in progress'}), 409
+    
+    if sequence_state['thread'] and sequence_state['thread'].is_alive():
+        print("[Sequence Start] Error: Previous sequence is still saving")
+        return jsonify({'error': 'Previous sequence is still saving photos'}), 409
+    
     if 'save_path' not in data or 'count' not in data:
         print(f"[Sequence Start] Error: Missing parameters. Received keys: {list(data.keys()) if data else 'None'}")
         return jsonify({'error': 'Missing required parameters: save_path, count'}), 400
@@ -1227,6 +4499,18 @@ def start_sequence():
     if interval < 0:
         return jsonify({'error': 'Interval must be >= 0'}), 400
     
+    # Burst: fast mode frames read back to back from video mode (tens of fps for lunar/planetary/meteor work)
+    burst = bool(data.get('burst', False))
+    if burst and interval > 0:
+        return jsonify({'error': 'Burst mode requires interval 0 (fast mode)'}), 400
+    
+    # Optional live stack of the captured frames (GET /camera/sequence/stack)
+    stack = data.get('stack') or None
+    if stack == 'none':
+        stack = None
+    if stack is not None and stack not in STACK_MODES:
+        return jsonify({'error': f"stack must be one of: none, {', '.join(STACK_MODES)}"}), 400
+    
     # Validate save path exists and is a directory
     # Expand user path (~) if present
     save_path = os.path.expanduser(save_path)
@@ -1249,26 +4533,39 @@ def start_sequence():
         return jsonify({'error': 'Count must be between 1 and 10000'}), 400
     
     # Validate file format
-    if file_format not in ['JPEG', 'PNG', 'TIFF']:
-        return jsonify({'error': 'File format must be JPEG, PNG, or TIFF'}), 400
+    if file_format not in ['JPEG', 'PNG', 'TIFF', 'FITS']:
+        return jsonify({'error': 'File format must be JPEG, PNG, TIFF, or FITS'}), 400
     
     # Check if camera is connected
     if not camera_state['connected'] or not camera.is_open:
         return jsonify({'error': 'Camera not connected'}), 500
     
+    capture_index.add_root(save_path)
+    
     # Initialize sequence state
     sequence_state['active'] = True
     sequence_state['save_path'] = save_path
     sequence_state['total_count'] = count
     sequence_state['current_count'] = 0
+    sequence_state['saved_count'] = 0
     sequence_state['file_format'] = file_format
     sequence_state['interval'] = interval
+    sequence_state['burst'] = burst
+    sequence_state['burst_dropped'] = 0
+    sequence_state['slots_triggered'] = 0
+    sequence_state['slots_skipped'] = 0
+    sequence_state['lateness_last'] = None
+    sequence_state['lateness_max'] = 0.0
+    sequence_state['lateness_total'] = 0.0
+    sequence_state['next_deadline'] = None
+    sequence_state['stack'] = stack
+    live_stack.reset(stack)
     
     # Start sequence capture thread
     sequence_state['thread'] = threading.Thread(target=sequence_capture_loop, daemon=True)
     sequence_state['thread'].start()
     
-    mode_str = f"time-lapse (interval: {interval}s)" if interval > 0 else "fast mode"
+    mode_str = f"time-lapse (interval: {interval}s)" if interval > 0 else ("burst mode" if burst else "fast mode")
     print(f"[Sequence] Started: {count} photos to {save_path}, format: {file_format}, {mode_str}")
     
     return jsonify({
@@ -1277,7 +4574,9 @@ def start_sequence():
         'save_path': save_path,
         'count': count,
         'file_format': file_format,
-        'interval': interval
+        'interval': interval,
+        'burst': burst,
+        'stack': stack
     })
 
 @app.route('/camera/sequence/stop', methods=['POST'])
@@ -1307,15 +4606,85 @@ def sequence_status():
     return jsonify({
         'active': sequence_state['active'],
         'current_count': sequence_state['current_count'],
+        'saved_count': sequence_state['saved_count'],
         'total_count': sequence_state['total_count'],
         'save_path': sequence_state['save_path'],
         'file_format': sequence_state['file_format'],
-        'interval': sequence_state.get('interval', 0)
+        'interval': sequence_state.get('interval', 0),
+        'burst': sequence_state['burst'],
+        'burst_dropped': sequence_state['burst_dropped'],
+        'schedule': sequence_schedule_stats(),
+        'writer': sequence_writer.stats(),
+        'stack': live_stack.stats()
     })
 
+@app.route('/camera/sequence/stack', methods=['GET'])
+def sequence_stack():
+    """Current live stack of the running (or last) sequence
+
+    Query parameter format: JPEG (default, auto-stretched preview), TIFF
+    (16-bit for mono/RAW stacks, 8-bit RGB) or FITS (16-bit).
+    """
+    file_format = request.args.get('format', 'JPEG').upper()
+    if file_format not in ('JPEG', 'TIFF', 'FITS'):
+        return jsonify({'error': 'format must be JPEG, TIFF or FITS'}), 400
+    stats = live_stack.stats()
+    if stats is None:
+        return jsonify({'error': 'Live stacking is not enabled for this sequence'}), 404
+    stack = live_stack.result(16 if file_format != 'JPEG' else None)
+    if stack is None:
+        return jsonify({'error': 'No frames stacked yet'}), 404
+    if file_format == 'TIFF' and stack.ndim == 3:
+        stack = (stack >> 8).astype(np.uint8)  # PIL writes RGB TIFFs with 8 bits per channel only
+    download_name = f"stack_{stats['mode']}_{stats['frames']}frames"
+    
+    if file_format == 'FITS':
+        header = list(live_stack.header) + [
+            ('NCOMBINE', stats['frames'], 'number of stacked frames'),
+            ('STACKMOD', stats['mode'], 'live stack mode'),
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'stack.fits')
+            write_fits(path, stack, header)
+            with open(path, 'rb') as f:
+                data = f.read()
+        return send_file(io.BytesIO(data), mimetype='image/fits', download_name=f"{download_name}.fits")
+    
+    img = Image.fromarray(stack)
+    img.array = stack
+    img.bayer_pattern = live_stack.bayer_pattern
+    img_io = io.BytesIO()
+    if file_format == 'TIFF':
+        img.save(img_io, 'TIFF')
+        return send_file(io.BytesIO(img_io.getvalue()), mimetype='image/tiff', download_name=f"{download_name}.tif")
+    preview_8bit(img, stack_stretch).save(img_io, 'JPEG', quality=90)
+    return send_file(io.BytesIO(img_io.getvalue()), mimetype='image/jpeg', download_name=f"{download_name}.jpg")
+
+def sequence_schedule_stats():
+    """Time-lapse lateness/skipped-slot figures for /camera/sequence/status"""
+    if not sequence_state.get('interval'):
+        return None
+    triggered = sequence_state['slots_triggered']
+    next_deadline = sequence_state['next_deadline']
+    return {
+        'slots_triggered': triggered,
+        'slots_skipped': sequence_state['slots_skipped'],
+        'lateness_last': round(sequence_state['lateness_last'], 4) if sequence_state['lateness_last'] is not None else None,
+        'lateness_max': round(sequence_state['lateness_max'], 4),
+        'lateness_avg': round(sequence_state['lateness_total'] / triggered, 4) if triggered else None,
+        'next_capture_in': round(max(0.0, next_deadline - time.monotonic()), 3) if next_deadline is not None else None,
+        'stream_paused': camera.stream_paused
+    }
+
 @app.route('/camera/sequence/capture', methods=['POST'])
 def capture_sequence():
-    """Capture a sequence of photos - simple: stop stream, take N photos, resume stream"""
+    """Capture a sequence of photos - simple: stop stream, take N photos, resume stream
+
+    By default all photos come back at once as base64 JPEGs in a JSON body.
+    With ?stream=multipart (multipart/mixed) or ?stream=zip (a streamed ZIP)
+    each photo is sent as soon as it is read out and encoded, and only about
+    one frame is held in memory however many are requested.
+    """
     from flask import request
     import base64
     
@@ -1328,117 +4697,478 @@ def capture_sequence():
     if count < 1 or count > 100:
         return jsonify({'error': 'Count must be between 1 and 100'}), 400
     
+    stream = request.args.get('stream')
+    if stream not in (None, 'multipart', 'zip'):
+        return jsonify({'error': 'stream must be multipart or zip'}), 400
+    
     # Check if camera is connected
     if not camera_state['connected'] or not camera.is_open:
         return jsonify({'error': 'Camera not connected'}), 500
     
-    # Remember if we were streaming
-    was_streaming = camera.streaming
+    if stream is not None:
+        return stream_photos(count, stream)
+    
+    photos = []
+    try:
+        camera_executor.call(capture_photos, count,
+                             lambda index, img: photos.append(encode_photo(calibrate_frame(img)) if img else None),
+                             priority=PRIORITY_SNAPSHOT)
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        print(f"[Sequence Capture] Exception: {e}")
+        print(f"[Sequence Capture] Traceback:\n{error_details}")
+        return jsonify({'error': f'Exception: {str(e)}'}), 500
+    
+    print(f"[Sequence Capture] Successfully captured {len([p for p in photos if p])}/{count} photos")
+    
+    return jsonify({
+        'success': True,
+        'count': len([p for p in photos if p]),
+        'photos': [base64.b64encode(p).decode('utf-8') if p else None for p in photos]
+    })
+
+def encode_photo(img):
+    """Full-quality JPEG of a captured photo"""
+    encode_started = time.perf_counter()
+    img_io = io.BytesIO()
+    preview_8bit(img).save(img_io, 'JPEG', quality=100)
+    metric_jpeg_encode_seconds.labels('sequence').observe(time.perf_counter() - encode_started)
+    return img_io.getvalue()
+
+class _ZipSink:
+    """Write-only file object for zipfile; drain() hands over what was written since the last call.
+
+    Without tell()/seek() zipfile streams its output: each entry is followed
+    by a data descriptor instead of patching the local header afterwards.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_photos(count, stream):
+    """Streaming /camera/sequence/capture response (multipart/mixed or ZIP).
+
+    The camera thread hands each raw photo over through a one-slot queue and
+    goes on to the next exposure while this request thread calibrates,
+    encodes and sends the previous one. A client that disconnects cancels
+    the remaining exposures.
+    """
+    import zipfile
+    
+    handoff = queue.Queue(maxsize=1)
+    cancelled = threading.Event()
+    
+    def on_photo(index, img):
+        # Camera thread: wait for the consumer, but never forever
+        while not cancelled.is_set():
+            try:
+                handoff.put((index, img), timeout=0.5)
+                return
+            except queue.Full:
+                continue
+    
+    future = camera_executor.submit(capture_photos, count, on_photo, lambda: not cancelled.is_set(),
+                                    priority=PRIORITY_SNAPSHOT)
+    
+    def photos():
+        """(index, JPEG bytes or None) as the photos arrive"""
+        while True:
+            try:
+                index, img = handoff.get(timeout=0.5)
+            except queue.Empty:
+                if future.done() and handoff.empty():
+                    future.result()  # Re-raise a capture failure
+                    return
+                continue
+            yield index, encode_photo(calibrate_frame(img)) if img is not None else None
+    
+    boundary = f'photo-{uuid4().hex}'
+    
+    def multipart():
+        failed = []
+        for index, jpeg in photos():
+            if jpeg is None:
+                failed.append(index + 1)
+                continue
+            yield (f'--{boundary}\r\n'
+                   f'Content-Type: image/jpeg\r\n'
+                   f'Content-Disposition: attachment; filename="photo_{index + 1:04d}.jpg"\r\n'
+                   f'Content-Length: {len(jpeg)}\r\n'
+                   f'X-Photo-Index: {index + 1}\r\n\r\n').encode('ascii') + jpeg + b'\r\n'
+        summary = json.dumps({'count': count - len(failed), 'failed': failed}).encode('utf-8')
+        yield (f'--{boundary}\r\nContent-Type: application/json\r\n\r\n').encode('ascii') + summary + \
+              f'\r\n--{boundary}--\r\n'.encode('ascii')
+    
+    def zipped():
+        sink = _ZipSink()
+        failed = []
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:  # JPEGs do not compress further
+            for index, jpeg in photos():
+                if jpeg is None:
+                    failed.append(index + 1)
+                    continue
+                archive.writestr(f'photo_{index + 1:04d}.jpg', jpeg)
+                yield sink.drain()
+            archive.writestr('summary.json', json.dumps({'count': count - len(failed), 'failed': failed}))
+        yield sink.drain()
+    
+    def guarded(chunks):
+        try:
+            yield from chunks
+        finally:
+            # Runs when the response finishes or the client goes away
+            cancelled.set()
+    
+    if stream == 'zip':
+        return Response(guarded(zipped()), mimetype='application/zip',
+                        headers={'Content-Disposition': f'attachment; filename="sequence_{count}.zip"'})
+    return Response(guarded(multipart()), mimetype=f'multipart/mixed; boundary={boundary}')
+
+def capture_photos(count, on_photo, should_continue=None):
+    """Stop the stream, take count photos, resume the stream.
+
+    on_photo(index, img) gets each photo as soon as it is read out (None for a
+    failed capture); nothing is kept here. Stops early once should_continue()
+    returns False. Runs on the camera thread as a single command.
+    """
+    # Remember if we were streaming (a stream paused by a sequence counts)
+    was_streaming = camera.streaming or camera.stream_paused
     
     try:
         # Stop stream if running
-        if was_streaming:
+        if camera.streaming:
             print(f"[Sequence Capture] Stopping stream for {count} photos...")
             camera.stop_stream()
-            time.sleep(0.5)
         
-        # Apply image format if needed
+        # Apply image format (free through the ROI shadow register when unchanged)
         photo_format = camera_state['image_format']
-        width = camera_state['width']
-        height = camera_state['height']
-        format_applied = False
-        
-        if photo_format != ASI_IMG_RGB24:
-            asi_lib.ASISetROIFormat(camera.camera_id, width, height, 1, photo_format)
-            format_applied = True
+        camera.set_photo_format(photo_format)
         
         # Capture all photos
-        photos = []
         print(f"[Sequence Capture] Capturing {count} photos...")
         
         for i in range(count):
+            if should_continue is not None and not should_continue():
+                print(f"[Sequence Capture] Cancelled after {i}/{count} photos")
+                break
             print(f"[Sequence Capture] Photo {i+1}/{count}...")
             img = camera.capture_snapshot()
-            
-            if img:
-                # Convert to JPEG bytes
-                img_io = io.BytesIO()
-                img.save(img_io, 'JPEG', quality=100)
-                img_io.seek(0)
-                img_bytes = img_io.read()
-                # Encode as base64 for JSON
-                img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-                photos.append(img_base64)
-                
-                # Wait between photos (at least exposure time)
-                exposure_s = camera_state['exposure'] / 1000000.0
-                wait_time = max(exposure_s + 0.3, 0.5)
-                if i < count - 1:  # Don't wait after last photo
-                    time.sleep(wait_time)
-            else:
+            if not img:
                 print(f"[Sequence Capture] Failed to capture photo {i+1}")
-                photos.append(None)
+            on_photo(i, img)
         
         # Restore format if needed
-        if was_streaming and format_applied:
-            asi_lib.ASISetROIFormat(camera.camera_id, width, height, 1, ASI_IMG_RGB24)
-            time.sleep(0.3)
-        
-        # Resume stream if it was running
         if was_streaming:
+            camera.set_video_roi()
+    finally:
+        # Resume stream if it was running
+        if was_streaming and not camera.streaming:
             print("[Sequence Capture] Resuming stream...")
-            time.sleep(0.5)
             camera.start_stream()
-        
-        print(f"[Sequence Capture] Successfully captured {len([p for p in photos if p])}/{count} photos")
-        
-        return jsonify({
-            'success': True,
-            'count': len([p for p in photos if p]),
-            'photos': photos
-        })
-        
+
+@app.route('/captures', methods=['GET'])
+def list_captures():
+    """Files saved by sequence capture, newest first
+
+    Query parameters: offset (default 0) and limit (default 100, at most
+    CAPTURE_PAGE_LIMIT). Served from the capture index - no directory walk.
+    """
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', 100, type=int)
+    if offset < 0 or not (1 <= limit <= CAPTURE_PAGE_LIMIT):
+        return jsonify({'error': f'offset must be >= 0 and limit between 1 and {CAPTURE_PAGE_LIMIT}'}), 400
+    total, entries = capture_index.page(offset, limit)
+    next_offset = offset + len(entries)
+    return jsonify({
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'next_offset': next_offset if next_offset < total else None,
+        'captures': [{
+            'name': name,
+            'size': size,
+            'mtime': datetime.fromtimestamp(mtime, timezone.utc).isoformat(),
+            'url': f"/captures/{name}",
+            'thumb_url': f"/captures/{name}/thumb"
+        } for mtime, name, size, path in entries]
+    })
+
+@app.route('/captures/<name>/thumb', methods=['GET'])
+def capture_thumbnail(name):
+    """JPEG thumbnail of a captured file: ?size=256 (longest side, 32-1024)"""
+    size = request.args.get('size', THUMBNAIL_SIZE, type=int)
+    if not (THUMBNAIL_MIN_SIZE <= size <= THUMBNAIL_MAX_SIZE):
+        return jsonify({'error': f'size must be between {THUMBNAIL_MIN_SIZE} and {THUMBNAIL_MAX_SIZE}'}), 400
+    path = capture_index.path(name)
+    if path is None:
+        return jsonify({'error': 'Capture not found'}), 404
+    if not os.path.isfile(path):
+        capture_index.remove(name)
+        return jsonify({'error': 'Capture not found'}), 404
+    try:
+        jpeg = thumbnails.get(name, size, path)
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"[Sequence Capture] Exception: {e}")
-        print(f"[Sequence Capture] Traceback:\n{error_details}")
-        
-        # Try to resume stream if it was running
-        if was_streaming and not camera.streaming:
+        print(f"[Captures] Thumbnail for {name} failed: {e}")
+        return jsonify({'error': f'Cannot read {name}: {str(e)}'}), 500
+    return send_file(io.BytesIO(jpeg), mimetype='image/jpeg', max_age=3600)
+
+@app.route('/captures/<name>', methods=['GET'])
+def download_capture(name):
+    """Download a captured file.
+
+    Supports Range requests (resume), ETag/If-None-Match and
+    If-Modified-Since via werkzeug's conditional responses. The body goes
+    through the server's wsgi.file_wrapper, which lets servers such as
+    gunicorn use sendfile() instead of copying the file through Python.
+    """
+    path = capture_index.path(name)
+    if path is None:
+        return jsonify({'error': 'Capture not found'}), 404
+    if not os.path.isfile(path):
+        capture_index.remove(name)
+        return jsonify({'error': 'Capture not found'}), 404
+    return send_file(path, as_attachment=True, download_name=name, conditional=True, etag=True)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of capture/stream/sequence hot-path metrics"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Bookings storage: in-memory interval index, persisted as a JSON snapshot plus an append-only journal
+BOOKINGS_FILE = 'bookings.json'  # Compacted snapshot
+BOOKINGS_JOURNAL = 'bookings.journal'  # Changes since the snapshot, one JSON object per line
+BOOKINGS_COMPACT_EVERY = 256  # Journal entries before the snapshot is rewritten
+
+def parse_booking_time(value):
+    """ISO 8601 string -> timezone-aware datetime (naive times are taken as UTC)"""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+class BookingStore:
+    """Bookings kept in memory as intervals sorted by start time.
+
+    Overlap checks and range queries bisect the interval list instead of
+    re-reading and re-parsing every booking. A running maximum of end times
+    keeps them correct even if older files hold overlapping bookings. Each
+    change is appended to a journal; once it grows past BOOKINGS_COMPACT_EVERY
+    entries the snapshot is rewritten atomically and the journal truncated.
+    """
+
+    def __init__(self, snapshot_file=BOOKINGS_FILE, journal_file=BOOKINGS_JOURNAL,
+                 compact_every=BOOKINGS_COMPACT_EVERY):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.compact_every = compact_every
+        self.lock = threading.Lock()
+        self.bookings = None  # id -> booking dict, loaded on first use
+        self.intervals = []  # Sorted (start, end, id)
+        self.max_ends = []  # max_ends[i] = latest end among intervals[:i + 1]
+        self.unparsed = []  # Snapshot records that could not be parsed, written back verbatim
+        self.snapshot_intact = True  # False if the snapshot could not be read; compaction is then refused
+        self.journal_entries = 0
+        self.cached_json = None  # Serialized GET /bookings body, dropped on change
+
+    def _load(self):
+        """Read the snapshot and replay the journal (lock held)"""
+        if self.bookings is not None:
+            return
+        self.bookings = {}
+        times = {}
+        if os.path.exists(self.snapshot_file):
             try:
-                camera.start_stream()
-            except:
-                pass
-        
-        return jsonify({'error': f'Exception: {str(e)}'}), 500
+                with open(self.snapshot_file, 'r') as f:
+                    records = json.load(f)
+                if not isinstance(records, list):
+                    raise ValueError("expected a list of bookings")
+            except (OSError, ValueError) as e:
+                print(f"[Bookings] Unreadable {self.snapshot_file}, compaction disabled: {e}")
+                records = []
+                self.snapshot_intact = False
+            for record in records:
+                try:
+                    times[record['id']] = (parse_booking_time(record['start_time']),
+                                           parse_booking_time(record['end_time']))
+                    self.bookings[record['id']] = record
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    print(f"[Bookings] Keeping unparseable booking as-is: {e}")
+                    self.unparsed.append(record)
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        if entry['op'] == 'put':
+                            booking = entry['booking']
+                            times[booking['id']] = (parse_booking_time(booking['start_time']),
+                                                    parse_booking_time(booking['end_time']))
+                            self.bookings[booking['id']] = booking
+                        elif entry['op'] == 'delete':
+                            self.bookings.pop(entry['id'], None)
+                        self.journal_entries += 1
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        # A torn final line from a crash mid-append; everything before it is intact
+                        print(f"[Bookings] Skipping unreadable journal entry in {self.journal_file}")
+        self.intervals = sorted((*times[booking_id], booking_id) for booking_id in self.bookings)
+        self._reindex(0)
+        overlapping = sum(1 for i in range(1, len(self.intervals))
+                          if self.intervals[i][0] < self.max_ends[i - 1])
+        if overlapping:
+            print(f"[Bookings] {overlapping} stored bookings overlap an earlier one")
+        print(f"[Bookings] Loaded {len(self.bookings)} bookings ({self.journal_entries} journal entries)")
 
-# Bookings storage (simple JSON file-based storage)
-BOOKINGS_FILE = 'bookings.json'
-bookings_lock = threading.Lock()
+    def _reindex(self, i):
+        """Recompute the running maximum of end times from index i onwards (lock held)"""
+        latest = self.max_ends[i - 1] if i > 0 else None
+        del self.max_ends[i:]
+        for _, end, _ in itertools.islice(self.intervals, i, None):
+            if latest is None or end > latest:
+                latest = end
+            self.max_ends.append(latest)
 
-def load_bookings():
-    """Load bookings from JSON file"""
-    if os.path.exists(BOOKINGS_FILE):
-        try:
-            with open(BOOKINGS_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
-
-def save_bookings(bookings):
-    """Save bookings to JSON file"""
-    with bookings_lock:
-        with open(BOOKINGS_FILE, 'w') as f:
+    def _put(self, booking):
+        """Insert or replace a booking in the index (lock held)"""
+        self._remove(booking['id'])
+        interval = (parse_booking_time(booking['start_time']),
+                    parse_booking_time(booking['end_time']), booking['id'])
+        self.bookings[booking['id']] = booking
+        i = bisect.bisect_left(self.intervals, interval)
+        self.intervals.insert(i, interval)
+        self._reindex(i)
+        self.cached_json = None
+
+    def _remove(self, booking_id):
+        """Drop a booking from the index, returning it or None (lock held)"""
+        booking = self.bookings.pop(booking_id, None)
+        if booking is None:
+            return None
+        start = parse_booking_time(booking['start_time'])
+        i = bisect.bisect_left(self.intervals, (start,))
+        while self.intervals[i][2] != booking_id:
+            i += 1
+        del self.intervals[i]
+        self._reindex(i)
+        self.cached_json = None
+        return booking
+
+    def _intersecting(self, start, end):
+        """Indices of stored bookings intersecting [start, end), latest start first (lock held)"""
+        # Only bookings starting before `end` qualify; walking back from the last of
+        # them can stop once no earlier booking ends after `start`.
+        i = bisect.bisect_left(self.intervals, (end,)) - 1
+        while i >= 0 and self.max_ends[i] > start:
+            if self.intervals[i][1] > start:
+                yield i
+            i -= 1
+
+    def _overlaps(self, start, end, exclude=None):
+        """Whether [start, end) intersects a stored booking other than exclude (lock held)"""
+        return any(self.intervals[i][2] != exclude for i in self._intersecting(start, end))
+
+    def _append(self, entry):
+        """Journal one change, compacting into the snapshot when the journal is long (lock held)"""
+        with open(self.journal_file, 'a') as f:
+            f.write(json.dumps(entry, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_entries += 1
+        if self.journal_entries >= self.compact_every and self.snapshot_intact:
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the snapshot atomically, then empty the journal (lock held)"""
+        bookings = [self.bookings[booking_id] for _, _, booking_id in self.intervals] + self.unparsed
+        partial = self.snapshot_file + '.partial'
+        with open(partial, 'w') as f:
             json.dump(bookings, f, indent=2, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, self.snapshot_file)
+        # Crashing before this point only means the journal is replayed onto a snapshot
+        # that already contains it; puts and deletes are idempotent.
+        open(self.journal_file, 'w').close()
+        self.journal_entries = 0
+
+    def all_json(self):
+        """Every booking in start order, serialized (cached until the next change)"""
+        with self.lock:
+            self._load()
+            if self.cached_json is None:
+                self.cached_json = app.json.dumps(
+                    [self.bookings[booking_id] for _, _, booking_id in self.intervals])
+            return self.cached_json
+
+    def between(self, start, end):
+        """Bookings intersecting [start, end), in start order"""
+        with self.lock:
+            self._load()
+            found = [self.bookings[self.intervals[i][2]] for i in self._intersecting(start, end)]
+            return found[::-1]
+
+    def create(self, booking, start, end):
+        """Store a new booking unless it overlaps; returns it or None"""
+        with self.lock:
+            self._load()
+            if self._overlaps(start, end):
+                return None
+            self._put(booking)
+            self._append({'op': 'put', 'booking': booking})
+            return booking
+
+    def update(self, booking_id, data, start, end):
+        """Apply an edit; returns (booking, error) with error 'not_found' or 'overlap'"""
+        with self.lock:
+            self._load()
+            existing = self.bookings.get(booking_id)
+            if existing is None:
+                return None, 'not_found'
+            if self._overlaps(start, end, exclude=booking_id):
+                return None, 'overlap'
+            booking = dict(existing)
+            booking.update({
+                'user_name': data.get('user_name', existing['user_name']),
+                'start_time': data['start_time'],
+                'end_time': data['end_time'],
+                'notes': data.get('notes', existing.get('notes'))
+            })
+            self._put(booking)
+            self._append({'op': 'put', 'booking': booking})
+            return booking, None
+
+    def delete(self, booking_id):
+        """Remove a booking; returns False if it did not exist"""
+        with self.lock:
+            self._load()
+            if self._remove(booking_id) is None:
+                return False
+            self._append({'op': 'delete', 'id': booking_id})
+            return True
+
+booking_store = BookingStore()
 
 # Booking API Routes
 @app.route('/bookings', methods=['GET'])
 def get_bookings():
-    """Get all bookings"""
-    bookings = load_bookings()
-    return jsonify(bookings)
+    """Get bookings in start order, optionally only those intersecting ?from=&to="""
+    if 'from' in request.args or 'to' in request.args:
+        try:
+            start = parse_booking_time(request.args['from']) if 'from' in request.args else datetime.min.replace(tzinfo=timezone.utc)
+            end = parse_booking_time(request.args['to']) if 'to' in request.args else datetime.max.replace(tzinfo=timezone.utc)
+        except ValueError:
+            return jsonify({'error': 'Invalid date format. Use ISO 8601 format (YYYY-MM-DDTHH:MM:SS)'}), 400
+        return jsonify(booking_store.between(start, end))
+    return Response(booking_store.all_json(), mimetype='application/json')
 
 @app.route('/bookings', methods=['POST'])
 def create_booking():
@@ -1455,16 +5185,14 @@ def create_booking():
     
     # Parse dates
     try:
-        start_time = datetime.fromisoformat(data['start_time'].replace('Z', '+00:00'))
-        end_time = datetime.fromisoformat(data['end_time'].replace('Z', '+00:00'))
+        start_time = parse_booking_time(data['start_time'])
+        end_time = parse_booking_time(data['end_time'])
     except:
         return jsonify({'error': 'Invalid date format. Use ISO 8601 format (YYYY-MM-DDTHH:MM:SS)'}), 400
     
     if end_time <= start_time:
         return jsonify({'error': 'End time must be after start time'}), 400
     
-    # Check for overlaps
-    bookings = load_bookings()
     new_booking = {
         'id': str(uuid4()),
         'user_name': data['user_name'],
@@ -1473,15 +5201,8 @@ def create_booking():
         'notes': data.get('notes')
     }
     
-    # Check overlaps
-    for booking in bookings:
-        existing_start = datetime.fromisoformat(booking['start_time'].replace('Z', '+00:00'))
-        existing_end = datetime.fromisoformat(booking['end_time'].replace('Z', '+00:00'))
-        if start_time < existing_end and end_time > existing_start:
-            return jsonify({'error': 'Booking overlaps with existing booking'}), 409
-    
-    bookings.append(new_booking)
-    save_bookings(bookings)
+    if booking_store.create(new_booking, start_time, end_time) is None:
+        return jsonify({'error': 'Booking overlaps with existing booking'}), 409
     return jsonify(new_booking), 201
 
 @app.route('/bookings/<booking_id>', methods=['PUT'])
@@ -1492,59 +5213,134 @@ def update_booking(booking_id):
     if not data:
         return jsonify({'error': 'Invalid request'}), 400
     
-    bookings = load_bookings()
-    booking_index = None
-    for i, booking in enumerate(bookings):
-        if booking['id'] == booking_id:
-            booking_index = i
-            break
-    
-    if booking_index is None:
-        return jsonify({'error': 'Booking not found'}), 404
-    
     # Parse dates
     try:
-        start_time = datetime.fromisoformat(data['start_time'].replace('Z', '+00:00'))
-        end_time = datetime.fromisoformat(data['end_time'].replace('Z', '+00:00'))
+        start_time = parse_booking_time(data['start_time'])
+        end_time = parse_booking_time(data['end_time'])
     except:
         return jsonify({'error': 'Invalid date format. Use ISO 8601 format (YYYY-MM-DDTHH:MM:SS)'}), 400
     
     if end_time <= start_time:
         return jsonify({'error': 'End time must be after start time'}), 400
     
-    # Check for overlaps (excluding self)
-    for booking in bookings:
-        if booking['id'] == booking_id:
-            continue
-        existing_start = datetime.fromisoformat(booking['start_time'].replace('Z', '+00:00'))
-        existing_end = datetime.fromisoformat(booking['end_time'].replace('Z', '+00:00'))
-        if start_time < existing_end and end_time > existing_start:
-            return jsonify({'error': 'Booking overlaps with existing booking'}), 409
-    
-    # Update booking
-    bookings[booking_index].update({
-        'user_name': data.get('user_name', bookings[booking_index]['user_name']),
-        'start_time': data['start_time'],
-        'end_time': data['end_time'],
-        'notes': data.get('notes', bookings[booking_index].get('notes'))
-    })
-    save_bookings(bookings)
-    return jsonify(bookings[booking_index])
+    booking, error = booking_store.update(booking_id, data, start_time, end_time)
+    if error == 'not_found':
+        return jsonify({'error': 'Booking not found'}), 404
+    if error == 'overlap':
+        return jsonify({'error': 'Booking overlaps with existing booking'}), 409
+    return jsonify(booking)
 
 @app.route('/bookings/<booking_id>', methods=['DELETE'])
 def delete_booking(booking_id):
     """Delete a booking"""
-    bookings = load_bookings()
-    original_count = len(bookings)
-    bookings = [b for b in bookings if b['id'] != booking_id]
-    
-    if len(bookings) == original_count:
+    if not booking_store.delete(booking_id):
         return jsonify({'error': 'Booking not found'}), 404
-    
-    save_bookings(bookings)
     return jsonify({'success': True})
 
+def _print_latency_stats(label, samples):
+    samples = sorted(samples)
+    if not samples:
+        print(f"[Benchmark] {label}: no samples")
+        return
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"[Benchmark] {label}: n={len(samples)} min={samples[0] * 1000:.1f}ms "
+          f"median={samples[len(samples) // 2] * 1000:.1f}ms p95={p95 * 1000:.1f}ms max={samples[-1] * 1000:.1f}ms")
+
+# Sensor sizes for the demosaic benchmark (ASI462, ASI178, ASI294, ASI2600)
+DEMOSAIC_BENCHMARK_SIZES = [(1936, 1096), (3096, 2080), (4144, 2822), (6248, 4176)]
+
+def run_demosaic_benchmark(count):
+    """Demosaic latency for typical sensor sizes, 8/16-bit, bilinear/superpixel (no camera needed)"""
+    rng = np.random.default_rng(0)
+    for width, height in DEMOSAIC_BENCHMARK_SIZES:
+        for dtype in (np.uint8, np.uint16):
+            raw = rng.integers(0, np.iinfo(dtype).max, (height, width), dtype=dtype)
+            for mode in ('bilinear', 'superpixel'):
+                out = None
+                samples = []
+                for _ in range(count):
+                    started = time.perf_counter()
+                    out = demosaicer.demosaic(raw, ASI_BAYER_RG, mode, out)
+                    samples.append(time.perf_counter() - started)
+                _print_latency_stats(f"demosaic {mode} {width}x{height} {np.dtype(dtype).name}", samples)
+    return True
+
+def run_benchmark(name, count, exposure_us, file_format='JPEG', burst=False):
+    """Measure snapshot latency or fast-sequence throughput (use ASI_SIMULATOR=1 without a camera)"""
+    import tempfile
+    
+    if name == 'demosaic':
+        return run_demosaic_benchmark(count)
+    
+    if not camera_state['connected'] and not camera.connect():
+        print(f"[Benchmark] Camera not available: {camera_state['error']}")
+        return False
+    camera_state['exposure'] = exposure_us
+    client = app.test_client()
+    
+    if name == 'snapshot':
+        # Idle camera: exposure + readout + conversion only
+        camera.stop_stream()
+        samples = []
+        for _ in range(count):
+            started = time.perf_counter()
+            camera.capture_snapshot()
+            samples.append(time.perf_counter() - started)
+        _print_latency_stats(f"capture_snapshot, idle, exposure {exposure_us} us", samples)
+        
+        # End to end through /camera/snapshot while streaming (stop, capture, encode, resume)
+        camera.start_stream()
+        samples = []
+        for _ in range(count):
+            started = time.perf_counter()
+            response = client.get('/camera/snapshot')
+            samples.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                print(f"[Benchmark] Snapshot failed: {response.status_code}")
+        camera.stop_stream()
+        _print_latency_stats(f"GET /camera/snapshot while streaming, exposure {exposure_us} us", samples)
+        return True
+    
+    if name == 'sequence':
+        with tempfile.TemporaryDirectory() as save_path:
+            started = time.perf_counter()
+            response = client.post('/camera/sequence/start', json={
+                'save_path': save_path, 'count': count, 'file_format': file_format, 'interval': 0,
+                'burst': burst})
+            if response.status_code != 200:
+                print(f"[Benchmark] Sequence start failed: {response.get_json()}")
+                return False
+            while sequence_state['active']:
+                time.sleep(0.01)
+            captured_elapsed = time.perf_counter() - started
+            captured = sequence_state['current_count']
+            sequence_state['thread'].join()  # Writer pool drains before the thread exits
+            elapsed = time.perf_counter() - started
+            writer = sequence_writer.stats()
+        print(f"[Benchmark] {'burst' if burst else 'fast'} sequence: {captured}/{count} frames captured in {captured_elapsed:.2f}s "
+              f"= {captured / captured_elapsed:.2f} fps, {sequence_state['saved_count']} saved in {elapsed:.2f}s "
+              f"(exposure {exposure_us} us, encode avg {writer['encode_seconds_avg']}s, "
+              f"backpressure {writer['backpressure_seconds']}s)")
+        return True
+    
+    print(f"[Benchmark] Unknown benchmark: {name}")
+    return False
+
 if __name__ == '__main__':
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='ASI Camera Service')
+    parser.add_argument('--benchmark', choices=['snapshot', 'sequence', 'demosaic'],
+                        help='Run a latency/throughput benchmark instead of the HTTP server')
+    parser.add_argument('--count', type=int, default=20, help='Benchmark iterations / frames')
+    parser.add_argument('--exposure', type=int, default=10000, help='Benchmark photo exposure in microseconds')
+    parser.add_argument('--format', default='JPEG', choices=['JPEG', 'PNG', 'TIFF', 'FITS'], help='Sequence benchmark file format')
+    parser.add_argument('--burst', action='store_true', help='Sequence benchmark in video-mode burst capture')
+    args = parser.parse_args()
+    
+    if args.benchmark:
+        raise SystemExit(0 if run_benchmark(args.benchmark, args.count, args.exposure, args.format, args.burst) else 1)
+    
     print("Starting ASI Camera Service...")
     print("Attempting to connect to camera...")
     
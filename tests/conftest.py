@@ -0,0 +1,33 @@
+"""Run camera_service against the simulated SDK (ASI_SIMULATOR=1), keeping its files out of the tree"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ['ASI_SIMULATOR'] = '1'
+os.environ.setdefault('ASI_SIM_WIDTH', '640')
+os.environ.setdefault('ASI_SIM_HEIGHT', '480')
+_scratch = tempfile.mkdtemp(prefix='camera_service_tests_')
+os.environ.setdefault('ASI_CALIBRATION_DIR', os.path.join(_scratch, 'calibration'))
+os.environ.setdefault('ASI_THUMBNAIL_DIR', os.path.join(_scratch, 'thumbnails'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import camera_service  # noqa: E402 - the environment above must be set first
+
+
+@pytest.fixture
+def client():
+    return camera_service.app.test_client()
+
+
+@pytest.fixture
+def connected(client):
+    """Connected simulator with a short photo exposure; disconnected again afterwards"""
+    response = client.post('/camera/connect')
+    assert response.status_code == 200, response.get_json()
+    response = client.post('/camera/settings', json={'photo_exposure': 10000, 'image_format': 'RGB24'})
+    assert response.status_code == 200, response.get_json()
+    yield client
+    client.post('/camera/stream/stop')
+    client.post('/camera/disconnect')
@@ -0,0 +1,222 @@
+"""camera_service against the simulated SDK: capture paths, storage formats and HTTP downloads"""
+import io
+import json
+import os
+import zipfile
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import camera_service as cs
+
+# --- Snapshot format switching ---
+
+def snapshot(client, image_format):
+    assert client.post('/camera/settings', json={'image_format': image_format}).status_code == 200
+    img, error = cs.take_snapshot()
+    assert error is None
+    return img
+
+
+def test_snapshot_uses_the_photo_format_every_time(connected):
+    width, height = cs.camera_state['max_width'], cs.camera_state['max_height']
+    raw = snapshot(connected, 'RAW16')
+    assert raw.img_format == cs.ASI_IMG_RAW16
+    assert cs.frame_array(raw).dtype == np.uint16
+    assert cs.frame_array(raw).shape == (height, width)
+    rgb = snapshot(connected, 'RGB24')
+    assert rgb.mode == 'RGB' and rgb.size == (width, height)
+    assert snapshot(connected, 'Y8').mode == 'L'
+    assert cs.camera.roi_shadow == (width, height, 1, cs.ASI_IMG_Y8)
+
+
+def test_snapshot_during_stream_restores_the_video_roi(connected):
+    assert connected.post('/camera/roi', json={'bin': 2}).status_code == 200
+    assert connected.post('/camera/stream/start').status_code == 200
+    raw = snapshot(connected, 'RAW16')
+    assert raw.img_format == cs.ASI_IMG_RAW16
+    assert cs.camera.streaming
+    assert cs.camera.roi_shadow == (cs.camera_state['width'], cs.camera_state['height'], 2, cs.ASI_IMG_RGB24)
+    # The stream switched the camera to RGB24 - the next photo must not inherit it
+    assert cs.frame_array(snapshot(connected, 'RAW16')).dtype == np.uint16
+    assert connected.post('/camera/roi', json={'bin': 1}).status_code == 200
+
+# --- Bookings ---
+
+def at(hour):
+    return (datetime(2026, 1, 1, tzinfo=timezone.utc) + timedelta(hours=hour)).isoformat()
+
+
+def booking(booking_id, start, end):
+    return {'id': booking_id, 'user_name': 'test', 'start_time': at(start), 'end_time': at(end), 'notes': None}
+
+
+def store_with(tmp_path, records, compact_every=cs.BOOKINGS_COMPACT_EVERY):
+    snapshot_file = tmp_path / 'bookings.json'
+    snapshot_file.write_text(records if isinstance(records, str) else json.dumps(records))
+    return cs.BookingStore(str(snapshot_file), str(tmp_path / 'bookings.journal'), compact_every)
+
+
+def interval(start, end):
+    return cs.parse_booking_time(at(start)), cs.parse_booking_time(at(end))
+
+
+def test_booking_overlap_is_rejected_and_adjacent_accepted(tmp_path):
+    store = store_with(tmp_path, [booking('a', 1, 3)])
+    assert store.create(booking('b', 2, 4), *interval(2, 4)) is None
+    assert store.create(booking('c', 3, 4), *interval(3, 4)) is not None
+    assert store.update('c', booking('c', 0, 2), *interval(0, 2)) == (None, 'overlap')
+    assert [b['id'] for b in store.between(*interval(0, 5))] == ['a', 'c']
+
+
+def test_legacy_overlapping_bookings_are_all_found(tmp_path):
+    # A long booking hidden behind a shorter one that starts later
+    store = store_with(tmp_path, [booking('long', 0, 10), booking('short', 1, 2)])
+    assert [b['id'] for b in store.between(*interval(5, 6))] == ['long']
+    assert store.create(booking('new', 5, 6), *interval(5, 6)) is None
+    assert store.create(booking('after', 10, 11), *interval(10, 11)) is not None
+
+
+def test_unparseable_bookings_survive_compaction(tmp_path):
+    bad = {'id': 'bad', 'start_time': 'not a time', 'end_time': None}
+    store = store_with(tmp_path, [booking('a', 1, 2), bad], compact_every=1)
+    assert store.create(booking('b', 3, 4), *interval(3, 4)) is not None
+    saved = json.loads((tmp_path / 'bookings.json').read_text())
+    assert [record['id'] for record in saved] == ['a', 'b', 'bad']
+    assert saved[2] == bad
+
+
+def test_unreadable_snapshot_is_never_compacted_over(tmp_path):
+    store = store_with(tmp_path, '[{"id": "a", truncated', compact_every=1)
+    assert store.create(booking('b', 3, 4), *interval(3, 4)) is not None
+    assert (tmp_path / 'bookings.json').read_text() == '[{"id": "a", truncated'
+    assert 'b' in (tmp_path / 'bookings.journal').read_text()
+
+# --- FITS ---
+
+@pytest.mark.parametrize('shape, dtype', [((7, 9), np.uint16), ((7, 9, 3), np.uint8), ((7, 9, 3), np.uint16)])
+def test_fits_round_trip(tmp_path, shape, dtype):
+    data = np.random.default_rng(0).integers(0, np.iinfo(dtype).max, shape, endpoint=True).astype(dtype)
+    path = str(tmp_path / 'frame.fits')
+    cs.write_fits(path, data, [('GAIN', 7, 'sensor gain')])
+    restored = cs.read_fits(path)
+    assert restored.dtype == data.dtype
+    assert np.array_equal(restored, data)
+    assert os.path.getsize(path) % cs.FITS_BLOCK == 0
+
+
+def test_fits_header_comes_from_the_frame(connected, tmp_path):
+    img = snapshot(connected, 'RAW16')
+    # Settings changed after the capture must not leak into the header
+    assert connected.post('/camera/settings', json={'gain': img.gain + 10, 'photo_exposure': 20000}).status_code == 200
+    path = str(tmp_path / 'photo.fits')
+    cs.write_fits(path, cs.frame_array(img), cs.fits_header(img))
+    header, _ = cs.open_fits(path)
+    assert int(header['GAIN']) == img.gain
+    assert float(header['EXPTIME']) == pytest.approx(img.exposure_us / 1e6)
+    assert header['BAYERPAT'] == cs.BAYER_NAMES[img.bayer_pattern]
+    assert header['DATE-OBS'].startswith(datetime.fromtimestamp(img.exposure_start, timezone.utc).strftime('%Y-%m-%dT%H:%M'))
+    assert np.array_equal(cs.read_fits(path), cs.frame_array(img))
+
+# --- Demosaic ---
+
+def reference_bilinear(raw, bayer_pattern):
+    """Each color: the pixel's own value, else the rounded mean of that color in its (mirrored) 3x3 neighbourhood"""
+    ry, rx = cs.BAYER_RED_OFFSET[bayer_pattern]
+    height, width = raw.shape
+    padded = np.pad(raw.astype(np.int64), 1, mode='reflect')
+    # Mirroring keeps each pixel's row and column parity, so the padding has the same CFA
+    rows, cols = np.indices(padded.shape) - 1
+    color = np.ones(padded.shape, int)  # Green
+    color[(rows % 2 == ry) & (cols % 2 == rx)] = 0
+    color[(rows % 2 != ry) & (cols % 2 != rx)] = 2
+    out = np.empty((height, width, 3), raw.dtype)
+    for y in range(height):
+        for x in range(width):
+            values = padded[y:y + 3, x:x + 3]
+            colors = color[y:y + 3, x:x + 3]
+            for c in range(3):
+                if colors[1, 1] == c:
+                    out[y, x, c] = values[1, 1]
+                else:
+                    same = values[colors == c]
+                    out[y, x, c] = (same.sum() + len(same) // 2) // len(same)
+    return out
+
+
+@pytest.mark.parametrize('bayer_pattern', sorted(cs.BAYER_RED_OFFSET))
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16])
+def test_bilinear_demosaic_matches_reference(bayer_pattern, dtype):
+    raw = np.random.default_rng(bayer_pattern).integers(0, np.iinfo(dtype).max, (10, 14), endpoint=True).astype(dtype)
+    result = cs.demosaicer.demosaic(raw, bayer_pattern)
+    assert result.dtype == dtype
+    assert np.array_equal(result, reference_bilinear(raw, bayer_pattern))
+
+
+@pytest.mark.parametrize('bayer_pattern', sorted(cs.BAYER_RED_OFFSET))
+def test_superpixel_demosaic_matches_reference(bayer_pattern):
+    raw = np.random.default_rng(bayer_pattern).integers(0, 65535, (10, 14), endpoint=True).astype(np.uint16)
+    ry, rx = cs.BAYER_RED_OFFSET[bayer_pattern]
+    result = cs.demosaicer.demosaic(raw, bayer_pattern, mode='superpixel')
+    for y in range(5):
+        for x in range(7):
+            cell = raw[2 * y:2 * y + 2, 2 * x:2 * x + 2].astype(int)
+            green = (cell[ry, 1 - rx] + cell[1 - ry, rx]) // 2
+            assert list(result[y, x]) == [cell[ry, rx], green, cell[1 - ry, 1 - rx]]
+
+# --- Sequence ZIP stream ---
+
+def test_sequence_zip_stream_is_a_valid_archive(connected):
+    response = connected.post('/camera/sequence/capture?stream=zip', json={'count': 3})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ['photo_0001.jpg', 'photo_0002.jpg', 'photo_0003.jpg', 'summary.json']
+        assert json.loads(archive.read('summary.json')) == {'count': 3, 'failed': []}
+        photo = Image.open(io.BytesIO(archive.read('photo_0001.jpg')))
+        assert photo.format == 'JPEG'
+        assert photo.size == (cs.camera_state['max_width'], cs.camera_state['max_height'])
+
+# --- Capture downloads ---
+
+@pytest.fixture
+def capture_file(tmp_path, monkeypatch):
+    index = cs.CaptureIndex(str(tmp_path / 'capture_roots.json'))
+    monkeypatch.setattr(cs, 'capture_index', index)
+    path = tmp_path / 'frame_0001.fits'
+    path.write_bytes(bytes(range(256)) * 16)
+    stat = path.stat()
+    index.add(str(path), stat.st_size, stat.st_mtime)
+    return path
+
+
+def test_download_supports_etag(client, capture_file):
+    response = client.get(f'/captures/{capture_file.name}')
+    assert response.status_code == 200
+    assert response.data == capture_file.read_bytes()
+    etag = response.headers['ETag']
+    assert client.get(f'/captures/{capture_file.name}', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get(f'/captures/{capture_file.name}', headers={'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_download_supports_range_resume(client, capture_file):
+    data = capture_file.read_bytes()
+    etag = client.get(f'/captures/{capture_file.name}').headers['ETag']
+    response = client.get(f'/captures/{capture_file.name}', headers={'Range': 'bytes=1000-1999', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 1000-1999/{len(data)}'
+    assert response.data == data[1000:2000]
+    # A stale validator gets the whole file instead of a mismatched piece
+    response = client.get(f'/captures/{capture_file.name}', headers={'Range': 'bytes=1000-', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == data
+    assert client.get(f'/captures/{capture_file.name}', headers={'Range': f'bytes={len(data)}-'}).status_code == 416
+
+
+def test_download_of_a_deleted_file_is_not_found(client, capture_file):
+    capture_file.unlink()
+    assert client.get(f'/captures/{capture_file.name}').status_code == 404
+    assert cs.capture_index.path(capture_file.name) is None